@@ -0,0 +1,193 @@
+"""
+MinHash/LSH блокинг STE перед кластеризацией.
+
+Большинство групп STE - почти одинаковые названия, отличающиеся номером
+модели. Вместо HDBSCAN по всему каталогу:
+1. точные дубликаты (после нормализации) схлопываются в одного представителя;
+2. представители раскладываются по блокам кандидатов через MinHash/LSH
+   по шинглам названия, производителя и модели;
+3. дорогая кластеризация запускается только внутри блоков.
+"""
+import os
+import re
+import zlib
+from typing import Iterable, List
+
+import numpy as np
+import pandas as pd
+
+# Длина символьных шинглов
+SHINGLE_SIZE = int(os.getenv('BLOCKING_SHINGLE_SIZE', 4))
+# Число хеш-функций MinHash = BANDS * ROWS
+BLOCKING_BANDS = int(os.getenv('BLOCKING_BANDS', 16))
+BLOCKING_ROWS = int(os.getenv('BLOCKING_ROWS', 4))
+# Минимальная оценка сходства Жаккара для объединения кандидатов в блок
+BLOCKING_THRESHOLD = float(os.getenv('BLOCKING_THRESHOLD', 0.5))
+# Максимальный размер блока (защита от склейки каталога в один блок)
+BLOCKING_MAX_BLOCK_SIZE = int(os.getenv('BLOCKING_MAX_BLOCK_SIZE', 500))
+# Учитывать характеристики в шинглах
+BLOCKING_USE_CHARACTERISTICS = os.getenv('BLOCKING_USE_CHARACTERISTICS', '0') == '1'
+
+_MERSENNE_PRIME = (1 << 61) - 1
+_MAX_HASH = (1 << 32) - 1
+_NON_WORD = re.compile(r'[^\w]+')
+
+
+def normalize_text(value) -> str:
+    """Нижний регистр, без пунктуации и лишних пробелов."""
+    if value is None or (isinstance(value, float) and np.isnan(value)):
+        return ''
+    return _NON_WORD.sub(' ', str(value).lower()).strip()
+
+
+def blocking_key(row) -> str:
+    """Текст STE для блокинга: название + производитель + модель (+ характеристики)."""
+    parts = [row.get('title'), row.get('manufacturer'), row.get('model_name')]
+    if BLOCKING_USE_CHARACTERISTICS and isinstance(row.get('features'), dict):
+        parts.extend(f"{k} {v}" for k, v in sorted(row['features'].items()))
+    return ' '.join(filter(None, (normalize_text(part) for part in parts)))
+
+
+def shingles(text: str, size: int = SHINGLE_SIZE) -> np.ndarray:
+    """Хеши символьных шинглов текста (crc32 стабилен между процессами, в отличие от hash())."""
+    if len(text) <= size:
+        grams = {text}
+    else:
+        grams = {text[i:i + size] for i in range(len(text) - size + 1)}
+    return np.fromiter((zlib.crc32(gram.encode('utf-8')) for gram in grams), dtype=np.uint64, count=len(grams))
+
+
+def minhash_signatures(texts: Iterable[str], num_perm: int, seed: int = 1) -> np.ndarray:
+    """MinHash подписи [len(texts), num_perm] через универсальное хеширование (a*x + b) mod p."""
+    rng = np.random.default_rng(seed)
+    # x < 2^32 и a, b < 2^31, поэтому a*x + b помещается в uint64 без переполнения
+    a = rng.integers(1, 1 << 31, num_perm, dtype=np.uint64)
+    b = rng.integers(0, 1 << 31, num_perm, dtype=np.uint64)
+
+    texts = list(texts)
+    signatures = np.full((len(texts), num_perm), _MAX_HASH, dtype=np.uint64)
+    for i, text in enumerate(texts):
+        hashes = shingles(text)
+        if len(hashes) == 0:
+            continue
+        permuted = ((hashes[:, None] * a[None, :] + b[None, :]) % _MERSENNE_PRIME) & _MAX_HASH
+        signatures[i] = permuted.min(axis=0)
+    return signatures
+
+
+class _UnionFind:
+    def __init__(self, size: int):
+        self.parent = np.arange(size)
+        self.size = np.ones(size, dtype=np.int64)
+
+    def find(self, x: int) -> int:
+        root = x
+        while self.parent[root] != root:
+            root = self.parent[root]
+        while self.parent[x] != root:
+            self.parent[x], x = root, self.parent[x]
+        return root
+
+    def union(self, x: int, y: int, max_size: int) -> None:
+        rx, ry = self.find(x), self.find(y)
+        if rx == ry or self.size[rx] + self.size[ry] > max_size:
+            return
+        small, big = (rx, ry) if self.size[rx] < self.size[ry] else (ry, rx)
+        self.parent[small] = big
+        self.size[big] += self.size[small]
+
+
+def candidate_pairs(signatures: np.ndarray, bands: int = BLOCKING_BANDS, rows: int = BLOCKING_ROWS) -> np.ndarray:
+    """Пары подписей, совпавших хотя бы в одной полосе LSH (соседние в бакете)."""
+    pairs = []
+    for band in range(bands):
+        band_values = signatures[:, band * rows:(band + 1) * rows]
+        _, inverse = np.unique(band_values, axis=0, return_inverse=True)
+        inverse = inverse.ravel()
+        order = np.argsort(inverse, kind='stable')
+        sorted_keys = inverse[order]
+        same = np.flatnonzero(sorted_keys[1:] == sorted_keys[:-1])
+        pairs.append(np.stack([order[same], order[same + 1]], axis=1))
+    if not pairs:
+        return np.zeros((0, 2), dtype=np.int64)
+    pairs = np.sort(np.concatenate(pairs), axis=1)
+    return np.unique(pairs, axis=0)
+
+
+def lsh_blocks(
+    signatures: np.ndarray,
+    bands: int = BLOCKING_BANDS,
+    rows: int = BLOCKING_ROWS,
+    threshold: float = BLOCKING_THRESHOLD,
+    max_block_size: int = BLOCKING_MAX_BLOCK_SIZE,
+) -> np.ndarray:
+    """
+    Номер блока для каждой подписи.
+
+    Кандидаты из LSH проверяются оценкой Жаккара по подписям и объединяются
+    от самых похожих к менее похожим. Размер блока ограничен, иначе общая
+    лексика каталога склеивает всё в один блок через цепочки.
+    """
+    n = len(signatures)
+    uf = _UnionFind(n)
+    pairs = candidate_pairs(signatures, bands, rows)
+    if len(pairs):
+        similarity = (signatures[pairs[:, 0]] == signatures[pairs[:, 1]]).mean(axis=1)
+        keep = similarity >= threshold
+        pairs, similarity = pairs[keep], similarity[keep]
+        for a, b in pairs[np.argsort(-similarity, kind='stable')]:
+            uf.union(a, b, max_block_size)
+    roots = np.array([uf.find(i) for i in range(n)])
+    _, block_ids = np.unique(roots, return_inverse=True)
+    return block_ids.ravel()
+
+
+def build_blocks(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Блокинг STE.
+
+    Returns:
+        DataFrame с колонками id, dup_group (группа точных дубликатов),
+        is_representative и block_id (блок кандидатов для представителя группы)
+    """
+    if df.empty:
+        return pd.DataFrame(columns=['id', 'dup_group', 'is_representative', 'block_id'])
+
+    keys = [blocking_key(row) for row in df.to_dict('records')]
+    dup_group = pd.factorize(pd.Series(keys))[0]
+
+    result = pd.DataFrame({'id': df['id'].to_numpy(), 'dup_group': dup_group})
+    result['is_representative'] = ~result['dup_group'].duplicated()
+
+    representatives = result.loc[result['is_representative'], 'dup_group'].to_numpy()
+    rep_keys = [keys[i] for i in np.flatnonzero(result['is_representative'].to_numpy())]
+    signatures = minhash_signatures(rep_keys, BLOCKING_BANDS * BLOCKING_ROWS)
+    group_block = pd.Series(lsh_blocks(signatures), index=representatives)
+    result['block_id'] = result['dup_group'].map(group_block).astype(int)
+    return result
+
+
+def block_stats(blocks: pd.DataFrame) -> dict:
+    """Насколько блокинг сократил вход кластеризации."""
+    reps = blocks[blocks['is_representative']]
+    block_sizes = reps.groupby('block_id').size()
+    return {
+        'total': len(blocks),
+        'representatives': len(reps),
+        'blocks': len(block_sizes),
+        'singleton_blocks': int((block_sizes == 1).sum()),
+        'largest_block': int(block_sizes.max()) if len(block_sizes) else 0,
+        # Сколько STE реально уходит в кластеризацию
+        'clustered': int(block_sizes[block_sizes > 1].sum()),
+    }
+
+
+def block_members(blocks: pd.DataFrame, min_size: int = 2) -> List[np.ndarray]:
+    """Позиции представителей (в blocks) для каждого блока размером >= min_size."""
+    reps = blocks[blocks['is_representative']]
+    groups = reps.groupby('block_id').indices
+    return [
+        reps.index.to_numpy()[positions]
+        for positions in groups.values()
+        if len(positions) >= min_size
+    ]
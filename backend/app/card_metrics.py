@@ -0,0 +1,203 @@
+"""
+Метрики связности карточек по эмбеддингам STE.
+
+Для каждой карточки считаются средняя попарная близость STE, самый
+далёкий от центроида STE и ближайшая другая карточка. Всё считается
+векторно: суммы векторов по карточкам собираются через np.add.at,
+средняя попарная близость выводится из нормы суммы без матрицы n x n.
+
+Частичный пересчёт читает только STE пересчитываемых карточек и карточек-
+кандидатов в ближайшие: карточек их соседей по графу ste_neighbors и
+прежних ближайших. Пока граф не построен, читаются все карточки.
+"""
+import logging
+from typing import List, Optional, Set
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import delete, insert, select
+from sqlalchemy.orm import Session, aliased
+
+from . import database, embedding_store, http_cache, models
+
+logger = logging.getLogger(__name__)
+
+_CHUNK = 65536
+
+
+def _load_assignments(db: Session, store, card_ids: Optional[List[int]] = None) -> pd.DataFrame:
+    """Пары (STE, карточка) для STE, у которых есть вектор в хранилище (card_ids - только этих карточек)."""
+    query = select(models.STE.id, models.STE.card_id).where(models.STE.card_id.isnot(None))
+    if card_ids is None:
+        rows = db.execute(query).all()
+    else:
+        rows = []
+        for start in range(0, len(card_ids), 5000):
+            rows += db.execute(query.where(models.STE.card_id.in_(card_ids[start:start + 5000]))).all()
+    df = pd.DataFrame(rows, columns=['ste_id', 'card_id'])
+    if df.empty:
+        df['position'] = pd.Series(dtype=np.int64)
+        return df
+    df['position'] = store.positions(df['ste_id'].to_numpy())
+    return df[df['position'] >= 0].reset_index(drop=True)
+
+
+def _candidate_cards(db: Session, card_ids: List[int]) -> Optional[Set[int]]:
+    """
+    Карточки, среди которых ищем ближайшие к card_ids: карточки соседей их STE
+    по графу и прежние ближайшие. None - графа для этих STE нет.
+    """
+    neighbor = aliased(models.STE)
+    found, has_edges = set(), False
+    for start in range(0, len(card_ids), 5000):
+        chunk = card_ids[start:start + 5000]
+        cards = db.scalars(
+            select(neighbor.card_id)
+            .select_from(models.STE)
+            .join(models.STENeighbor, models.STENeighbor.ste_id == models.STE.id)
+            .join(neighbor, neighbor.id == models.STENeighbor.neighbor_id)
+            .where(models.STE.card_id.in_(chunk), neighbor.card_id.isnot(None))
+            .distinct()
+        ).all()
+        has_edges = has_edges or bool(cards)
+        found.update(cards)
+        found.update(db.scalars(
+            select(models.CardMetrics.nearest_card_id)
+            .where(models.CardMetrics.card_id.in_(chunk), models.CardMetrics.nearest_card_id.isnot(None))
+        ))
+    return found if has_edges else None
+
+
+def compute_card_metrics(db: Session, store, card_ids: Optional[List[int]] = None) -> List[dict]:
+    """
+    Считает метрики для card_ids (None - для всех карточек).
+    Центроиды нужны и карточкам-кандидатам, чтобы найти ближайшую соседнюю.
+    """
+    if card_ids is None:
+        df = _load_assignments(db, store)
+    else:
+        card_ids = sorted(set(card_ids))
+        if not card_ids:
+            return []
+        candidates = _candidate_cards(db, card_ids)
+        if candidates is None:
+            # Без графа ближайшую карточку честно найти можно только среди всех
+            logger.warning(
+                f"Neighbor graph has no edges for {len(card_ids)} cards: "
+                f"partial metrics refresh loads the whole catalog (run python -m app.neighbors)"
+            )
+            df = _load_assignments(db, store)
+        else:
+            df = pd.concat([
+                _load_assignments(db, store, card_ids),
+                _load_assignments(db, store, sorted(candidates - set(card_ids))),
+            ], ignore_index=True)
+    if df.empty:
+        return []
+
+    codes, cards = pd.factorize(df['card_id'])
+    positions = df['position'].to_numpy()
+
+    # Проход 1: суммы векторов и суммы квадратов норм по карточкам
+    sums = np.zeros((len(cards), store.dim), dtype=np.float64)
+    sq_norms = np.zeros(len(cards), dtype=np.float64)
+    for start in range(0, len(positions), _CHUNK):
+        vectors = store.dequantize(positions[start:start + _CHUNK])
+        chunk_codes = codes[start:start + _CHUNK]
+        np.add.at(sums, chunk_codes, vectors)
+        np.add.at(sq_norms, chunk_codes, (vectors ** 2).sum(axis=1))
+    counts = np.bincount(codes, minlength=len(cards))
+
+    sum_norms_sq = (sums ** 2).sum(axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        # sum_{i != j} <v_i, v_j> = |sum v|^2 - sum |v_i|^2
+        mean_similarity = np.where(counts > 1, (sum_norms_sq - sq_norms) / (counts * (counts - 1)), np.nan)
+    norms = np.sqrt(sum_norms_sq)
+    norms[norms == 0] = 1.0
+    centroids = (sums / norms[:, None]).astype(np.float32)
+
+    if card_ids is None:
+        target = np.arange(len(cards))
+    else:
+        target = np.flatnonzero(np.isin(cards.to_numpy(), card_ids))
+    if len(target) == 0:
+        return []
+
+    # Проход 2: близость STE целевых карточек к центроиду своей карточки
+    member_mask = np.isin(codes, target)
+    member_codes = codes[member_mask]
+    member_positions = positions[member_mask]
+    member_ids = df['ste_id'].to_numpy()[member_mask]
+    member_sims = np.empty(len(member_positions), dtype=np.float32)
+    for start in range(0, len(member_positions), _CHUNK):
+        vectors = store.dequantize(member_positions[start:start + _CHUNK])
+        member_sims[start:start + _CHUNK] = (vectors * centroids[member_codes[start:start + _CHUNK]]).sum(axis=1)
+    worst = (
+        pd.DataFrame({'code': member_codes, 'ste_id': member_ids, 'sim': member_sims})
+        .sort_values('sim')
+        .drop_duplicates('code')
+        .set_index('code')
+    )
+
+    # Ближайшая другая карточка по центроидам
+    nearest = np.full(len(target), -1)
+    nearest_sim = np.full(len(target), np.nan, dtype=np.float32)
+    if len(cards) > 1:
+        for start in range(0, len(target), 1024):
+            block = target[start:start + 1024]
+            scores = centroids[block] @ centroids.T
+            scores[np.arange(len(block)), block] = -np.inf
+            best = scores.argmax(axis=1)
+            nearest[start:start + len(block)] = best
+            nearest_sim[start:start + len(block)] = scores[np.arange(len(block)), best]
+
+    results = []
+    for i, code in enumerate(target):
+        has_worst = counts[code] > 1 and code in worst.index
+        results.append({
+            'card_id': int(cards[code]),
+            'size': int(counts[code]),
+            'mean_similarity': None if np.isnan(mean_similarity[code]) else float(mean_similarity[code]),
+            'worst_ste_id': int(worst.at[code, 'ste_id']) if has_worst else None,
+            'worst_similarity': float(worst.at[code, 'sim']) if has_worst else None,
+            'nearest_card_id': int(cards[nearest[i]]) if nearest[i] >= 0 else None,
+            'nearest_card_similarity': None if np.isnan(nearest_sim[i]) else float(nearest_sim[i]),
+        })
+    return results
+
+
+def refresh_card_metrics(db: Session, card_ids: Optional[List[int]] = None) -> int:
+    """Пересчитывает и сохраняет метрики карточек (None - все карточки)."""
+    if card_ids is not None and not card_ids:
+        return 0
+    store = embedding_store.get_store()
+    if store is None:
+        return 0
+
+    rows = compute_card_metrics(db, store, card_ids)
+    if card_ids is None:
+        db.execute(delete(models.CardMetrics))
+    else:
+        for start in range(0, len(card_ids), 5000):
+            db.execute(delete(models.CardMetrics).where(
+                models.CardMetrics.card_id.in_(card_ids[start:start + 5000])
+            ))
+    for start in range(0, len(rows), 5000):
+        db.execute(insert(models.CardMetrics), rows[start:start + 5000])
+    db.commit()
+    # Новое поколение метрик меняет ETag каталога (sort=quality)
+    http_cache.catalog_version.invalidate()
+    logger.info(f"Card metrics refreshed for {len(rows)} cards")
+    return len(rows)
+
+
+def refresh_card_metrics_task(card_ids: Optional[List[int]] = None) -> None:
+    """Фоновое обновление метрик после реагрегации (своя сессия БД)."""
+    db = database.SessionLocal()
+    try:
+        refresh_card_metrics(db, card_ids)
+    except Exception as e:
+        logger.error(f"Card metrics refresh failed: {e}")
+        db.rollback()
+    finally:
+        db.close()
@@ -0,0 +1,169 @@
+"""
+Журнал изменений STE и карточек для инкрементальной синхронизации.
+
+Каждая запись в stes/cards увеличивает version, обновляет updated_at и
+добавляет строку в change_log (seq растёт монотонно). Потребители читают
+/api/changes?since=<seq> и забирают только изменившиеся id.
+
+Курсор корректен, только если строки журнала становятся видимы в порядке
+seq. На PostgreSQL параллельные транзакции коммитятся в произвольном
+порядке, поэтому запись в журнал берёт advisory lock до конца транзакции:
+следующий seq выдаётся только после коммита предыдущей пишущей транзакции.
+Пишущие транзакции сериализуются от первой записи в журнал до коммита.
+
+Журнал не растёт бесконечно: ``python -m app.changes`` (по cron) удаляет
+записи старше CHANGE_LOG_RETENTION_DAYS и записи, перекрытые более поздней
+записью того же объекта. Курсор старше начала журнала получает 410 -
+потребителю нужна полная выгрузка.
+
+ORM-записи (CRUD, импорт) отслеживаются событиями сессии автоматически;
+массовые пути (executemany UPDATE, INSERT ... RETURNING, DELETE по условию)
+вызывают record_changes явно.
+"""
+import argparse
+import logging
+import os
+from datetime import datetime, timedelta, timezone
+from typing import Iterable, List, Optional
+
+from sqlalchemy import delete, event, exists, func, insert, select, text, update
+from sqlalchemy.orm import Session, aliased
+
+from . import database, models
+
+logger = logging.getLogger(__name__)
+
+ENTITIES = {"ste": models.STE, "card": models.Card}
+_ENTITY_NAMES = {model: name for name, model in ENTITIES.items()}
+
+# Сколько дней хранить записи журнала
+CHANGE_LOG_RETENTION_DAYS = int(os.getenv("CHANGE_LOG_RETENTION_DAYS", 30))
+
+_CHUNK = 5000
+# Произвольный ключ для pg_advisory_xact_lock (отличается от ключа миграций)
+_LOG_LOCK_KEY = 7_340_042
+
+
+def _lock_log(connection) -> None:
+    """PostgreSQL: seq выдаются и коммитятся по порядку (блокировка до конца транзакции)."""
+    if connection.dialect.name == "postgresql":
+        connection.execute(text("SELECT pg_advisory_xact_lock(:key)"), {"key": _LOG_LOCK_KEY})
+
+
+def record_changes(db: Session, entity: str, ids: Iterable[int], op: str = "update") -> int:
+    """
+    Фиксирует изменения массовых операций (без commit).
+    Для update/insert увеличивает version и обновляет updated_at строк.
+    """
+    ids = sorted({int(i) for i in ids})
+    if not ids:
+        return 0
+    model = ENTITIES[entity]
+    _lock_log(db.connection())
+    for start in range(0, len(ids), _CHUNK):
+        chunk = ids[start:start + _CHUNK]
+        if op == "update":
+            db.execute(
+                update(model)
+                .where(model.id.in_(chunk))
+                .values(version=model.version + 1, updated_at=func.now())
+                .execution_options(synchronize_session=False)
+            )
+        db.execute(insert(models.ChangeLog), [{"entity": entity, "entity_id": i, "op": op} for i in chunk])
+    return len(ids)
+
+
+@event.listens_for(Session, "before_flush")
+def _bump_versions(session, flush_context, instances):
+    for obj in session.dirty:
+        if type(obj) in _ENTITY_NAMES and session.is_modified(obj, include_collections=False):
+            # updated_at обновится через onupdate колонки
+            obj.version = (obj.version or 0) + 1
+
+
+@event.listens_for(Session, "after_flush")
+def _log_orm_changes(session, flush_context):
+    rows = []
+    for objects, op in ((session.new, "insert"), (session.dirty, "update"), (session.deleted, "delete")):
+        for obj in objects:
+            entity = _ENTITY_NAMES.get(type(obj))
+            if entity is None or obj.id is None:
+                continue
+            if op == "update" and not session.is_modified(obj, include_collections=False):
+                continue
+            rows.append({"entity": entity, "entity_id": obj.id, "op": op})
+    if rows:
+        connection = session.connection()
+        _lock_log(connection)
+        connection.execute(insert(models.ChangeLog), rows)
+
+
+def get_changes(db: Session, since: int = 0, limit: int = 1000, entity: Optional[str] = None) -> List[tuple]:
+    """Записи журнала после since в порядке seq."""
+    query = select(
+        models.ChangeLog.seq, models.ChangeLog.entity, models.ChangeLog.entity_id,
+        models.ChangeLog.op, models.ChangeLog.changed_at,
+    ).where(models.ChangeLog.seq > since)
+    if entity is not None:
+        query = query.where(models.ChangeLog.entity == entity)
+    return db.execute(query.order_by(models.ChangeLog.seq).limit(limit)).all()
+
+
+def oldest_cursor(db: Session) -> int:
+    """Наименьший since, с которым журнал ещё полон (до него записи удалены очисткой)."""
+    first = db.scalar(select(func.min(models.ChangeLog.seq)))
+    return first - 1 if first is not None else 0
+
+
+def prune_changes(db: Session, retention_days: int = CHANGE_LOG_RETENTION_DAYS) -> dict:
+    """
+    Удаляет записи старше retention_days и компактирует журнал: у объекта
+    остаётся только последняя запись (потребитель всё равно перечитывает объект).
+    Первая и последняя записи журнала не удаляются компакцией: по ним
+    определяются начало журнала (oldest_cursor) и текущий seq.
+    """
+    cutoff = datetime.now(timezone.utc) - timedelta(days=retention_days)
+    last = db.scalar(select(func.max(models.ChangeLog.seq)))
+    if last is None:
+        return {"expired": 0, "compacted": 0}
+
+    expired = db.execute(
+        delete(models.ChangeLog)
+        .where(models.ChangeLog.changed_at < cutoff, models.ChangeLog.seq < last)
+        .execution_options(synchronize_session=False)
+    ).rowcount
+
+    first = db.scalar(select(func.min(models.ChangeLog.seq)))
+    later = aliased(models.ChangeLog)
+    compacted = db.execute(
+        delete(models.ChangeLog)
+        .where(
+            models.ChangeLog.seq > first,
+            exists().where(
+                later.entity == models.ChangeLog.entity,
+                later.entity_id == models.ChangeLog.entity_id,
+                later.seq > models.ChangeLog.seq,
+            ),
+        )
+        .execution_options(synchronize_session=False)
+    ).rowcount
+    db.commit()
+    logger.info(f"Change log pruned: {expired} expired, {compacted} compacted")
+    return {"expired": expired, "compacted": compacted}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Prune and compact the change log")
+    parser.add_argument("--retention-days", type=int, default=CHANGE_LOG_RETENTION_DAYS)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(name)s %(levelname)s %(message)s")
+    db = database.SessionLocal()
+    try:
+        print(prune_changes(db, args.retention_days))
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
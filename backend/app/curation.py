@@ -0,0 +1,252 @@
+"""
+Ручная курация карточек: слияние, разделение и перенос STE.
+
+Каждая операция - несколько UPDATE/DELETE по множествам id в одной
+транзакции (commit - на вызывающем) вместо загрузки ORM объектов и
+изменения STE по одному. Изменения попадают в журнал (changes.py),
+HTTP кеш каталога сбрасывается middleware после записи, метрики
+связности затронутых карточек пересчитываются фоном вызывающим.
+
+Оценки при слиянии переезжают в целевую карточку (при совпадении
+пользователя и STE остаётся последний голос). При разделении и переносе
+оценки остаются у прежней карточки: они относятся к прежнему составу.
+"""
+import os
+from typing import Iterable, List, Optional, Set
+
+from fastapi import HTTPException
+from sqlalchemy import and_, delete, exists, func, insert, or_, select, update
+from sqlalchemy.orm import Session, aliased
+
+from . import changes, models, ratings
+
+# Максимум STE в одном запросе курации
+CARD_BULK_MAX = int(os.getenv("CARD_BULK_MAX", 10000))
+
+_CHUNK = 5000
+
+
+def _chunks(ids: List[int]):
+    for start in range(0, len(ids), _CHUNK):
+        yield ids[start:start + _CHUNK]
+
+
+def create_cards(db: Session, count: int, name: Optional[str] = None) -> List[int]:
+    """Создаёт ``count`` пустых карточек одним INSERT и возвращает их id."""
+    if count <= 0:
+        return []
+    result = db.execute(
+        insert(models.Card).returning(models.Card.id),
+        [{'name': name} for _ in range(count)]
+    )
+    card_ids = [row[0] for row in result]
+    changes.record_changes(db, 'card', card_ids, op='insert')
+    return card_ids
+
+
+def delete_cards(db: Session, card_ids: Iterable[int], condition=None) -> List[int]:
+    """Удаляет карточки (и их метрики) одним DELETE; ``condition`` - доп. фильтр. Возвращает удалённые id."""
+    deleted = []
+    for chunk in _chunks(sorted(set(card_ids))):
+        query = delete(models.Card).where(models.Card.id.in_(chunk))
+        if condition is not None:
+            query = query.where(condition)
+        deleted += db.execute(
+            query.returning(models.Card.id).execution_options(synchronize_session=False)
+        ).scalars().all()
+    for chunk in _chunks(deleted):
+        # На SQLite ON DELETE CASCADE не срабатывает без PRAGMA foreign_keys
+        db.execute(delete(models.CardMetrics).where(models.CardMetrics.card_id.in_(chunk)))
+    changes.record_changes(db, 'card', deleted, op='delete')
+    return deleted
+
+
+def _retire_empty(db: Session, card_ids: Iterable[int]) -> List[int]:
+    has_stes = select(models.STE.id).where(models.STE.card_id == models.Card.id).exists()
+    has_feedback = select(models.Feedback.id).where(models.Feedback.card_id == models.Card.id).exists()
+    return delete_cards(db, card_ids, ~has_stes & ~has_feedback)
+
+
+def retire_empty_cards(db: Session, card_ids: List[int]) -> int:
+    """
+    Удаляет карточки из ``card_ids``, в которых не осталось STE.
+    Карточки с фидбеком не удаляются - оценки нужны для ML датасета.
+    """
+    if not card_ids:
+        return 0
+    return len(_retire_empty(db, card_ids))
+
+
+def reassign(db: Session, condition, card_id: Optional[int]) -> List[int]:
+    """
+    UPDATE stes SET card_id = :card_id по условию (None - отвязать).
+    STE, уже привязанные к card_id, не трогаются. Возвращает id перенесённых STE.
+    """
+    moved = db.execute(
+        update(models.STE)
+        .where(condition, models.STE.card_id.is_distinct_from(card_id))
+        .values(card_id=card_id)
+        .returning(models.STE.id)
+        .execution_options(synchronize_session=False)
+    ).scalars().all()
+    changes.record_changes(db, 'ste', moved)
+    return moved
+
+
+def move_stes(db: Session, ste_ids: Iterable[int], card_id: Optional[int]) -> List[int]:
+    moved = []
+    for chunk in _chunks(sorted(set(ste_ids))):
+        moved += reassign(db, models.STE.id.in_(chunk), card_id)
+    return moved
+
+
+def _card_ids_of(db: Session, ste_ids: List[int]) -> Set[int]:
+    """Текущие карточки STE (до переноса)."""
+    found = set()
+    for chunk in _chunks(ste_ids):
+        found.update(db.scalars(
+            select(models.STE.card_id).where(models.STE.id.in_(chunk), models.STE.card_id.isnot(None)).distinct()
+        ))
+    return found
+
+
+def _lock_cards(db: Session, card_ids: Iterable[int]) -> Set[int]:
+    """Существующие карточки из card_ids; на PostgreSQL строки блокируются до конца транзакции."""
+    card_ids = sorted(set(card_ids))
+    found = set()
+    for chunk in _chunks(card_ids):
+        found.update(db.scalars(
+            select(models.Card.id).where(models.Card.id.in_(chunk)).order_by(models.Card.id).with_for_update()
+        ))
+    missing = sorted(set(card_ids) - found)
+    if missing:
+        raise HTTPException(status_code=404, detail={"msg": "Card not found", "card_ids": missing})
+    return found
+
+
+def _check_stes(db: Session, ste_ids: List[int]) -> None:
+    if len(ste_ids) > CARD_BULK_MAX:
+        raise HTTPException(status_code=400, detail=f"At most {CARD_BULK_MAX} STE per request")
+    found = set()
+    for chunk in _chunks(ste_ids):
+        found.update(db.scalars(select(models.STE.id).where(models.STE.id.in_(chunk))))
+    missing = sorted(set(ste_ids) - found)
+    if missing:
+        raise HTTPException(status_code=404, detail={"msg": "STE not found", "ste_ids": missing})
+
+
+def _set_name(db: Session, card_id: int, name: Optional[str]) -> None:
+    if name is not None:
+        db.execute(
+            update(models.Card).where(models.Card.id == card_id).values(name=name)
+            .execution_options(synchronize_session=False)
+        )
+
+
+def merge_cards(db: Session, target_id: int, source_ids: List[int], name: Optional[str] = None) -> dict:
+    """Переносит STE и оценки карточек source_ids в target_id и удаляет source_ids."""
+    source_ids = sorted(set(source_ids) - {target_id})
+    if not source_ids:
+        raise HTTPException(status_code=400, detail="source_ids must contain cards other than target_id")
+    if len(source_ids) > CARD_BULK_MAX:
+        raise HTTPException(status_code=400, detail=f"At most {CARD_BULK_MAX} cards per merge")
+    _lock_cards(db, [target_id, *source_ids])
+    cards = [target_id, *source_ids]
+
+    moved = reassign(db, models.STE.card_id.in_(source_ids), target_id)
+
+    # Дубли (STE, пользователь) после переноса: остаётся последний голос. Повторный
+    # голос обновляет строку на месте, поэтому «последний» - по updated_at, а не по id
+    other = aliased(models.Feedback)
+    voted_at = func.coalesce(models.Feedback.updated_at, models.Feedback.created_at)
+    other_voted_at = func.coalesce(other.updated_at, other.created_at)
+    db.execute(
+        delete(models.Feedback)
+        .where(
+            models.Feedback.card_id.in_(cards),
+            exists().where(
+                other.card_id.in_(cards),
+                other.ste_id == models.Feedback.ste_id,
+                other.user_id == models.Feedback.user_id,
+                or_(
+                    other_voted_at > voted_at,
+                    and_(other_voted_at == voted_at, other.id > models.Feedback.id),
+                ),
+            ),
+        )
+        .execution_options(synchronize_session=False)
+    )
+    db.execute(
+        update(models.Feedback)
+        .where(models.Feedback.card_id.in_(source_ids))
+        .values(card_id=target_id)
+        .execution_options(synchronize_session=False)
+    )
+
+    deleted = delete_cards(db, source_ids)
+    _set_name(db, target_id, name)
+    # Агрегаты оценок и запись в журнал для целевой карточки
+    ratings.refresh_card_feedback(db, [target_id])
+    return {
+        "card_id": target_id,
+        "moved": len(moved),
+        "touched_card_ids": cards,
+        "created_card_ids": [],
+        "deleted_card_ids": deleted,
+    }
+
+
+def split_card(db: Session, card_id: int, ste_ids: List[int], name: Optional[str] = None) -> dict:
+    """Выносит ste_ids карточки card_id в новую карточку."""
+    ste_ids = sorted(set(ste_ids))
+    if not ste_ids:
+        raise HTTPException(status_code=400, detail="ste_ids cannot be empty")
+    _check_stes(db, ste_ids)
+    _lock_cards(db, [card_id])
+    foreign = []
+    for chunk in _chunks(ste_ids):
+        foreign += db.scalars(select(models.STE.id).where(
+            models.STE.id.in_(chunk), models.STE.card_id.is_distinct_from(card_id)
+        )).all()
+    if foreign:
+        raise HTTPException(status_code=400, detail={"msg": "STE do not belong to the card", "ste_ids": sorted(foreign)})
+
+    new_id = create_cards(db, 1, name)[0]
+    moved = move_stes(db, ste_ids, new_id)
+    return {
+        "card_id": new_id,
+        "moved": len(moved),
+        "touched_card_ids": [card_id, new_id],
+        "created_card_ids": [new_id],
+        "deleted_card_ids": [],
+    }
+
+
+def move(db: Session, moves: List[dict], retire_empty: bool = False) -> dict:
+    """
+    Переносит наборы STE в указанные карточки (card_id None - отвязать).
+    С retire_empty опустевшие карточки без оценок удаляются.
+    """
+    all_ids = [ste_id for item in moves for ste_id in set(item["ste_ids"])]
+    if not all_ids:
+        raise HTTPException(status_code=400, detail="ste_ids cannot be empty")
+    if len(all_ids) != len(set(all_ids)):
+        raise HTTPException(status_code=400, detail="Each STE can appear in only one move")
+    all_ids.sort()
+    _check_stes(db, all_ids)
+    targets = {item["card_id"] for item in moves if item["card_id"] is not None}
+    sources = _card_ids_of(db, all_ids)
+    _lock_cards(db, targets | sources)
+
+    moved = 0
+    for item in moves:
+        moved += len(move_stes(db, item["ste_ids"], item["card_id"]))
+
+    deleted = _retire_empty(db, sources - targets) if retire_empty else []
+    return {
+        "card_id": None,
+        "moved": moved,
+        "touched_card_ids": sorted(targets | sources),
+        "created_card_ids": [],
+        "deleted_card_ids": deleted,
+    }
@@ -1,15 +1,76 @@
-from fastapi import Depends, HTTPException, status
+import os
+import threading
+import time
+from dataclasses import dataclass
+
+from fastapi import Depends, HTTPException, Request, status
 from fastapi.security import OAuth2PasswordBearer
 from jose import JWTError, jwt
-from sqlalchemy.orm import Session
+from sqlalchemy import event
 
-from . import database, models
+from . import database, metrics, models
 from .auth.jwt import ALGORITHM, SECRET_KEY
 
 # Указываем FastAPI, где находится эндпоинт получения токена
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/api/auth/login")
 
-def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(database.get_db)):
+# Сколько секунд пользователь из БД считается актуальным (0 - без кеша)
+AUTH_CACHE_TTL = float(os.getenv("AUTH_CACHE_TTL", 60))
+AUTH_CACHE_MAX_SIZE = int(os.getenv("AUTH_CACHE_MAX_SIZE", 10000))
+# Для GET/HEAD доверять подписанным claims токена (login, is_admin) без запроса в БД
+AUTH_TRUST_TOKEN_CLAIMS = os.getenv("AUTH_TRUST_TOKEN_CLAIMS", "0") == "1"
+
+
+@dataclass(frozen=True)
+class Principal:
+    """Аутентифицированный пользователь (без привязки к сессии БД)."""
+    id: int
+    username: str
+    is_admin: bool
+
+
+# (user_id, token) -> (Principal, истекает в)
+_principal_cache = {}
+_cache_lock = threading.Lock()
+
+
+def _cache_get(key):
+    with _cache_lock:
+        entry = _principal_cache.get(key)
+        if entry is None:
+            return None
+        if entry[1] <= time.monotonic():
+            del _principal_cache[key]
+            return None
+        return entry[0]
+
+
+def _cache_put(key, principal: Principal, expires_at: float) -> None:
+    with _cache_lock:
+        if len(_principal_cache) >= AUTH_CACHE_MAX_SIZE:
+            now = time.monotonic()
+            for stale in [k for k, (_, exp) in _principal_cache.items() if exp <= now]:
+                del _principal_cache[stale]
+            if len(_principal_cache) >= AUTH_CACHE_MAX_SIZE:
+                # Dict хранит порядок вставки - выкидываем самую старую запись
+                del _principal_cache[next(iter(_principal_cache))]
+        _principal_cache[key] = (principal, expires_at)
+
+
+def invalidate_user(user_id: int) -> None:
+    """Сбрасывает кеш пользователя в этом воркере (остальные воркеры - по TTL)."""
+    with _cache_lock:
+        for key in [k for k in _principal_cache if k[0] == user_id]:
+            del _principal_cache[key]
+
+
+@event.listens_for(models.User, "after_update")
+@event.listens_for(models.User, "after_delete")
+def _invalidate_on_user_change(mapper, connection, target):
+    invalidate_user(target.id)
+
+
+def get_current_user(request: Request, token: str = Depends(oauth2_scheme)) -> Principal:
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
@@ -20,10 +81,41 @@ def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(
         user_id: str = payload.get("sub")
         if user_id is None:
             raise credentials_exception
-    except JWTError:
-        raise credentials_exception
-    
-    user = db.query(models.User).filter(models.User.id == int(user_id)).first()
-    if user is None:
+        user_id = int(user_id)
+    except (JWTError, ValueError):
         raise credentials_exception
-    return user
+
+    # Чтение: claims подписаны нами при логине, БД не нужна
+    if (
+        AUTH_TRUST_TOKEN_CLAIMS
+        and request.method in database.READ_METHODS
+        and "login" in payload
+        and "is_admin" in payload
+    ):
+        metrics.observe_cache("auth", "bypass")
+        return Principal(id=user_id, username=payload["login"], is_admin=bool(payload["is_admin"]))
+
+    key = (user_id, token)
+    principal = _cache_get(key)
+    if principal is not None:
+        metrics.observe_cache("auth", "hit")
+        return principal
+    metrics.observe_cache("auth", "miss")
+
+    # Сессия открывается только при промахе кеша
+    db = database.SessionLocal()
+    try:
+        user = db.query(models.User).filter(models.User.id == user_id).first()
+        if user is None:
+            raise credentials_exception
+        principal = Principal(id=user.id, username=user.username, is_admin=bool(user.is_admin))
+    finally:
+        db.close()
+
+    if AUTH_CACHE_TTL > 0:
+        expires_at = time.monotonic() + AUTH_CACHE_TTL
+        if payload.get("exp"):
+            # Не держим пользователя в кеше дольше жизни токена
+            expires_at = min(expires_at, time.monotonic() + payload["exp"] - time.time())
+        _cache_put(key, principal, expires_at)
+    return principal
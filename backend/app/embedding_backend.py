@@ -0,0 +1,245 @@
+"""
+Бэкенды инференса модели эмбеддингов на CPU.
+
+- torch            - SentenceTransformer как есть
+- torch-quantized  - динамическое int8 квантование Linear слоёв
+- onnx             - экспорт трансформера в ONNX Runtime
+- onnx-int8        - ONNX модель с динамическим int8 квантованием
+
+Все бэкенды кодируют тексты батчами, отсортированными по длине в токенах,
+и ограничивают батч по числу токенов, чтобы не тратить время на паддинг.
+"""
+import fcntl
+import logging
+import os
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from typing import Callable, List
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+EMBEDDING_BACKEND = os.getenv('EMBEDDING_BACKEND', 'torch')
+# Число потоков для intra-op параллелизма (0 - значение по умолчанию библиотеки)
+EMBEDDING_THREADS = int(os.getenv('EMBEDDING_THREADS', 0))
+# Максимум токенов (длина * размер батча) в одном батче
+EMBEDDING_MAX_BATCH_TOKENS = int(os.getenv('EMBEDDING_MAX_BATCH_TOKENS', 16384))
+EMBEDDING_MAX_BATCH_SIZE = int(os.getenv('EMBEDDING_MAX_BATCH_SIZE', 256))
+ONNX_CACHE_DIR = os.getenv('EMBEDDING_ONNX_DIR', 'data/onnx')
+
+BACKENDS = ('torch', 'torch-quantized', 'onnx', 'onnx-int8')
+
+
+def length_sorted_batches(
+    lengths: List[int],
+    max_tokens: int = EMBEDDING_MAX_BATCH_TOKENS,
+    max_batch_size: int = EMBEDDING_MAX_BATCH_SIZE,
+) -> List[np.ndarray]:
+    """
+    Разбивает тексты на батчи по длине: короткие тексты идут большими батчами,
+    длинные - маленькими. Возвращает списки индексов исходных текстов.
+    """
+    order = np.argsort(lengths, kind='stable')
+    batches = []
+    start = 0
+    for end in range(1, len(order) + 1):
+        # Тексты отсортированы по возрастанию, паддинг батча = длина последнего
+        padded = lengths[order[end - 1]] * (end - start)
+        if end - start > 1 and (padded > max_tokens or end - start > max_batch_size):
+            batches.append(order[start:end - 1])
+            start = end - 1
+    if start < len(order):
+        batches.append(order[start:])
+    return batches
+
+
+class BaseEncoder(ABC):
+    """Общий интерфейс: encode(texts) -> np.ndarray [len(texts), dim]."""
+
+    name = 'base'
+
+    def token_lengths(self, texts: List[str]) -> List[int]:
+        encoded = self.tokenizer(texts, add_special_tokens=True, truncation=True,
+                                 max_length=self.max_seq_length)
+        return [len(ids) for ids in encoded['input_ids']]
+
+    @abstractmethod
+    def encode_batch(self, texts: List[str]) -> np.ndarray:
+        """Кодирует один батч (тексты близкой длины)."""
+
+    def encode(self, texts: List[str], show_progress_bar: bool = False, batch_size: int = None, **kwargs) -> np.ndarray:
+        """
+        Кодирует тексты с динамическими батчами.
+        ``batch_size`` оставлен для совместимости с SentenceTransformer.encode
+        и ограничивает размер батча сверху.
+        """
+        texts = list(texts)
+        if not texts:
+            return np.zeros((0, self.dim), dtype=np.float32)
+
+        lengths = self.token_lengths(texts)
+        max_batch_size = min(batch_size or EMBEDDING_MAX_BATCH_SIZE, EMBEDDING_MAX_BATCH_SIZE)
+        result = np.empty((len(texts), self.dim), dtype=np.float32)
+        for batch in length_sorted_batches(lengths, max_batch_size=max_batch_size):
+            result[batch] = self.encode_batch([texts[i] for i in batch])
+        return result
+
+    def get_sentence_embedding_dimension(self) -> int:
+        return self.dim
+
+
+class TorchEncoder(BaseEncoder):
+    """SentenceTransformer на PyTorch, опционально с int8 квантованием."""
+
+    def __init__(self, model_name: str, quantized: bool = False, threads: int = EMBEDDING_THREADS):
+        import torch
+        from sentence_transformers import SentenceTransformer
+
+        if threads:
+            torch.set_num_threads(threads)
+
+        self.model = SentenceTransformer(model_name, device='cpu')
+        if quantized:
+            self.model = torch.quantization.quantize_dynamic(self.model, {torch.nn.Linear}, dtype=torch.qint8)
+        self.name = 'torch-quantized' if quantized else 'torch'
+        self.tokenizer = self.model.tokenizer
+        self.max_seq_length = self.model.max_seq_length
+        self.dim = self.model.get_sentence_embedding_dimension()
+
+    def encode_batch(self, texts: List[str]) -> np.ndarray:
+        return self.model.encode(texts, batch_size=len(texts), show_progress_bar=False, convert_to_numpy=True)
+
+
+class OnnxEncoder(BaseEncoder):
+    """
+    Трансформер модели, экспортированный в ONNX Runtime. Пулинг и нормализация
+    повторяют модули SentenceTransformer, поэтому эмбеддинги совпадают с torch.
+    """
+
+    def __init__(self, model_name: str, quantized: bool = False, threads: int = EMBEDDING_THREADS):
+        import onnxruntime as ort
+
+        model_path, self.tokenizer, self.max_seq_length, self.pooling, self.normalize = \
+            export_onnx(model_name, quantized=quantized)
+
+        options = ort.SessionOptions()
+        if threads:
+            options.intra_op_num_threads = threads
+            options.inter_op_num_threads = 1
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = ort.InferenceSession(model_path, options, providers=['CPUExecutionProvider'])
+        self.input_names = {i.name for i in self.session.get_inputs()}
+        self.name = 'onnx-int8' if quantized else 'onnx'
+        self.dim = self.session.get_outputs()[0].shape[-1]
+
+    def encode_batch(self, texts: List[str]) -> np.ndarray:
+        inputs = self.tokenizer(texts, padding=True, truncation=True, max_length=self.max_seq_length,
+                                return_tensors='np')
+        feed = {name: inputs[name].astype(np.int64) for name in inputs if name in self.input_names}
+        token_embeddings = self.session.run(None, feed)[0]
+
+        if self.pooling == 'cls':
+            embeddings = token_embeddings[:, 0]
+        else:
+            mask = inputs['attention_mask'][..., None].astype(np.float32)
+            embeddings = (token_embeddings * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+
+        if self.normalize:
+            embeddings = embeddings / np.clip(np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-12, None)
+        return embeddings.astype(np.float32)
+
+
+@contextmanager
+def _file_lock(path: str):
+    """Межпроцессная блокировка: воркеры не экспортируют одну модель параллельно."""
+    with open(path, 'w') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def _write_once(path: str, write: Callable[[str], None]) -> None:
+    """Создаёт файл ``path`` через write(tmp_path) и os.replace, если его ещё нет."""
+    if os.path.exists(path):
+        return
+    with _file_lock(f"{path}.lock"):
+        # Пока ждали блокировку, файл мог записать другой воркер
+        if os.path.exists(path):
+            return
+        tmp_path = f"{path}.tmp-{os.getpid()}"
+        try:
+            write(tmp_path)
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+
+def export_onnx(model_name: str, quantized: bool = False):
+    """
+    Экспортирует трансформер SentenceTransformer в ONNX (один раз, с кешем на диске).
+
+    Returns:
+        (путь к .onnx, токенизатор, max_seq_length, режим пулинга, нужна ли нормализация)
+    """
+    import torch
+    from sentence_transformers import SentenceTransformer
+
+    st_model = SentenceTransformer(model_name, device='cpu')
+    transformer = st_model[0]
+    pooling = 'cls' if any(
+        getattr(module, 'pooling_mode_cls_token', False) for module in st_model
+    ) else 'mean'
+    normalize = any(type(module).__name__ == 'Normalize' for module in st_model)
+
+    model_dir = os.path.join(ONNX_CACHE_DIR, model_name.replace('/', '__'))
+    model_path = os.path.join(model_dir, 'model.onnx')
+    os.makedirs(model_dir, exist_ok=True)
+
+    def _export(path):
+        logger.info(f"Exporting {model_name} to ONNX: {model_path}")
+        dummy = transformer.tokenizer(['пример текста'], return_tensors='pt')
+        input_names = list(dummy.keys())
+        dynamic_axes = {name: {0: 'batch', 1: 'sequence'} for name in input_names}
+        dynamic_axes['token_embeddings'] = {0: 'batch', 1: 'sequence'}
+        auto_model = transformer.auto_model.eval()
+        with torch.no_grad():
+            torch.onnx.export(
+                auto_model,
+                tuple(dummy[name] for name in input_names),
+                path,
+                input_names=input_names,
+                output_names=['token_embeddings'],
+                dynamic_axes=dynamic_axes,
+                opset_version=14,
+            )
+
+    _write_once(model_path, _export)
+
+    if quantized:
+        quantized_path = os.path.join(model_dir, 'model.int8.onnx')
+
+        def _quantize(path):
+            from onnxruntime.quantization import QuantType, quantize_dynamic
+
+            logger.info(f"Quantizing ONNX model: {quantized_path}")
+            quantize_dynamic(model_path, path, weight_type=QuantType.QInt8)
+
+        _write_once(quantized_path, _quantize)
+        model_path = quantized_path
+
+    return model_path, transformer.tokenizer, st_model.max_seq_length, pooling, normalize
+
+
+def load_encoder(model_name: str, backend: str = EMBEDDING_BACKEND, threads: int = EMBEDDING_THREADS) -> BaseEncoder:
+    """Создаёт энкодер выбранного бэкенда."""
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown embedding backend '{backend}', use one of {BACKENDS}")
+
+    logger.info(f"Embedding backend: {backend}, threads: {threads or 'default'}")
+    if backend.startswith('onnx'):
+        return OnnxEncoder(model_name, quantized=backend == 'onnx-int8', threads=threads)
+    return TorchEncoder(model_name, quantized=backend == 'torch-quantized', threads=threads)
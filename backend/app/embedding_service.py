@@ -0,0 +1,288 @@
+"""
+Локальный сервис эмбеддингов.
+
+Один процесс держит модель и обслуживает все uvicorn воркеры через Unix
+сокет. Запросы от разных воркеров собираются в общий батч (окно
+микробатчинга), поэтому память не растёт с числом воркеров, а время
+ответа предсказуемо: модель прогревается при старте сервиса.
+
+Запуск:
+    python -m app.embedding_service           # сервис
+    python -m app.embedding_service --wait    # дождаться готовности (для start.sh)
+"""
+import argparse
+import logging
+import os
+import queue
+import secrets
+import threading
+import time
+from multiprocessing.connection import Client, Listener
+from typing import List
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Путь к сокету; если пусто - каждый воркер грузит модель сам
+SERVICE_SOCKET = os.getenv('EMBEDDING_SERVICE_SOCKET', '')
+# Ключ аутентификации клиентов; если не задан, сервис генерирует его при старте
+# и кладёт в файл с правами 0600 (по умолчанию <сокет>.key), воркеры читают оттуда
+SERVICE_AUTHKEY = os.getenv('EMBEDDING_SERVICE_AUTHKEY', '')
+SERVICE_AUTHKEY_FILE = os.getenv('EMBEDDING_SERVICE_AUTHKEY_FILE', '')
+# Сколько ждём остальные запросы после первого, прежде чем кодировать батч
+BATCH_WINDOW_MS = float(os.getenv('EMBEDDING_SERVICE_BATCH_WINDOW_MS', 5))
+# Максимум текстов в одном батче сервиса
+BATCH_MAX_TEXTS = int(os.getenv('EMBEDDING_SERVICE_BATCH_MAX', 256))
+# Крупные запросы клиент режет на части, чтобы не блокировать короткие
+CLIENT_CHUNK_SIZE = int(os.getenv('EMBEDDING_SERVICE_CHUNK', 512))
+CLIENT_TIMEOUT = float(os.getenv('EMBEDDING_SERVICE_TIMEOUT', 120))
+
+_WARMUP_TEXTS = ['Бумага офисная А4', 'Ручка шариковая синяя', 'Картридж для принтера']
+
+
+def _authkey_path(socket_path: str) -> str:
+    return SERVICE_AUTHKEY_FILE or f"{socket_path}.key"
+
+
+def create_authkey(socket_path: str) -> bytes:
+    """Ключ сервиса: из EMBEDDING_SERVICE_AUTHKEY или новый случайный в файле 0600."""
+    if SERVICE_AUTHKEY:
+        return SERVICE_AUTHKEY.encode()
+    key = secrets.token_hex(32)
+    path = _authkey_path(socket_path)
+    tmp_path = f"{path}.tmp-{os.getpid()}"
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, 'w') as f:
+        f.write(key)
+    os.replace(tmp_path, path)
+    return key.encode()
+
+
+def load_authkey(socket_path: str) -> bytes:
+    """Ключ для клиента; файл перечитывается при каждом подключении (сервис мог перезапуститься)."""
+    if SERVICE_AUTHKEY:
+        return SERVICE_AUTHKEY.encode()
+    with open(_authkey_path(socket_path)) as f:
+        return f.read().strip().encode()
+
+
+class _Request:
+    __slots__ = ('texts', 'conn', 'lock', 'request_id')
+
+    def __init__(self, texts, conn, lock, request_id):
+        self.texts = texts
+        self.conn = conn
+        self.lock = lock
+        self.request_id = request_id
+
+
+class EmbeddingService:
+    """Сервер: принимает запросы от воркеров и кодирует их общими батчами."""
+
+    def __init__(self, encoder, socket_path: str = SERVICE_SOCKET,
+                 window_ms: float = BATCH_WINDOW_MS, max_texts: int = BATCH_MAX_TEXTS):
+        self.encoder = encoder
+        self.socket_path = socket_path
+        self.window = window_ms / 1000.0
+        self.max_texts = max_texts
+        self.requests = queue.Queue()
+
+    def warm_up(self) -> None:
+        start = time.perf_counter()
+        self.encoder.encode(_WARMUP_TEXTS)
+        logger.info(f"Embedding service warmed up in {time.perf_counter() - start:.2f}s")
+
+    def serve_forever(self) -> None:
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+        authkey = create_authkey(self.socket_path)
+        listener = Listener(self.socket_path, family='AF_UNIX', authkey=authkey)
+        os.chmod(self.socket_path, 0o600)
+        threading.Thread(target=self._batch_loop, daemon=True).start()
+        logger.info(f"Embedding service listening on {self.socket_path}")
+        try:
+            while True:
+                try:
+                    conn = listener.accept()
+                except Exception as e:
+                    logger.warning(f"Rejected embedding client: {e}")
+                    continue
+                threading.Thread(target=self._client_loop, args=(conn,), daemon=True).start()
+        finally:
+            listener.close()
+
+    def _client_loop(self, conn) -> None:
+        lock = threading.Lock()
+        try:
+            while True:
+                message = conn.recv()
+                kind = message[0]
+                if kind == 'ping':
+                    with lock:
+                        conn.send(('ok', message[1], None))
+                elif kind == 'encode':
+                    _, request_id, texts = message
+                    self.requests.put(_Request(texts, conn, lock, request_id))
+        except (EOFError, OSError):
+            pass
+        finally:
+            conn.close()
+
+    def _collect_batch(self) -> List[_Request]:
+        batch = [self.requests.get()]
+        total = len(batch[0].texts)
+        deadline = time.monotonic() + self.window
+        while total < self.max_texts:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                request = self.requests.get(timeout=timeout)
+            except queue.Empty:
+                break
+            batch.append(request)
+            total += len(request.texts)
+        return batch
+
+    def _batch_loop(self) -> None:
+        while True:
+            batch = self._collect_batch()
+            texts = [text for request in batch for text in request.texts]
+            try:
+                embeddings = np.asarray(self.encoder.encode(texts), dtype=np.float32)
+                error = None
+            except Exception as e:
+                logger.error(f"Embedding batch failed: {e}")
+                embeddings, error = None, str(e)
+
+            offset = 0
+            for request in batch:
+                size = len(request.texts)
+                if error is None:
+                    reply = ('ok', request.request_id, embeddings[offset:offset + size])
+                else:
+                    reply = ('error', request.request_id, error)
+                offset += size
+                try:
+                    with request.lock:
+                        request.conn.send(reply)
+                except (EOFError, OSError):
+                    pass  # клиент отключился
+
+
+class RemoteEncoder:
+    """
+    Клиент сервиса с интерфейсом энкодера: encode(texts) -> np.ndarray.
+    Соединение открывается на поток, при обрыве соединения переподключаемся
+    один раз. Ошибки кодирования и таймауты не повторяются: повтор заново
+    кодировал бы весь батч.
+    """
+
+    name = 'remote'
+
+    def __init__(self, socket_path: str = SERVICE_SOCKET, timeout: float = CLIENT_TIMEOUT):
+        self.socket_path = socket_path
+        self.timeout = timeout
+        self._local = threading.local()
+        self._dim = None
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = Client(self.socket_path, family='AF_UNIX', authkey=load_authkey(self.socket_path))
+            self._local.conn = conn
+            self._local.next_id = 0
+        return conn
+
+    def _reset(self) -> None:
+        conn = getattr(self._local, 'conn', None)
+        self._local.conn = None
+        if conn is not None:
+            try:
+                conn.close()
+            except OSError:
+                pass
+
+    def _call(self, kind: str, payload=None):
+        for attempt in range(2):
+            try:
+                conn = self._connection()
+                self._local.next_id += 1
+                request_id = self._local.next_id
+                conn.send((kind, request_id) if kind == 'ping' else (kind, request_id, payload))
+                if not conn.poll(self.timeout):
+                    raise TimeoutError(f"Embedding service did not answer in {self.timeout}s")
+                status, reply_id, result = conn.recv()
+            except TimeoutError as e:
+                # Ответ может прийти позже и сбить очередь ответов - соединение не переиспользуем
+                self._reset()
+                raise RuntimeError(str(e)) from e
+            except (EOFError, OSError) as e:
+                self._reset()
+                if attempt:
+                    # Ошибки транспорта - RuntimeError, как и ошибки сервиса: пайплайн вернёт status=error
+                    raise RuntimeError(f"Embedding service unavailable: {e!r}") from e
+                continue
+            if reply_id != request_id:
+                self._reset()
+                raise RuntimeError("Embedding service reply out of order")
+            if status != 'ok':
+                raise RuntimeError(f"Embedding service error: {result}")
+            return result
+
+    def ping(self) -> bool:
+        try:
+            self._call('ping')
+            return True
+        except Exception:
+            return False
+
+    def encode(self, texts, show_progress_bar: bool = False, batch_size: int = None, **kwargs) -> np.ndarray:
+        texts = list(texts)
+        parts = [
+            self._call('encode', texts[start:start + CLIENT_CHUNK_SIZE])
+            for start in range(0, len(texts), CLIENT_CHUNK_SIZE)
+        ]
+        if not parts:
+            return np.zeros((0, self.get_sentence_embedding_dimension()), dtype=np.float32)
+        return np.concatenate(parts)
+
+    def get_sentence_embedding_dimension(self) -> int:
+        if self._dim is None:
+            self._dim = self._call('encode', _WARMUP_TEXTS[:1]).shape[1]
+        return self._dim
+
+
+def wait_until_ready(socket_path: str = SERVICE_SOCKET, timeout: float = 600) -> bool:
+    """Ждёт, пока сервис начнёт отвечать (модель загружена и прогрета)."""
+    client = RemoteEncoder(socket_path, timeout=5)
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if os.path.exists(socket_path) and client.ping():
+            return True
+        time.sleep(0.5)
+    return False
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Local embedding service')
+    parser.add_argument('--socket', default=SERVICE_SOCKET or '/tmp/embeddings.sock')
+    parser.add_argument('--wait', action='store_true', help='Только дождаться готовности сервиса')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(name)s %(levelname)s %(message)s')
+
+    if args.wait:
+        raise SystemExit(0 if wait_until_ready(args.socket) else 1)
+
+    from . import embedding_backend
+    from .ml_insert import MODEL_NAME
+
+    service = EmbeddingService(embedding_backend.load_encoder(MODEL_NAME), args.socket)
+    service.warm_up()
+    service.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
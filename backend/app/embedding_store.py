@@ -0,0 +1,432 @@
+"""
+Компактное хранилище эмбеддингов STE.
+
+Векторы хранятся на диске в .npy файлах и открываются через memory mapping,
+поэтому все uvicorn воркеры делят одну копию в page cache ОС.
+Поддерживаются float32, float16 и int8 (скалярное квантование с масштабом
+на вектор), а также опциональное снижение размерности через PCA.
+
+Рядом с вектором хранится хеш закодированного текста (названия STE): после
+переименования STE хеш не совпадает, и вектор кодируется заново. У хранилищ
+без хешей (старый формат) все векторы считаются устаревшими.
+"""
+import fcntl
+import glob
+import hashlib
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, List, Optional
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+STORE_PATH = os.getenv('EMBEDDING_STORE_PATH', 'data/embeddings')
+# float32 | float16 | int8
+STORE_DTYPE = os.getenv('EMBEDDING_STORE_DTYPE', 'float16')
+# Размерность после PCA (0 - без снижения размерности)
+STORE_DIM = int(os.getenv('EMBEDDING_STORE_DIM', 0))
+
+SUPPORTED_DTYPES = ('float32', 'float16', 'int8')
+
+# Сколько векторов берём для обучения PCA
+_PCA_SAMPLE_SIZE = 20000
+# Меньше векторов - PCA не обучаем, хранилище строится без снижения размерности
+_PCA_MIN_SAMPLES = 5000
+
+
+def text_hashes(texts: List[str]) -> np.ndarray:
+    """64-битные хеши текстов (0 зарезервирован под «хеш неизвестен»)."""
+    hashes = np.fromiter(
+        (int.from_bytes(hashlib.blake2b(text.encode('utf-8'), digest_size=8).digest(), 'little') for text in texts),
+        dtype=np.uint64, count=len(texts),
+    )
+    hashes[hashes == 0] = 1
+    return hashes
+
+
+def _normalize(x: np.ndarray) -> np.ndarray:
+    x = np.asarray(x, dtype=np.float32)
+    norms = np.linalg.norm(x, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return x / norms
+
+
+def fit_pca(embeddings: np.ndarray, dim: int, seed: int = 0) -> Dict[str, np.ndarray]:
+    """Обучает PCA-проекцию на подвыборке эмбеддингов."""
+    x = _normalize(embeddings)
+    if len(x) > _PCA_SAMPLE_SIZE:
+        rng = np.random.default_rng(seed)
+        x = x[rng.choice(len(x), _PCA_SAMPLE_SIZE, replace=False)]
+    mean = x.mean(axis=0)
+    _, _, vt = np.linalg.svd(x - mean, full_matrices=False)
+    return {'mean': mean.astype(np.float32), 'components': vt[:dim].astype(np.float32)}
+
+
+def quantize(x: np.ndarray, dtype: str):
+    """
+    Квантует нормированные векторы.
+
+    Returns:
+        (векторы в dtype, масштабы для int8 или None)
+    """
+    if dtype == 'float32':
+        return x.astype(np.float32), None
+    if dtype == 'float16':
+        return x.astype(np.float16), None
+    if dtype == 'int8':
+        scales = np.abs(x).max(axis=1) / 127.0
+        scales[scales == 0] = 1.0
+        q = np.round(x / scales[:, None]).clip(-127, 127).astype(np.int8)
+        return q, scales.astype(np.float32)
+    raise ValueError(f"Unsupported embedding dtype '{dtype}', use one of {SUPPORTED_DTYPES}")
+
+
+class EmbeddingStore:
+    """Набор эмбеддингов, индексированный по id STE."""
+
+    def __init__(
+        self,
+        ids: np.ndarray,
+        vectors: np.ndarray,
+        scales: Optional[np.ndarray] = None,
+        mean: Optional[np.ndarray] = None,
+        components: Optional[np.ndarray] = None,
+        source_dim: Optional[int] = None,
+        hashes: Optional[np.ndarray] = None,
+    ):
+        self.ids = ids
+        self.vectors = vectors
+        self.scales = scales
+        # Хеши закодированных текстов (None - хранилище старого формата)
+        self.hashes = hashes
+        self.mean = mean
+        self.components = components
+        self.source_dim = source_dim or (components.shape[1] if components is not None else vectors.shape[1])
+        self._positions = None
+
+    @property
+    def dtype(self) -> str:
+        return self.vectors.dtype.name
+
+    @property
+    def dim(self) -> int:
+        return self.vectors.shape[1]
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    @property
+    def nbytes(self) -> int:
+        total = self.vectors.nbytes + self.ids.nbytes
+        if self.scales is not None:
+            total += self.scales.nbytes
+        return total
+
+    @classmethod
+    def build(cls, ids, embeddings: np.ndarray, dtype: str = STORE_DTYPE, dim: int = STORE_DIM,
+              hashes: Optional[np.ndarray] = None) -> 'EmbeddingStore':
+        """Строит хранилище из float32 эмбеддингов модели."""
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+        mean = components = None
+        if dim and dim < embeddings.shape[1]:
+            pca = fit_pca(embeddings, dim)
+            mean, components = pca['mean'], pca['components']
+        store = cls(np.asarray(ids, dtype=np.int64), np.empty((0, 0), dtype=np.float32),
+                    mean=mean, components=components, source_dim=embeddings.shape[1],
+                    hashes=_hashes_or_unknown(hashes, len(embeddings)))
+        store.vectors, store.scales = quantize(store.project(embeddings), dtype)
+        return store
+
+    def project(self, embeddings: np.ndarray) -> np.ndarray:
+        """Переводит эмбеддинги модели в пространство хранилища (нормированные float32)."""
+        x = _normalize(embeddings)
+        if self.components is not None:
+            x = _normalize((x - self.mean) @ self.components.T)
+        return x
+
+    def upsert(self, ids, embeddings: np.ndarray, hashes: Optional[np.ndarray] = None) -> 'EmbeddingStore':
+        """
+        Возвращает новое хранилище, где векторы для ``ids`` заменены/добавлены.
+        Существующие строки не переквантуются, проекция PCA сохраняется.
+        """
+        ids = np.asarray(ids, dtype=np.int64)
+        new_vectors, new_scales = quantize(self.project(embeddings), self.dtype)
+        keep = ~np.isin(self.ids, ids)
+        scales = None
+        if self.scales is not None:
+            scales = np.concatenate([self.scales[keep], new_scales])
+        kept_hashes = self.hashes[keep] if self.hashes is not None else np.zeros(int(keep.sum()), dtype=np.uint64)
+        return EmbeddingStore(
+            np.concatenate([self.ids[keep], ids]),
+            np.concatenate([self.vectors[keep], new_vectors]),
+            scales=scales,
+            mean=self.mean,
+            components=self.components,
+            source_dim=self.source_dim,
+            hashes=np.concatenate([kept_hashes, _hashes_or_unknown(hashes, len(ids))]),
+        )
+
+    def dequantize(self, rows=slice(None)) -> np.ndarray:
+        """Возвращает векторы (по позициям) в float32."""
+        x = np.asarray(self.vectors[rows], dtype=np.float32)
+        if self.scales is not None:
+            x = x * self.scales[rows][:, None]
+        return x
+
+    def positions(self, ids) -> np.ndarray:
+        """Позиции строк для id STE (-1 для отсутствующих)."""
+        if self._positions is None:
+            self._positions = {int(ste_id): pos for pos, ste_id in enumerate(self.ids)}
+        return np.array([self._positions.get(int(i), -1) for i in ids], dtype=np.int64)
+
+    def hashes_at(self, positions: np.ndarray) -> np.ndarray:
+        """Хеши текстов по позициям строк (0 - неизвестен)."""
+        if self.hashes is None:
+            return np.zeros(len(positions), dtype=np.uint64)
+        return np.asarray(self.hashes[positions])
+
+    def get(self, ids) -> np.ndarray:
+        """float32 векторы для id STE (нули для отсутствующих)."""
+        pos = self.positions(ids)
+        result = np.zeros((len(pos), self.dim), dtype=np.float32)
+        found = pos >= 0
+        if found.any():
+            result[found] = self.dequantize(pos[found])
+        return result
+
+    def scores(self, queries: np.ndarray, block_size: int = 65536) -> np.ndarray:
+        """Косинусная близость запросов (в пространстве хранилища) ко всем векторам."""
+        queries = np.asarray(queries, dtype=np.float32)
+        result = np.empty((len(queries), len(self.ids)), dtype=np.float32)
+        for start in range(0, len(self.ids), block_size):
+            end = start + block_size
+            result[:, start:end] = queries @ self.dequantize(slice(start, end)).T
+        return result
+
+    def save(self, path: str = STORE_PATH) -> None:
+        """
+        Атомарно сохраняет хранилище: пишет новую версию каталога
+        (``<path>.v<время>``) и подменяет симлинк ``path`` через os.replace,
+        так что читатели всегда видят целую версию.
+        """
+        version_path = f"{path}.v{time.time_ns()}-{os.getpid()}"
+        os.makedirs(version_path)
+        np.save(os.path.join(version_path, 'ids.npy'), self.ids)
+        np.save(os.path.join(version_path, 'vectors.npy'), np.ascontiguousarray(self.vectors))
+        if self.scales is not None:
+            np.save(os.path.join(version_path, 'scales.npy'), self.scales)
+        if self.hashes is not None:
+            np.save(os.path.join(version_path, 'hashes.npy'), self.hashes)
+        if self.components is not None:
+            np.save(os.path.join(version_path, 'mean.npy'), self.mean)
+            np.save(os.path.join(version_path, 'components.npy'), self.components)
+        with open(os.path.join(version_path, 'meta.json'), 'w') as f:
+            json.dump({
+                'dtype': self.dtype,
+                'dim': self.dim,
+                'source_dim': self.source_dim,
+                'count': len(self),
+                'saved_at': time.time(),
+            }, f)
+
+        if os.path.isdir(path) and not os.path.islink(path):
+            # Хранилище старого формата (обычный каталог): один раз переводим в версию
+            os.rename(path, f"{path}.v0-legacy")
+        link_path = f"{path}.link-{os.getpid()}"
+        if os.path.lexists(link_path):
+            os.remove(link_path)
+        os.symlink(os.path.basename(version_path), link_path)
+        os.replace(link_path, path)
+
+        # Уже открытые mmap продолжают работать с удалёнными файлами до перезагрузки
+        for stale in glob.glob(f"{glob.escape(path)}.v*"):
+            if stale != version_path:
+                shutil.rmtree(stale, ignore_errors=True)
+
+    @classmethod
+    def load(cls, path: str = STORE_PATH, mmap: bool = True) -> 'EmbeddingStore':
+        """Открывает хранилище; при mmap=True векторы не копируются в память процесса."""
+        mode = 'r' if mmap else None
+
+        def _load(name):
+            file_path = os.path.join(path, name)
+            return np.load(file_path, mmap_mode=mode) if os.path.exists(file_path) else None
+
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+        components = _load('components.npy')
+        return cls(
+            np.load(os.path.join(path, 'ids.npy')),
+            _load('vectors.npy'),
+            scales=_load('scales.npy'),
+            mean=_load('mean.npy') if components is not None else None,
+            components=components,
+            source_dim=meta.get('source_dim'),
+            hashes=_load('hashes.npy'),
+        )
+
+
+def _hashes_or_unknown(hashes: Optional[np.ndarray], count: int) -> np.ndarray:
+    if hashes is None:
+        return np.zeros(count, dtype=np.uint64)
+    return np.asarray(hashes, dtype=np.uint64)
+
+
+# Кеш открытого хранилища на процесс (перечитывается при изменении файлов)
+_store_cache = None
+_store_mtime = None
+_store_lock = threading.Lock()
+
+
+def get_store(path: str = STORE_PATH) -> Optional[EmbeddingStore]:
+    """Хранилище эмбеддингов текущего процесса или None, если оно ещё не построено."""
+    global _store_cache, _store_mtime
+
+    # Параллельный save() может переключить симлинк и удалить прочитанную версию
+    # между realpath и загрузкой - тогда перечитываем симлинк ещё раз
+    for attempt in range(2):
+        # Версия каталога (цель симлинка) + mtime: новая версия видна сразу после save
+        real_path = os.path.realpath(path)
+        try:
+            version = (real_path, os.path.getmtime(os.path.join(real_path, 'meta.json')))
+        except OSError:
+            if attempt == 0 and os.path.lexists(path):
+                continue
+            return None
+
+        with _store_lock:
+            if _store_cache is not None and version == _store_mtime:
+                return _store_cache
+            try:
+                store = EmbeddingStore.load(real_path)
+            except OSError as e:
+                if attempt == 0:
+                    continue
+                logger.warning(f"Embedding store {real_path} could not be loaded: {e}")
+                return _store_cache
+            _store_cache, _store_mtime = store, version
+            logger.info(f"Embedding store loaded: {len(store)} vectors, {store.dtype}x{store.dim}")
+            return store
+    return _store_cache
+
+
+@contextmanager
+def _write_lock(path: str):
+    """Межпроцессная блокировка записи хранилища (воркеры обновляют его параллельно)."""
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(f"{path}.lock", 'w') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def save_embeddings(ids, embeddings: np.ndarray, path: str = STORE_PATH,
+                    hashes: Optional[np.ndarray] = None) -> Optional[EmbeddingStore]:
+    """
+    Сохраняет эмбеддинги после прогона пайплайна.
+
+    Если хранилище уже есть, обновляются только переданные id в его текущем
+    формате. Смена EMBEDDING_STORE_DTYPE / EMBEDDING_STORE_DIM или модели
+    применяется только при полном перекодировании (переданы все id
+    хранилища): перестройка по частичному батчу потеряла бы остальные векторы.
+    ``hashes`` - text_hashes закодированных текстов (без них векторы
+    считаются устаревшими и при следующем чтении кодируются заново).
+
+    Returns:
+        Сохранённое хранилище или None, если запись отклонена.
+    """
+    ids = np.asarray(ids, dtype=np.int64)
+    with _write_lock(path):
+        existing = get_store(path)
+        full = existing is None or bool(np.isin(existing.ids, ids).all())
+        target_dim = STORE_DIM if 0 < STORE_DIM < embeddings.shape[1] else embeddings.shape[1]
+        settings_match = (
+            existing is not None
+            and existing.source_dim == embeddings.shape[1]
+            and existing.dtype == STORE_DTYPE
+            and existing.dim == target_dim
+        )
+
+        if settings_match or (not full and existing.source_dim == embeddings.shape[1]):
+            if not settings_match:
+                logger.warning(
+                    f"Embedding store is {existing.dtype}x{existing.dim}, settings ask for "
+                    f"{STORE_DTYPE}x{target_dim}: keeping the current format until a full re-encode"
+                )
+            store = existing.upsert(ids, embeddings, hashes)
+        elif full:
+            dim = STORE_DIM
+            if 0 < dim < embeddings.shape[1] and len(embeddings) < max(_PCA_MIN_SAMPLES, dim):
+                logger.warning(
+                    f"Only {len(embeddings)} vectors, PCA to {dim} needs {max(_PCA_MIN_SAMPLES, dim)}: "
+                    f"storing without dimensionality reduction"
+                )
+                dim = 0
+            if existing is not None:
+                logger.info(f"Embedding store rebuilt from a full re-encode of {len(ids)} STE")
+            store = EmbeddingStore.build(ids, embeddings, dim=dim, hashes=hashes)
+        else:
+            logger.warning(
+                f"Embedding model dim {embeddings.shape[1]} does not match the store "
+                f"({existing.source_dim}): {len(ids)} vectors not saved, run a full reaggregation to rebuild"
+            )
+            return None
+        store.save(path)
+        return store
+
+
+def quality_report(
+    embeddings: np.ndarray,
+    configs: Optional[List[tuple]] = None,
+    k: int = 10,
+    n_queries: int = 500,
+    seed: int = 0,
+) -> List[dict]:
+    """
+    Сравнивает варианты хранения с float32 по качеству поиска соседей.
+
+    Args:
+        embeddings: float32 эмбеддинги модели
+        configs: список пар (dtype, dim); dim=0 - без PCA
+        k: размер top-k для recall
+        n_queries: сколько векторов используем как запросы
+
+    Returns:
+        Список словарей: dtype, dim, bytes_per_vector, recall@k, mean_abs_error
+    """
+    if configs is None:
+        configs = [(dtype, 0) for dtype in SUPPORTED_DTYPES] + [('int8', 128), ('float16', 128)]
+
+    reference = _normalize(embeddings)
+    rng = np.random.default_rng(seed)
+    query_pos = rng.choice(len(reference), min(n_queries, len(reference)), replace=False)
+    exact = reference[query_pos] @ reference.T
+    exact[np.arange(len(query_pos)), query_pos] = -np.inf
+    k = min(k, len(reference) - 1)
+    exact_top = np.argpartition(-exact, k, axis=1)[:, :k]
+
+    report = []
+    for dtype, dim in configs:
+        store = EmbeddingStore.build(np.arange(len(reference)), reference, dtype=dtype, dim=dim)
+        approx = store.scores(store.dequantize(query_pos))
+        approx[np.arange(len(query_pos)), query_pos] = -np.inf
+        approx_top = np.argpartition(-approx, k, axis=1)[:, :k]
+
+        hits = sum(len(np.intersect1d(a, b)) for a, b in zip(exact_top, approx_top))
+        finite = np.isfinite(exact)
+        report.append({
+            'dtype': dtype,
+            'dim': store.dim,
+            'bytes_per_vector': store.nbytes / len(store),
+            f'recall@{k}': hits / (k * len(query_pos)),
+            'mean_abs_error': float(np.abs(approx[finite] - exact[finite]).mean()),
+        })
+    return report
@@ -0,0 +1,190 @@
+"""
+Потоковая выгрузка оценок и распределения STE по карточкам.
+
+Строки читаются серверным курсором порциями EXPORT_CHUNK_SIZE и сразу
+отдаются клиенту (NDJSON, CSV или Parquet по row group на порцию), так
+что память не зависит от размера таблицы. Инкрементальные выгрузки:
+after_id - keyset по первичному ключу, since - по времени изменения.
+"""
+import csv
+import io
+import json
+import os
+from datetime import datetime
+from typing import Iterator, List, Optional
+
+from fastapi import HTTPException
+from fastapi.responses import StreamingResponse
+from sqlalchemy import select
+
+from . import database, models
+
+EXPORT_CHUNK_SIZE = int(os.getenv("EXPORT_CHUNK_SIZE", 5000))
+
+FORMATS = {
+    "ndjson": ("application/x-ndjson", "ndjson"),
+    "csv": ("text/csv; charset=utf-8", "csv"),
+    "parquet": ("application/vnd.apache.parquet", "parquet"),
+}
+
+
+def feedback_query(since: Optional[datetime] = None, after_id: Optional[int] = None, limit: Optional[int] = None):
+    columns = [
+        models.Feedback.id, models.Feedback.card_id, models.Feedback.ste_id,
+        models.Feedback.user_id, models.Feedback.score, models.Feedback.created_at,
+        models.Feedback.updated_at,
+    ]
+    query = select(*columns).order_by(models.Feedback.id)
+    if since is not None:
+        # Повторный голос обновляет строку на месте: фильтр по времени изменения
+        query = query.where(models.Feedback.updated_at >= since)
+    if after_id is not None:
+        query = query.where(models.Feedback.id > after_id)
+    return query.limit(limit) if limit else query
+
+
+def assignments_query(since: Optional[datetime] = None, after_id: Optional[int] = None, limit: Optional[int] = None):
+    columns = [
+        models.STE.id.label("ste_id"), models.STE.external_id, models.STE.card_id,
+        models.STE.version, models.STE.updated_at,
+    ]
+    query = select(*columns).order_by(models.STE.id)
+    if since is None and after_id is None:
+        query = query.where(models.STE.card_id.isnot(None))
+    # В инкрементальной выгрузке нужны и отвязанные STE (card_id = null),
+    # иначе потребитель не узнает, что STE ушла из карточки
+    if since is not None:
+        query = query.where(models.STE.updated_at >= since)
+    if after_id is not None:
+        query = query.where(models.STE.id > after_id)
+    return query.limit(limit) if limit else query
+
+
+def _iter_chunks(query) -> Iterator[List[tuple]]:
+    """Порции строк через серверный курсор; сессия живёт, пока идёт ответ."""
+    db = database.ReadSessionLocal()
+    try:
+        result = db.execute(query.execution_options(stream_results=True, yield_per=EXPORT_CHUNK_SIZE))
+        for partition in result.partitions():
+            yield partition
+    finally:
+        db.close()
+
+
+def _json_value(value):
+    return value.isoformat() if isinstance(value, datetime) else value
+
+
+def _ndjson(columns: List[str], chunks) -> Iterator[bytes]:
+    for chunk in chunks:
+        lines = [
+            json.dumps({c: _json_value(v) for c, v in zip(columns, row)}, ensure_ascii=False)
+            for row in chunk
+        ]
+        yield ("\n".join(lines) + "\n").encode("utf-8")
+
+
+def _csv(columns: List[str], chunks) -> Iterator[bytes]:
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(columns)
+    for chunk in chunks:
+        writer.writerows([[_json_value(v) for v in row] for row in chunk])
+        yield buffer.getvalue().encode("utf-8")
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode("utf-8")
+
+
+class _StreamSink:
+    """Файлоподобный приёмник для pyarrow: копит байты до следующей отдачи клиенту."""
+
+    def __init__(self):
+        self._parts = []
+        self._position = 0
+        self.closed = False
+
+    def write(self, data) -> int:
+        data = bytes(data)
+        self._parts.append(data)
+        self._position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self._position
+
+    def flush(self) -> None:
+        pass
+
+    def writable(self) -> bool:
+        return True
+
+    def close(self) -> None:
+        self.closed = True
+
+    def drain(self) -> bytes:
+        data = b"".join(self._parts)
+        self._parts = []
+        return data
+
+
+def _parquet(columns: List[str], chunks, schema) -> Iterator[bytes]:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    sink = _StreamSink()
+    writer = pq.ParquetWriter(sink, schema)
+    try:
+        for chunk in chunks:
+            table = pa.Table.from_pylist([dict(zip(columns, row)) for row in chunk], schema=schema)
+            writer.write_table(table)
+            data = sink.drain()
+            if data:
+                yield data
+    finally:
+        writer.close()
+    yield sink.drain()
+
+
+def _arrow_schema(query):
+    import pyarrow as pa
+
+    types = []
+    for column in query.selected_columns:
+        python_type = column.type.python_type
+        if python_type is datetime:
+            arrow_type = pa.timestamp("us", tz="UTC")
+        elif python_type is int:
+            arrow_type = pa.int64()
+        elif python_type is float:
+            arrow_type = pa.float64()
+        else:
+            arrow_type = pa.string()
+        types.append(pa.field(column.name, arrow_type))
+    return pa.schema(types)
+
+
+def stream_export(query, name: str, fmt: str) -> StreamingResponse:
+    """Ответ с выгрузкой запроса в формате fmt (ndjson / csv / parquet)."""
+    if fmt not in FORMATS:
+        raise HTTPException(status_code=400, detail=f"format must be one of: {', '.join(FORMATS)}")
+    media_type, extension = FORMATS[fmt]
+    columns = [column.name for column in query.selected_columns]
+
+    if fmt == "parquet":
+        try:
+            schema = _arrow_schema(query)
+        except ImportError:
+            raise HTTPException(status_code=400, detail="Parquet export requires pyarrow")
+        body = _parquet(columns, _iter_chunks(query), schema)
+    elif fmt == "csv":
+        body = _csv(columns, _iter_chunks(query))
+    else:
+        body = _ndjson(columns, _iter_chunks(query))
+
+    return StreamingResponse(
+        body,
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="{name}.{extension}"'},
+    )
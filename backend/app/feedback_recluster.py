@@ -0,0 +1,183 @@
+"""
+Точечная переагрегация спорных карточек по фидбеку.
+
+Берём карточки, где доля отрицательных оценок (score=0) выше порога,
+и перекластеризуем только их STE. Оценки работают как ограничения:
+- must-link: STE, подтверждённые в одной карточке (score=1), остаются вместе;
+- cannot-link: отклонённый STE не попадает в кластер к подтверждённым STE
+  своей бывшей карточки.
+
+После прогона карточкам ставится reclustered_at: спорность дальше считается
+только по оценкам, поставленным или изменённым позже, иначе те же карточки выбирались бы
+при каждом запуске.
+"""
+import logging
+import os
+import time
+from typing import Dict, List, Optional, Set, Tuple
+
+import hdbscan
+import numpy as np
+import pandas as pd
+from sqlalchemy import func, or_, update
+from sqlalchemy.orm import Session
+
+from . import metrics, ml_insert, models, representation
+
+logger = logging.getLogger(__name__)
+
+# Доля отрицательных оценок, начиная с которой карточка считается спорной
+DISPUTE_THRESHOLD = float(os.getenv('FEEDBACK_DISPUTE_THRESHOLD', 0.3))
+# Минимальное число оценок, чтобы доверять доле
+DISPUTE_MIN_VOTES = int(os.getenv('FEEDBACK_DISPUTE_MIN_VOTES', 2))
+
+
+def get_disputed_cards(db: Session, threshold: float = DISPUTE_THRESHOLD, min_votes: int = DISPUTE_MIN_VOTES) -> List[int]:
+    """Карточки, у которых доля оценок score=0 (после их последней переагрегации) не меньше порога."""
+    total = func.count(models.Feedback.id)
+    negative = func.sum(1 - models.Feedback.score)
+    rows = (
+        db.query(models.Feedback.card_id)
+        .join(models.Card, models.Card.id == models.Feedback.card_id)
+        .filter(or_(models.Card.reclustered_at.is_(None), models.Feedback.updated_at > models.Card.reclustered_at))
+        .group_by(models.Feedback.card_id)
+        .having(total >= min_votes)
+        .having(negative >= threshold * total)
+        .all()
+    )
+    return [row.card_id for row in rows]
+
+
+def get_feedback_constraints(db: Session, card_ids: List[int]) -> Tuple[List[Set[int]], List[Tuple[int, int]]]:
+    """
+    Строит ограничения из оценок по парам (карточка, STE).
+    Для пары берётся большинство голосов.
+
+    Returns:
+        (группы must-link, пары cannot-link) в id STE
+    """
+    rows = (
+        db.query(models.Feedback.card_id, models.Feedback.ste_id, func.avg(models.Feedback.score))
+        .filter(models.Feedback.card_id.in_(card_ids))
+        .group_by(models.Feedback.card_id, models.Feedback.ste_id)
+        .all()
+    )
+    positive: Dict[int, Set[int]] = {}
+    negative: Dict[int, Set[int]] = {}
+    for card_id, ste_id, avg_score in rows:
+        target = positive if float(avg_score) >= 0.5 else negative
+        target.setdefault(card_id, set()).add(ste_id)
+
+    must_link = [stes for stes in positive.values() if len(stes) > 1]
+    cannot_link = [
+        (bad, good)
+        for card_id, bad_stes in negative.items()
+        for bad in bad_stes
+        for good in positive.get(card_id, ())
+    ]
+    return must_link, cannot_link
+
+
+def run_constrained_clustering(
+    left_df: pd.DataFrame,
+    must_link: List[Set[int]],
+    cannot_link: List[Tuple[int, int]],
+    timer: Optional[metrics.StageTimer] = None,
+) -> pd.DataFrame:
+    """HDBSCAN на матрице расстояний, исправленной ограничениями из фидбека."""
+    timer = timer or metrics.StageTimer('disputed')
+    with timer.stage('encode'):
+        embeddings = representation.build_representations(left_df, ml_insert.get_or_encode_embeddings(left_df))
+    start = time.perf_counter()
+    norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    embeddings = embeddings / norms
+
+    distances = np.clip(1.0 - embeddings @ embeddings.T, 0.0, 2.0).astype(np.float64)
+    np.fill_diagonal(distances, 0.0)
+
+    position = {int(ste_id): pos for pos, ste_id in enumerate(left_df['id'])}
+    for group in must_link:
+        members = [position[ste_id] for ste_id in group if ste_id in position]
+        distances[np.ix_(members, members)] = 0.0
+    for bad, good in cannot_link:
+        if bad in position and good in position:
+            distances[position[bad], position[good]] = distances[position[good], position[bad]] = 2.0
+
+    if len(left_df) < 2:
+        labels = np.full(len(left_df), -1)
+    else:
+        # Подмножество маленькое, поэтому разрешаем один общий кластер
+        labels = hdbscan.HDBSCAN(
+            min_cluster_size=2, min_samples=1, metric='precomputed', allow_single_cluster=True
+        ).fit_predict(distances)
+
+    # Подтверждённая группа, целиком ушедшая в шум, становится отдельным кластером
+    next_label = labels.max() + 1 if len(labels) else 0
+    for group in must_link:
+        members = [position[ste_id] for ste_id in group if ste_id in position]
+        if len(members) > 1 and (labels[members] < 0).all():
+            labels[members] = next_label
+            next_label += 1
+
+    # Плотность может всё равно склеить пару cannot-link - такой STE уходит в шум
+    for bad, good in cannot_link:
+        if bad in position and good in position:
+            if labels[position[bad]] >= 0 and labels[position[bad]] == labels[position[good]]:
+                labels[position[bad]] = -1
+
+    timer.add('cluster', time.perf_counter() - start)
+    df = left_df[['id', 'title']].copy()
+    df['cluster_id'] = labels
+    return df
+
+
+def mark_reclustered(db: Session, card_ids: List[int]) -> None:
+    """Отмечает карточки переагрегированными (без commit)."""
+    db.execute(
+        update(models.Card)
+        .where(models.Card.id.in_(card_ids))
+        .values(reclustered_at=func.now())
+        .execution_options(synchronize_session=False)
+    )
+
+
+def run_feedback_pipeline(
+    db: Session,
+    threshold: Optional[float] = None,
+    min_votes: Optional[int] = None,
+) -> dict:
+    """Переагрегация STE из спорных карточек с учётом фидбека (по умолчанию - пороги из env)."""
+    threshold = DISPUTE_THRESHOLD if threshold is None else threshold
+    min_votes = DISPUTE_MIN_VOTES if min_votes is None else min_votes
+    card_ids = get_disputed_cards(db, threshold, min_votes)
+    if not card_ids:
+        return {"status": "no_data", "total": 0, "updated": 0, "disputed_cards": 0}
+
+    timer = metrics.StageTimer('disputed')
+    with timer.stage('load'):
+        ste_ids = [row.id for row in db.query(models.STE.id).filter(models.STE.card_id.in_(card_ids))]
+        # Пустой список загрузчику не передаём: карточки без STE - нечего переагрегировать
+        left_df = ml_insert.get_all_stes_from_db(db, ste_ids) if ste_ids else None
+    if left_df is None or left_df.empty:
+        mark_reclustered(db, card_ids)
+        db.commit()
+        return {"status": "no_data", "total": 0, "updated": 0, "disputed_cards": len(card_ids)}
+
+    must_link, cannot_link = get_feedback_constraints(db, card_ids)
+    logger.info(
+        f"Feedback reaggregation: {len(card_ids)} disputed cards, {len(left_df)} STE, "
+        f"{len(must_link)} must-link groups, {len(cannot_link)} cannot-link pairs"
+    )
+
+    try:
+        right_df = run_constrained_clustering(left_df, must_link, cannot_link, timer)
+    except RuntimeError as e:
+        logger.error(f"Feedback clustering failed: {e}")
+        return {"status": "error", "total": len(left_df), "updated": 0, "error": str(e)}
+
+    # Фиксируется тем же commit, что и новые card_id
+    mark_reclustered(db, card_ids)
+    result = ml_insert.apply_clusters(db, left_df, right_df, ste_ids, timer)
+    result["disputed_cards"] = len(card_ids)
+    return result
@@ -2,10 +2,24 @@
 Fuzzy search utilities для нечёткого поиска.
 Использует rapidfuzz для быстрого fuzzy matching.
 """
+import asyncio
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from typing import List, Optional, Tuple
 
 from rapidfuzz import fuzz, process
 
+from . import metrics
+
+# Сколько fuzzy-запросов считаются одновременно (остальные ждут в очереди,
+# не занимая event loop и общий threadpool FastAPI)
+FUZZY_EXECUTOR_WORKERS = int(os.getenv('FUZZY_EXECUTOR_WORKERS', 2))
+
+_executor = None
+_executor_lock = threading.Lock()
+
 
 def fuzzy_match(query: str, candidates: List[str], threshold: int = 60, limit: int = 100) -> List[Tuple[str, int, int]]:
     """
@@ -54,6 +68,7 @@ def get_fuzzy_matches_for_ste(
     if not query or not ste_data:
         return []
     
+    start = time.perf_counter()
     # Создаём комбинированные строки для поиска
     search_strings = []
     id_map = {}
@@ -77,9 +92,48 @@ def get_fuzzy_matches_for_ste(
     for match, score, index in matches:
         result_ids.append(id_map[index])
     
+    metrics.observe_fuzzy(len(search_strings), len(result_ids), time.perf_counter() - start)
     return result_ids
 
 
+def get_executor() -> ThreadPoolExecutor:
+    """Ограниченный пул для CPU-тяжёлого скоринга (создаётся лениво в каждом воркере)."""
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(max_workers=FUZZY_EXECUTOR_WORKERS, thread_name_prefix='fuzzy')
+    return _executor
+
+
+def rows_to_ste_data(rows) -> List[dict]:
+    """Строки select(id, name, model_name, manufacturer) -> словари для get_fuzzy_matches_for_ste."""
+    return [
+        {'id': row.id, 'name': row.name, 'model_name': row.model_name, 'manufacturer': row.manufacturer}
+        for row in rows
+    ]
+
+
+def _match_rows(query: str, rows, threshold: int) -> List[int]:
+    return get_fuzzy_matches_for_ste(query, rows_to_ste_data(rows), threshold)
+
+
+async def get_fuzzy_matches_for_rows_async(
+    query: str,
+    rows,
+    threshold: int = 50
+) -> List[int]:
+    """
+    То же, что get_fuzzy_matches_for_ste, но по строкам выборки из БД:
+    и сборка словарей по всему каталогу, и скоринг выполняются в пуле
+    FUZZY_EXECUTOR_WORKERS, чтобы не блокировать event loop.
+    """
+    if not query or not rows:
+        return []
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_executor(), _match_rows, query, rows, threshold)
+
+
 def calculate_similarity(s1: str, s2: str) -> int:
     """
     Вычисляет similarity score между двумя строками (0-100).
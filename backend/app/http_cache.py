@@ -0,0 +1,303 @@
+"""
+HTTP кеширование чтений каталога: ETag / Last-Modified и условные GET.
+
+Версия каталога - последний seq журнала изменений (changes.py): любая
+запись в STE или карточки её увеличивает. К ней добавляется поколение
+метрик карточек (последний пересчёт card_metrics): от него зависит
+sort=quality. Воркер держит версию в памяти и перечитывает её не чаще
+раза в HTTP_CACHE_VERSION_TTL секунд, а после собственных записей -
+сразу. Поэтому If-None-Match с актуальным ETag получает 304 без запроса
+в БД и без сериализации.
+
+Отдельные STE и карточки получают ETag по версии своей строки (у карточки -
+и по версиям её STE), чтобы запись в другой объект не сбрасывала их кеш.
+Версия строки запоминается вместе с версией каталога, при которой она
+прочитана: пока каталог не менялся, условный GET не ходит в БД.
+
+Свои записи сбрасывают версию каталога, как только обработчик начал ответ
+(commit уже сделан), не дожидаясь BackgroundTasks.
+
+Политики Cache-Control задаются таблицей ROUTE_POLICIES.
+"""
+import hashlib
+import os
+import re
+import threading
+import time
+from datetime import datetime, timezone
+from email.utils import format_datetime, parsedate_to_datetime
+from typing import Optional, Tuple
+
+from sqlalchemy import func, select
+from starlette.concurrency import run_in_threadpool
+
+from . import database, metrics, models
+
+HTTP_CACHE_ENABLED = os.getenv("HTTP_CACHE_ENABLED", "1") == "1"
+# Как долго воркер доверяет версии каталога без запроса в БД (изменения других воркеров)
+HTTP_CACHE_VERSION_TTL = float(os.getenv("HTTP_CACHE_VERSION_TTL", 2))
+
+_EPOCH = datetime(2000, 1, 1, tzinfo=timezone.utc)
+
+# (шаблон пути, Cache-Control, нужна авторизация, версия: catalog / card / ste - по id из пути)
+ROUTE_POLICIES = [
+    (re.compile(r"^/api/categories$"), "public, max-age=60", False, "catalog"),
+    (re.compile(r"^/api/search$"), "public, max-age=10", False, "catalog"),
+    (re.compile(r"^/api/card/\d+/\d+$"), "public, max-age=30", False, "catalog"),
+    (re.compile(r"^/api/admin/card/(\d+)$"), "private, no-cache", True, "card"),
+    (re.compile(r"^/api/admin/ste/(\d+)$"), "private, no-cache", True, "ste"),
+    (re.compile(r"^/api/admin/card/$"), "private, no-cache", True, "catalog"),
+    (re.compile(r"^/api/admin/ste$"), "private, no-cache", True, "catalog"),
+]
+
+
+def _utc(value: Optional[datetime]) -> datetime:
+    if value is None:
+        return _EPOCH
+    return value if value.tzinfo is not None else value.replace(tzinfo=timezone.utc)
+
+
+class CatalogVersion:
+    """Версия каталога (ETag, время изменения) с кешем в памяти воркера."""
+
+    def __init__(self, ttl: float = HTTP_CACHE_VERSION_TTL):
+        self.ttl = ttl
+        self._value: Optional[Tuple[str, datetime]] = None
+        self._loaded_at = 0.0
+        self._lock = threading.Lock()
+
+    def _load(self) -> Tuple[str, datetime]:
+        db = database.ReadSessionLocal()
+        try:
+            row = db.execute(
+                select(models.ChangeLog.seq, models.ChangeLog.changed_at)
+                .order_by(models.ChangeLog.seq.desc())
+                .limit(1)
+            ).first()
+            metrics_at = db.scalar(select(func.max(models.CardMetrics.updated_at)))
+        finally:
+            db.close()
+        seq, changed_at = (row.seq, _utc(row.changed_at)) if row is not None else (0, _EPOCH)
+        metrics_at = _utc(metrics_at)
+        generation = int(metrics_at.timestamp() * 1_000_000) if metrics_at > _EPOCH else 0
+        return make_etag(f"catalog-{seq}-{generation}"), max(changed_at, metrics_at)
+
+    def get(self) -> Tuple[str, datetime]:
+        with self._lock:
+            if self._value is not None and time.monotonic() - self._loaded_at < self.ttl:
+                return self._value
+        value = self._load()
+        with self._lock:
+            self._value = value
+            self._loaded_at = time.monotonic()
+        return value
+
+    def invalidate(self) -> None:
+        with self._lock:
+            self._value = None
+
+
+catalog_version = CatalogVersion()
+
+
+def _ste_version(db, ste_id: int) -> Optional[Tuple[str, datetime]]:
+    row = db.execute(select(models.STE.version, models.STE.updated_at).where(models.STE.id == ste_id)).first()
+    if row is None:
+        return None
+    return make_etag(f"ste-{ste_id}-{row.version}"), _utc(row.updated_at)
+
+
+def _card_version(db, card_id: int) -> Optional[Tuple[str, datetime]]:
+    """Версия карточки и её состава: перенос STE не меняет version самой карточки."""
+    row = db.execute(select(models.Card.version, models.Card.updated_at).where(models.Card.id == card_id)).first()
+    if row is None:
+        return None
+    stes = db.execute(
+        select(models.STE.id, models.STE.version, models.STE.updated_at)
+        .where(models.STE.card_id == card_id)
+        .order_by(models.STE.id)
+    ).all()
+    digest = hashlib.blake2b(digest_size=8)
+    for ste_id, version, _ in stes:
+        digest.update(f"{ste_id}:{version},".encode())
+    changed_at = max([_utc(row.updated_at)] + [_utc(updated_at) for _, _, updated_at in stes])
+    return make_etag(f"card-{card_id}-{row.version}-{digest.hexdigest()}"), changed_at
+
+
+_ROW_VERSIONS = {"card": _card_version, "ste": _ste_version}
+
+
+def row_version(kind: str, row_id: int) -> Optional[Tuple[str, datetime]]:
+    """ETag и время изменения отдельного объекта; None - объекта нет (ответит приложение)."""
+    db = database.ReadSessionLocal()
+    try:
+        return _ROW_VERSIONS[kind](db, row_id)
+    finally:
+        db.close()
+
+
+# Сколько версий отдельных объектов держать в памяти воркера
+_ROW_CACHE_SIZE = 10000
+
+
+class RowVersions:
+    """Версии отдельных объектов, действительные при известной версии каталога."""
+
+    def __init__(self, max_size: int = _ROW_CACHE_SIZE):
+        self.max_size = max_size
+        self._cache = {}
+        self._lock = threading.Lock()
+
+    def cached(self, kind: str, row_id: int, catalog_etag: str) -> Optional[Tuple[str, datetime]]:
+        with self._lock:
+            entry = self._cache.get((kind, row_id))
+        if entry is not None and entry[0] == catalog_etag:
+            return entry[1]
+        return None
+
+    def put(self, kind: str, row_id: int, catalog_etag: str, version: Tuple[str, datetime]) -> None:
+        with self._lock:
+            if len(self._cache) >= self.max_size:
+                self._cache.clear()
+            self._cache[(kind, row_id)] = (catalog_etag, version)
+
+
+row_versions = RowVersions()
+
+
+def policy_for(path: str):
+    for pattern, cache_control, auth_required, kind in ROUTE_POLICIES:
+        match = pattern.match(path)
+        if match:
+            row_id = int(match.group(1)) if match.groups() else None
+            return cache_control, auth_required, kind, row_id
+    return None
+
+
+def make_etag(tag: str) -> str:
+    return f'W/"{tag}"'
+
+
+def _etag_matches(header: str, etag: str) -> bool:
+    if header.strip() == "*":
+        return True
+    # Слабое сравнение: W/ не учитывается
+    candidates = {tag.strip().removeprefix("W/") for tag in header.split(",")}
+    return etag.removeprefix("W/") in candidates
+
+
+def _not_modified_since(header: str, changed_at: datetime) -> bool:
+    try:
+        since = parsedate_to_datetime(header)
+    except (TypeError, ValueError):
+        return False
+    if since.tzinfo is None:
+        since = since.replace(tzinfo=timezone.utc)
+    return changed_at.replace(microsecond=0) <= since
+
+
+def _authorized(headers: dict) -> bool:
+    """Подпись токена без запроса в БД; невалидный токен отдаём приложению (там будет 401)."""
+    from jose import JWTError, jwt
+
+    from .auth.jwt import ALGORITHM, SECRET_KEY
+
+    authorization = headers.get("authorization", "")
+    scheme, _, token = authorization.partition(" ")
+    if scheme.lower() != "bearer" or not token:
+        return False
+    try:
+        jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        return True
+    except JWTError:
+        return False
+
+
+class HTTPCacheMiddleware:
+    """ASGI middleware: 304 по If-None-Match / If-Modified-Since и заголовки кеширования."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not HTTP_CACHE_ENABLED:
+            await self.app(scope, receive, send)
+            return
+
+        method = scope["method"]
+        if method not in ("GET", "HEAD"):
+            # Свои записи видим сразу, записи других воркеров - через TTL
+            if method in database.READ_METHODS:
+                await self.app(scope, receive, send)
+                return
+
+            async def send_invalidating(message):
+                if message["type"] == "http.response.start":
+                    # Обработчик уже закоммитил; фоновые задачи ещё впереди
+                    catalog_version.invalidate()
+                await send(message)
+
+            try:
+                await self.app(scope, receive, send_invalidating)
+            finally:
+                # Ошибка до ответа и записи фоновых задач
+                catalog_version.invalidate()
+            return
+
+        policy = policy_for(scope["path"])
+        if policy is None:
+            await self.app(scope, receive, send)
+            return
+        cache_control, auth_required, kind, row_id = policy
+
+        try:
+            if kind == "catalog":
+                version = await run_in_threadpool(catalog_version.get)
+            else:
+                # Версию каталога берём до чтения строки: запись между ними сбросит кеш строки
+                catalog_etag, _ = await run_in_threadpool(catalog_version.get)
+                version = row_versions.cached(kind, row_id, catalog_etag)
+                if version is None:
+                    version = await run_in_threadpool(row_version, kind, row_id)
+                    if version is not None:
+                        row_versions.put(kind, row_id, catalog_etag, version)
+        except Exception:
+            version = None
+        if version is None:
+            # Без версии кешировать нельзя - обычный ответ
+            await self.app(scope, receive, send)
+            return
+
+        etag, changed_at = version
+        last_modified = format_datetime(changed_at.astimezone(timezone.utc).replace(microsecond=0), usegmt=True)
+        cache_headers = [
+            (b"etag", etag.encode()),
+            (b"last-modified", last_modified.encode()),
+            (b"cache-control", cache_control.encode()),
+        ]
+
+        headers = {k.decode("latin-1").lower(): v.decode("latin-1") for k, v in scope["headers"]}
+        if_none_match = headers.get("if-none-match")
+        if_modified_since = headers.get("if-modified-since")
+        if if_none_match is not None:
+            not_modified = _etag_matches(if_none_match, etag)
+        else:
+            not_modified = if_modified_since is not None and _not_modified_since(if_modified_since, changed_at)
+
+        if not_modified and (not auth_required or _authorized(headers)):
+            metrics.observe_cache("http", "hit")
+            await send({"type": "http.response.start", "status": 304, "headers": cache_headers})
+            await send({"type": "http.response.body", "body": b""})
+            return
+
+        metrics.observe_cache("http", "miss")
+
+        async def send_with_headers(message):
+            if message["type"] == "http.response.start" and message["status"] == 200:
+                existing = {k.lower() for k, _ in message.get("headers", [])}
+                message["headers"] = list(message.get("headers", [])) + [
+                    (k, v) for k, v in cache_headers if k not in existing
+                ]
+            await send(message)
+
+        await self.app(scope, receive, send_with_headers)
@@ -0,0 +1,156 @@
+"""
+Запуск и готовность приложения.
+
+Импорт app.main не трогает БД и не грузит тяжёлые библиотеки: схема,
+админ по умолчанию и прогрев выполняются в lifespan. Время каждого шага
+пишется в лог и отдаётся в /api/health/ready.
+"""
+import logging
+import os
+import threading
+import time
+from contextlib import asynccontextmanager, contextmanager
+
+from sqlalchemy import text
+
+from . import database, models
+
+logger = logging.getLogger(__name__)
+
+# Прогревать модель и хранилище эмбеддингов в фоне после старта
+ML_WARMUP = os.getenv('ML_WARMUP', '0') == '1'
+# Пауза между попытками прогрева (удваивается до 60 секунд)
+WARMUP_RETRY_SECONDS = float(os.getenv('ML_WARMUP_RETRY_SECONDS', 5))
+
+_import_started = time.perf_counter()
+
+
+class StartupState:
+    """Тайминги шагов запуска и флаги готовности."""
+
+    def __init__(self):
+        self.steps = {}
+        self.schema_ready = False
+        self.warm = not ML_WARMUP
+        self.error = None
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def step(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.steps[name] = round(time.perf_counter() - start, 3)
+
+    @property
+    def ready(self) -> bool:
+        return self.schema_ready and self.warm and self.error is None
+
+    def report(self) -> dict:
+        with self._lock:
+            return {
+                'ready': self.ready,
+                'schema_ready': self.schema_ready,
+                'warm': self.warm,
+                'error': self.error,
+                'steps': dict(self.steps),
+            }
+
+
+state = StartupState()
+
+
+def ensure_schema() -> None:
+    """Применяет недостающие миграции схемы."""
+    from . import migrations
+
+    migrations.migrate(database.engine)
+
+
+def ensure_default_admin() -> None:
+    """Создаёт admin/admin1, если его нет. Хеш считается только при создании."""
+    db = database.SessionLocal()
+    try:
+        exists = db.query(models.User.id).filter(models.User.username == "admin").first()
+        if exists is not None:
+            return
+
+        from passlib.context import CryptContext
+
+        pwd_context = CryptContext(schemes=["argon2"], deprecated="auto")
+        db.add(models.User(username="admin", hashed_password=pwd_context.hash("admin1"), is_admin=True))
+        db.commit()
+        logger.info("Default admin user created: admin / admin1")
+    except Exception as e:
+        logger.error(f"Could not create admin: {e}")
+        db.rollback()
+    finally:
+        db.close()
+
+
+def _warm_up_once() -> None:
+    with state.step('warmup_imports'):
+        from . import embedding_store, ml_insert
+    with state.step('warmup_model'):
+        if not ml_insert.preload_model():
+            raise RuntimeError("embedding model did not load")
+    with state.step('warmup_embedding_store'):
+        embedding_store.get_store()
+
+
+def warm_up() -> None:
+    """
+    Фоновый прогрев: импорт ML стека, модель, хранилище эмбеддингов.
+    warm выставляется только после успешного прогрева; при ошибке воркер
+    остаётся неготовым и повторяет попытку с паузой.
+    """
+    delay = WARMUP_RETRY_SECONDS
+    while True:
+        try:
+            _warm_up_once()
+        except Exception as e:
+            logger.warning(f"Warm-up failed, retrying in {delay:.0f}s: {e}")
+            state.error = f"warm-up: {e}"
+            time.sleep(delay)
+            delay = min(delay * 2, 60)
+            continue
+        if state.error and state.error.startswith("warm-up"):
+            state.error = None
+        state.warm = True
+        logger.info(f"Warm-up finished: {state.report()['steps']}")
+        return
+
+
+def check_database() -> bool:
+    """Дешёвая проверка соединения с основной БД."""
+    try:
+        with database.engine.connect() as conn:
+            conn.execute(text("SELECT 1"))
+        return True
+    except Exception:
+        return False
+
+
+@asynccontextmanager
+async def lifespan(app):
+    # От импорта lifecycle (начало импорта app.main) до старта lifespan
+    state.steps['import'] = round(time.perf_counter() - _import_started, 3)
+
+    try:
+        with state.step('schema'):
+            ensure_schema()
+        with state.step('default_admin'):
+            ensure_default_admin()
+        state.schema_ready = True
+    except Exception as e:
+        # Воркер поднимается, но остаётся неготовым - видно в /api/health/ready
+        logger.error(f"Startup failed: {e}")
+        state.error = f"startup: {e}"
+
+    if ML_WARMUP:
+        threading.Thread(target=warm_up, name='ml-warmup', daemon=True).start()
+
+    logger.info(f"Startup finished: {state.report()['steps']}")
+    yield
@@ -1,50 +1,25 @@
-import io  # <--- И ЭТУ ТОЖЕ (если нет)
+import io
 import json
 import os
+import time
+from datetime import datetime
 from typing import List, Optional
 
-import pandas as pd  # <--- ДОБАВЬ ЭТУ СТРОКУ
-from fastapi import Depends, FastAPI, File, HTTPException, UploadFile
+from fastapi import BackgroundTasks, Depends, FastAPI, File, HTTPException, UploadFile
+from fastapi.responses import FileResponse, JSONResponse, Response
 from fastapi.middleware.cors import CORSMiddleware
-from sqlalchemy import or_
-from sqlalchemy.orm import Session
-
-# Импортируем наши модули
-from . import database, dependencies, models, schemas
+from sqlalchemy import func, or_, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session, selectinload
+
+# Импортируем наши модули (lifecycle первым - от него считается время импорта)
+from . import lifecycle
+from . import changes, curation, database, dependencies, export, http_cache, metrics, models
+from . import profiling, ratings, schemas, serialization
 from .auth import router as auth_router
 
-# Создаем таблицы (в проде лучше миграции Alembic)
-models.Base.metadata.create_all(bind=database.engine)
-
-# Создаем админа через SQLAlchemy ORM
-def create_default_admin():
-    from passlib.context import CryptContext
-    
-    pwd_context = CryptContext(schemes=["argon2"], deprecated="auto")
-    hashed_password = pwd_context.hash("admin1")
-    
-    db = database.SessionLocal()
-    try:
-        # Проверяем, есть ли уже админ
-        admin = db.query(models.User).filter(models.User.username == "admin").first()
-        if admin is None:
-            admin = models.User(
-                username="admin",
-                hashed_password=hashed_password,
-                is_admin=True
-            )
-            db.add(admin)
-            db.commit()
-            print("Default admin user created: admin / admin1")
-    except Exception as e:
-        print(f"Could not create admin: {e}")
-        db.rollback()
-    finally:
-        db.close()
-
-create_default_admin()
-
-app = FastAPI(title="TenderHack API")
+# Схема, админ и прогрев - в lifespan, импорт модуля без побочных эффектов
+app = FastAPI(title="TenderHack API", lifespan=lifecycle.lifespan)
 
 # CORS для фронтенда
 # В продакшене добавьте реальный домен в ALLOWED_ORIGINS
@@ -57,6 +32,9 @@ ALLOWED_ORIGINS.extend([
     "http://frontend:3000",
 ])
 
+# ETag / 304 для чтений каталога (добавлен до CORS, чтобы CORS-заголовки были и на 304)
+app.add_middleware(http_cache.HTTPCacheMiddleware)
+
 app.add_middleware(
     CORSMiddleware,
     allow_origins=ALLOWED_ORIGINS,
@@ -65,6 +43,12 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# X-Request-ID, детектор N+1 и профилирование по запросу
+app.add_middleware(profiling.ProfilingMiddleware)
+
+# Метрики последним - внешний слой, видит и ответы 304 из HTTP кеша
+app.add_middleware(metrics.MetricsMiddleware)
+
 # 1. Подключаем роуты авторизации (/api/auth/login, /api/auth/register)
 app.include_router(auth_router.router)
 
@@ -75,8 +59,11 @@ app.include_router(auth_router.router)
 async def import_ste_file(
     file: UploadFile = File(...), 
     db: Session = Depends(database.get_db),
-    current_user: models.User = Depends(dependencies.get_current_user)
+    current_user: dependencies.Principal = Depends(dependencies.get_current_user)
 ):
+    import pandas as pd
+
+    started = time.perf_counter()
     contents = await file.read()
     
     try:
@@ -157,6 +144,7 @@ async def import_ste_file(
             imported_count += 1
             
     db.commit()
+    metrics.observe_import("file", imported_count, updated_count, time.perf_counter() - started)
     
     return {
         "msg": "Import completed", 
@@ -169,7 +157,7 @@ async def import_ste_file(
 async def import_ste_file(
     file: UploadFile = File(...), 
     db: Session = Depends(database.get_db),
-    current_user: models.User = Depends(dependencies.get_current_user)
+    current_user: dependencies.Principal = Depends(dependencies.get_current_user)
 ):
     """
     Импорт CSV или Excel файла с данными о STE.
@@ -177,6 +165,9 @@ async def import_ste_file(
     'модель', 'страна происхождения', 'производитель', 
     'id категории', 'название категории', 'характеристики'
     """
+    import pandas as pd
+
+    started = time.perf_counter()
     contents = await file.read()
     
     # 1. Читаем файл в DataFrame
@@ -242,6 +233,7 @@ async def import_ste_file(
             imported_count += 1
             
     db.commit()
+    metrics.observe_import("file", imported_count, updated_count, time.perf_counter() - started)
     
     return {
         "msg": "Import completed", 
@@ -257,42 +249,39 @@ def get_stes(
     skip: int = 0, 
     limit: int = 100, 
     db: Session = Depends(database.get_db),
-    current_user: models.User = Depends(dependencies.get_current_user)
+    current_user: dependencies.Principal = Depends(dependencies.get_current_user)
 ):
     """Получить список STE с поиском, фильтрацией по категории и пагинацией."""
     from . import fuzzy_search
     
-    query = db.query(models.STE)
+    filters = []
     
     # Фильтр по категории (применяется всегда)
     if category_id:
-        query = query.filter(models.STE.category_id == category_id)
+        filters.append(models.STE.category_id == category_id)
     
     if q:
         if fuzzy:
-            # Fuzzy search: сначала получаем все записи, затем фильтруем
-            all_stes = query.all()
-            ste_data = [
-                {
-                    'id': ste.id,
-                    'name': ste.name,
-                    'model_name': ste.model_name,
-                    'manufacturer': ste.manufacturer
-                }
-                for ste in all_stes
-            ]
-            matching_ids = fuzzy_search.get_fuzzy_matches_for_ste(q, ste_data, threshold=50)
-            
-            if not matching_ids:
-                return []
+            # Fuzzy search: скорим по лёгким кортежам, полные строки - только для страницы
+            rows = db.execute(
+                select(models.STE.id, models.STE.name, models.STE.model_name, models.STE.manufacturer).where(*filters)
+            ).all()
+            matching_ids = fuzzy_search.get_fuzzy_matches_for_ste(q, fuzzy_search.rows_to_ste_data(rows), threshold=50)
+            page_ids = matching_ids[skip:skip + limit]
+            if not page_ids:
+                return serialization.json_response([])
             
             # Получаем STE в порядке релевантности
-            id_to_ste = {ste.id: ste for ste in all_stes}
-            result = [id_to_ste[id] for id in matching_ids if id in id_to_ste]
-            return result[skip:skip + limit]
+            id_to_ste = {
+                row.id: row
+                for row in db.execute(select(*serialization.STE_COLUMNS).where(models.STE.id.in_(page_ids)))
+            }
+            return serialization.json_response(
+                serialization.ste_dicts(id_to_ste[id] for id in page_ids if id in id_to_ste)
+            )
         else:
             # Обычный ILIKE поиск
-            query = query.filter(
+            filters.append(
                 or_(
                     models.STE.name.ilike(f"%{q}%"),
                     models.STE.model_name.ilike(f"%{q}%"),
@@ -300,13 +289,16 @@ def get_stes(
                 )
             )
     
-    return query.offset(skip).limit(limit).all()
+    rows = db.execute(
+        select(*serialization.STE_COLUMNS).where(*filters).order_by(models.STE.id).offset(skip).limit(limit)
+    )
+    return serialization.json_response(serialization.ste_dicts(rows))
 
 @app.post("/api/admin/ste", response_model=schemas.STEResponse)
 def create_ste(
     ste: schemas.STECreate, 
     db: Session = Depends(database.get_db),
-    current_user: models.User = Depends(dependencies.get_current_user)
+    current_user: dependencies.Principal = Depends(dependencies.get_current_user)
 ):
     """Создать новый STE."""
     db_ste = models.STE(**ste.model_dump())
@@ -316,23 +308,46 @@ def create_ste(
     return db_ste
 
 @app.get("/api/admin/ste/{id}", response_model=schemas.STEResponse)
-def get_ste_detail(
+async def get_ste_detail(
     id: int, 
-    db: Session = Depends(database.get_db),
-    current_user: models.User = Depends(dependencies.get_current_user)
+    db: AsyncSession = Depends(database.get_async_db),
+    current_user: dependencies.Principal = Depends(dependencies.get_current_user)
 ):
     """Получить STE по ID."""
-    ste = db.query(models.STE).filter(models.STE.id == id).first()
+    ste = await db.get(models.STE, id)
     if not ste:
         raise HTTPException(status_code=404, detail="STE not found")
     return ste
 
+@app.get("/api/ste/{id}/similar", response_model=List[schemas.SimilarSTEResponse])
+def get_similar_stes(
+    id: int,
+    k: int = 10,
+    same_category: bool = False,
+    db: Session = Depends(database.get_db),
+    current_user: dependencies.Principal = Depends(dependencies.get_current_user)
+):
+    """
+    Ближайшие по смыслу STE из предрассчитанного графа соседей.
+    Модель не вызывается; граф обновляется после реагрегации.
+    """
+    from . import neighbors
+    
+    if not 1 <= k <= neighbors.NEIGHBORS_K:
+        raise HTTPException(status_code=400, detail=f"k must be between 1 and {neighbors.NEIGHBORS_K}")
+    
+    if not db.query(models.STE.id).filter(models.STE.id == id).first():
+        raise HTTPException(status_code=404, detail="STE not found")
+    
+    rows = neighbors.get_similar(db, id, k, same_category)
+    return [{"ste": ste, "score": score} for ste, score in rows]
+
 @app.patch("/api/admin/ste/{id}", response_model=schemas.STEResponse)
 def update_ste(
     id: int, 
     ste_update: schemas.STEUpdate, 
     db: Session = Depends(database.get_db),
-    current_user: models.User = Depends(dependencies.get_current_user)
+    current_user: dependencies.Principal = Depends(dependencies.get_current_user)
 ):
     """Обновить STE (PATCH)."""
     db_ste = db.query(models.STE).filter(models.STE.id == id).first()
@@ -351,7 +366,7 @@ def update_ste(
 def delete_ste(
     id: int, 
     db: Session = Depends(database.get_db),
-    current_user: models.User = Depends(dependencies.get_current_user)
+    current_user: dependencies.Principal = Depends(dependencies.get_current_user)
 ):
     """Удалить STE."""
     db_ste = db.query(models.STE).filter(models.STE.id == id).first()
@@ -365,9 +380,10 @@ def delete_ste(
 async def upload_stes(
     file: UploadFile = File(...), 
     db: Session = Depends(database.get_db),
-    current_user: models.User = Depends(dependencies.get_current_user)
+    current_user: dependencies.Principal = Depends(dependencies.get_current_user)
 ):
     """Загрузка JSON файла с STE (массовое создание)."""
+    started = time.perf_counter()
     content = await file.read()
     try:
         data = json.loads(content)
@@ -386,6 +402,7 @@ async def upload_stes(
             created_count += 1
         
         db.commit()
+        metrics.observe_import("json", created_count, 0, time.perf_counter() - started)
         return {"msg": f"Successfully uploaded {created_count} STEs"}
     except Exception as e:
         raise HTTPException(status_code=400, detail=f"Invalid file format: {str(e)}")
@@ -398,45 +415,64 @@ def get_cards(
     q: Optional[str] = None,
     category_id: Optional[int] = None,  # Фильтр по категории (через STE)
     fuzzy: bool = True,  # Использовать fuzzy search
+    sort: Optional[str] = None,  # "quality" - сначала карточки с худшей связностью
     skip: int = 0, 
     limit: int = 50, 
     db: Session = Depends(database.get_db),
-    current_user: models.User = Depends(dependencies.get_current_user)
+    current_user: dependencies.Principal = Depends(dependencies.get_current_user)
 ):
     """Список карт с поиском и фильтрацией по категории."""
     from . import fuzzy_search
     
-    query = db.query(models.Card)
+    query = select(*serialization.CARD_COLUMNS)
     
     if category_id:
         # Фильтруем карточки, у которых есть STE с указанной категорией
-        query = query.join(models.STE).filter(models.STE.category_id == category_id).distinct()
+        has_category = select(models.STE.id).where(
+            models.STE.card_id == models.Card.id, models.STE.category_id == category_id
+        ).exists()
+        query = query.where(has_category)
     
     if q:
         if fuzzy:
             # Fuzzy search по названию карты
-            all_cards = query.all()
+            all_cards = db.execute(query).all()
             card_names = [card.name or '' for card in all_cards]
             
             matches = fuzzy_search.fuzzy_match(q, card_names, threshold=50, limit=len(card_names))
             
-            if not matches:
-                return []
-            
             # Сортируем по релевантности
-            matching_indices = [index for _, _, index in matches]
-            result = [all_cards[i] for i in matching_indices]
-            return result[skip:skip + limit]
+            card_rows = [all_cards[index] for _, _, index in matches][skip:skip + limit]
+            return serialization.json_response(_cards_with_stes(db, card_rows))
         else:
-            query = query.filter(models.Card.name.ilike(f"%{q}%"))
+            query = query.where(models.Card.name.ilike(f"%{q}%"))
+    
+    if sort == "quality":
+        # Метрики предрассчитаны (card_metrics), сортировка - обычный ORDER BY
+        query = query.outerjoin(models.CardMetrics, models.CardMetrics.card_id == models.Card.id).order_by(
+            models.CardMetrics.mean_similarity.asc().nulls_last(), models.Card.id
+        )
+    else:
+        query = query.order_by(models.Card.id)
     
-    return query.offset(skip).limit(limit).all()
+    card_rows = db.execute(query.offset(skip).limit(limit)).all()
+    return serialization.json_response(_cards_with_stes(db, card_rows))
+
+def _cards_with_stes(db: Session, card_rows) -> list:
+    """Вложенные STE страницы карточек - одним запросом."""
+    card_ids = [row[0] for row in card_rows]
+    ste_rows = []
+    if card_ids:
+        ste_rows = db.execute(
+            select(*serialization.STE_COLUMNS).where(models.STE.card_id.in_(card_ids)).order_by(models.STE.id)
+        ).all()
+    return serialization.card_dicts(card_rows, ste_rows)
 
 @app.post("/api/admin/card/", response_model=schemas.CardResponse)
 def create_card(
     card: schemas.CardCreate, 
     db: Session = Depends(database.get_db),
-    current_user: models.User = Depends(dependencies.get_current_user)
+    current_user: dependencies.Principal = Depends(dependencies.get_current_user)
 ):
     """Создать карту вручную."""
     # Extract ste_ids from the payload and create card with remaining fields
@@ -445,37 +481,49 @@ def create_card(
 
     db_card = models.Card(**payload)
     db.add(db_card)
-    db.commit()
-    db.refresh(db_card)
+    db.flush()
 
-    # Attach provided STEs to the created card
+    # Привязываем STE одним UPDATE в той же транзакции
     if ste_ids:
-        stes = db.query(models.STE).filter(models.STE.id.in_(ste_ids)).all()
-        for ste in stes:
-            ste.card_id = db_card.id
-        db.commit()
-        db.refresh(db_card)
+        curation.move_stes(db, ste_ids, db_card.id)
+    db.commit()
+    db.refresh(db_card)
 
     return db_card
 
 @app.get("/api/admin/card/{id}", response_model=schemas.CardResponse)
-def get_card_detail(
+async def get_card_detail(
     id: int, 
-    db: Session = Depends(database.get_db),
-    current_user: models.User = Depends(dependencies.get_current_user)
+    db: AsyncSession = Depends(database.get_async_db),
+    current_user: dependencies.Principal = Depends(dependencies.get_current_user)
 ):
     """Детальная инфо о карте."""
-    card = db.query(models.Card).filter(models.Card.id == id).first()
+    # STE грузим сразу: ленивая загрузка в async-сессии невозможна
+    card = await db.scalar(
+        select(models.Card).options(selectinload(models.Card.stes)).where(models.Card.id == id)
+    )
     if not card:
         raise HTTPException(status_code=404, detail="Card not found")
     return card
 
+@app.get("/api/admin/card/{id}/metrics", response_model=schemas.CardMetricsResponse)
+def get_card_metrics(
+    id: int,
+    db: Session = Depends(database.get_db),
+    current_user: dependencies.Principal = Depends(dependencies.get_current_user)
+):
+    """Метрики связности карточки (считаются после реагрегации)."""
+    metrics = db.query(models.CardMetrics).filter(models.CardMetrics.card_id == id).first()
+    if not metrics:
+        raise HTTPException(status_code=404, detail="Card metrics not found")
+    return metrics
+
 @app.patch("/api/admin/card/{id}", response_model=schemas.CardResponse)
 def update_card(
     id: int, 
     card_update: schemas.CardUpdate, 
     db: Session = Depends(database.get_db),
-    current_user: models.User = Depends(dependencies.get_current_user)
+    current_user: dependencies.Principal = Depends(dependencies.get_current_user)
 ):
     """Обновить карту (PATCH)."""
     db_card = db.query(models.Card).filter(models.Card.id == id).first()
@@ -494,124 +542,158 @@ def update_card(
 def delete_card(
     id: int, 
     db: Session = Depends(database.get_db),
-    current_user: models.User = Depends(dependencies.get_current_user)
+    current_user: dependencies.Principal = Depends(dependencies.get_current_user)
 ):
     """Удалить карту."""
-    db_card = db.query(models.Card).filter(models.Card.id == id).first()
-    if not db_card:
+    if not db.query(models.Card.id).filter(models.Card.id == id).first():
         raise HTTPException(status_code=404, detail="Card not found")
     
-    # Отвязываем STE перед удалением
-    for ste in db_card.stes:
-        ste.card_id = None
-    
-    db.delete(db_card)
+    # Отвязываем STE и удаляем карточку без загрузки ORM объектов
+    curation.reassign(db, models.STE.card_id == id, None)
+    curation.delete_cards(db, [id])
     db.commit()
     return {"msg": "Deleted"}
 
+@app.post("/api/admin/card/merge", response_model=schemas.CardBulkResponse)
+def merge_cards(
+    request: schemas.CardMergeRequest,
+    background_tasks: BackgroundTasks,
+    db: Session = Depends(database.get_db),
+    current_user: dependencies.Principal = Depends(dependencies.get_current_user)
+):
+    """Слить карточки source_ids в target_id: STE и оценки переезжают, источники удаляются."""
+    from . import card_metrics
+
+    result = curation.merge_cards(db, request.target_id, request.source_ids, request.name)
+    db.commit()
+    background_tasks.add_task(card_metrics.refresh_card_metrics_task, result["touched_card_ids"])
+    return result
+
+@app.post("/api/admin/card/{id}/split", response_model=schemas.CardBulkResponse)
+def split_card(
+    id: int,
+    request: schemas.CardSplitRequest,
+    background_tasks: BackgroundTasks,
+    db: Session = Depends(database.get_db),
+    current_user: dependencies.Principal = Depends(dependencies.get_current_user)
+):
+    """Вынести часть STE карточки в новую карточку."""
+    from . import card_metrics
+
+    result = curation.split_card(db, id, request.ste_ids, request.name)
+    db.commit()
+    background_tasks.add_task(card_metrics.refresh_card_metrics_task, result["touched_card_ids"])
+    return result
+
+@app.post("/api/admin/card/move", response_model=schemas.CardBulkResponse)
+def move_stes(
+    request: schemas.CardMoveRequest,
+    background_tasks: BackgroundTasks,
+    db: Session = Depends(database.get_db),
+    current_user: dependencies.Principal = Depends(dependencies.get_current_user)
+):
+    """Перенести наборы STE между карточками одной транзакцией."""
+    from . import card_metrics
+
+    result = curation.move(db, [move.model_dump() for move in request.moves], request.retire_empty)
+    db.commit()
+    background_tasks.add_task(card_metrics.refresh_card_metrics_task, result["touched_card_ids"])
+    return result
+
 
 # --- 4. API: Search & Aggregation (Публичные и ML) ---
 
 @app.get("/api/search", response_model=schemas.PaginatedSTEResponse)
-def search_public(
+async def search_public(
     query: str,
     exact: bool = False,
     fuzzy: bool = True,  # Использовать fuzzy search (игнорируется если exact=True)
     page: int = 1,
     per_page: int = 10,
     category_id: Optional[int] = None,
-    db: Session = Depends(database.get_db)
+    db: AsyncSession = Depends(database.get_async_db)
 ):
     """Публичный поиск STE по query с пагинацией. exact=true для точного поиска, fuzzy=true для нечёткого."""
     from . import fuzzy_search
 
-    # Базовый запрос
-    base_query = db.query(models.STE)
-    
     # Фильтр по категории
+    filters = []
     if category_id is not None:
-        base_query = base_query.filter(models.STE.category_id == category_id)
-    
-    # Фильтр по поисковому запросу
-    if exact:
-        # Точный поиск - ищем точное совпадение
-        base_query = base_query.filter(
-            or_(
-                models.STE.name == query,
-                models.STE.model_name == query,
-                models.STE.manufacturer == query
-            )
-        )
-        total = base_query.count()
-        offset = (page - 1) * per_page
-        items = base_query.offset(offset).limit(per_page).all()
-    elif fuzzy:
-        # Fuzzy search
-        all_stes = base_query.all()
-        ste_data = [
-            {
-                'id': ste.id,
-                'name': ste.name,
-                'model_name': ste.model_name,
-                'manufacturer': ste.manufacturer
-            }
-            for ste in all_stes
-        ]
-        matching_ids = fuzzy_search.get_fuzzy_matches_for_ste(query, ste_data, threshold=40)
+        filters.append(models.STE.category_id == category_id)
+    
+    offset = (page - 1) * per_page
+    if not exact and fuzzy:
+        # Fuzzy search: грузим только поля для скоринга, сам скоринг - в отдельном пуле
+        rows = (await db.execute(
+            select(models.STE.id, models.STE.name, models.STE.model_name, models.STE.manufacturer).where(*filters)
+        )).all()
+        matching_ids = await fuzzy_search.get_fuzzy_matches_for_rows_async(query, rows, threshold=40)
         
         total = len(matching_ids)
-        offset = (page - 1) * per_page
         page_ids = matching_ids[offset:offset + per_page]
         
         # Получаем STE в порядке релевантности
-        id_to_ste = {ste.id: ste for ste in all_stes}
-        items = [id_to_ste[id] for id in page_ids if id in id_to_ste]
+        id_to_ste = {}
+        if page_ids:
+            page_rows = await db.execute(select(*serialization.STE_COLUMNS).where(models.STE.id.in_(page_ids)))
+            id_to_ste = {row.id: row for row in page_rows}
+        items = serialization.ste_dicts(id_to_ste[id] for id in page_ids if id in id_to_ste)
     else:
-        # Обычный поиск - частичное совпадение (ILIKE)
-        base_query = base_query.filter(
-            or_(
+        if exact:
+            # Точный поиск - ищем точное совпадение
+            filters.append(or_(
+                models.STE.name == query,
+                models.STE.model_name == query,
+                models.STE.manufacturer == query
+            ))
+        else:
+            # Обычный поиск - частичное совпадение (ILIKE)
+            filters.append(or_(
                 models.STE.name.ilike(f"%{query}%"),
                 models.STE.model_name.ilike(f"%{query}%"),
                 models.STE.manufacturer.ilike(f"%{query}%")
-            )
+            ))
+        total = await db.scalar(select(func.count()).select_from(models.STE).where(*filters))
+        rows = await db.execute(
+            select(*serialization.STE_COLUMNS).where(*filters).order_by(models.STE.id).offset(offset).limit(per_page)
         )
-        total = base_query.count()
-        offset = (page - 1) * per_page
-        items = base_query.offset(offset).limit(per_page).all()
+        items = serialization.ste_dicts(rows)
     
     # Вычисляем общее количество страниц
     total_pages = (total + per_page - 1) // per_page if total > 0 else 1
     
-    return {
+    return serialization.json_response({
         "items": items,
         "total": total,
         "page": page,
         "per_page": per_page,
         "total_pages": total_pages
-    }
+    })
 
 @app.get("/api/card/{card_id}/{ste_id}", response_model=schemas.STEResponse)
-def get_card_ste_relation(
+async def get_card_ste_relation(
     card_id: int, 
     ste_id: int, 
-    db: Session = Depends(database.get_db)
+    db: AsyncSession = Depends(database.get_async_db)
 ):
     """Проверка связи между картой и STE. Возвращает данные STE, если он привязан к карте."""
-    ste = db.query(models.STE).filter(models.STE.id == ste_id, models.STE.card_id == card_id).first()
+    ste = await db.scalar(
+        select(models.STE).where(models.STE.id == ste_id, models.STE.card_id == card_id)
+    )
     if not ste:
         raise HTTPException(status_code=404, detail="Relation not found")
     return ste
 
 @app.get("/api/categories", response_model=List[schemas.CategoryResponse])
-def get_categories(
-    db: Session = Depends(database.get_db)
+async def get_categories(
+    db: AsyncSession = Depends(database.get_async_db)
 ):
     """
     Получить список всех категорий (id + name).
     Поскольку в проекте нет отдельной таблицы категорий, берём уникальные пары
     `category_id` и `category_name` из таблицы `stes`.
     """
-    rows = db.query(models.STE.category_id, models.STE.category_name).distinct().all()
+    rows = await db.execute(select(models.STE.category_id, models.STE.category_name).distinct())
     result = []
     for cid, cname in rows:
         if cid is None:
@@ -626,92 +708,230 @@ def get_categories(
 def rate_aggregation(
     feedback: schemas.FeedbackCreate,
     db: Session = Depends(database.get_db),
-    current_user: models.User = Depends(dependencies.get_current_user)
+    current_user: dependencies.Principal = Depends(dependencies.get_current_user)
 ):
     """
     Оценить качество агрегации (связь Карты и STE).
     score: 1 (Correct), 0 (Incorrect).
     Эти данные будут использованы для переобучения ML.
     """
-    # 1. Валидация: существуют ли такие ID
-    card = db.query(models.Card).filter(models.Card.id == feedback.card_id).first()
-    ste = db.query(models.STE).filter(models.STE.id == feedback.ste_id).first()
-    
-    if not card or not ste:
-        raise HTTPException(status_code=404, detail="Card or STE not found")
-        
-    if feedback.score not in [0, 1]:
-        raise HTTPException(status_code=400, detail="Score must be 0 or 1")
+    # Валидация и upsert (повторный голос пользователя обновляет оценку)
+    votes = ratings.validate_votes(db, [feedback.model_dump()])
+    ratings.upsert_votes(db, current_user.id, votes)
+    db.commit()
 
-    # 2. Проверяем, не голосовал ли уже этот юзер за эту пару (чтобы избежать дублей)
-    # Если нужно разрешить переголосовывать - можно убрать этот блок или делать update
-    existing_vote = db.query(models.Feedback).filter(
+    return db.query(models.Feedback).filter(
         models.Feedback.card_id == feedback.card_id,
         models.Feedback.ste_id == feedback.ste_id,
         models.Feedback.user_id == current_user.id
     ).first()
 
-    if existing_vote:
-        # Обновляем существующую оценку
-        existing_vote.score = feedback.score
-        db.commit()
-        db.refresh(existing_vote)
-        return existing_vote
-
-    # 3. Создаем новую запись фидбека
-    new_feedback = models.Feedback(
-        card_id=feedback.card_id,
-        ste_id=feedback.ste_id,
-        score=feedback.score,
-        user_id=current_user.id
-    )
-    db.add(new_feedback)
+@app.post("/api/rating/batch", response_model=schemas.FeedbackBatchResponse)
+def rate_aggregation_batch(
+    batch: schemas.FeedbackBatchCreate,
+    db: Session = Depends(database.get_db),
+    current_user: dependencies.Principal = Depends(dependencies.get_current_user)
+):
+    """
+    Пакетная оценка: много пар (card_id, ste_id, score) за один запрос.
+    Проверка существования - на весь пакет сразу, запись - одним upsert,
+    агрегаты карточек обновляются в той же транзакции.
+    """
+    if len(batch.votes) > ratings.RATING_BATCH_MAX:
+        raise HTTPException(status_code=400, detail=f"At most {ratings.RATING_BATCH_MAX} votes per batch")
+
+    votes = ratings.validate_votes(db, [vote.model_dump() for vote in batch.votes])
+    written = ratings.upsert_votes(db, current_user.id, votes)
     db.commit()
-    db.refresh(new_feedback)
-    
-    return new_feedback
+
+    return {
+        "received": len(batch.votes),
+        "written": written,
+        "cards_updated": len({vote["card_id"] for vote in votes}),
+    }
 
 @app.get("/api/rating/history")
 def get_rating_history(
     db: Session = Depends(database.get_db),
-    current_user: models.User = Depends(dependencies.get_current_user)
+    current_user: dependencies.Principal = Depends(dependencies.get_current_user)
 ):
-    """Получить все оценки (для ML датасета)."""
+    """Получить все оценки (для ML датасета). Для больших объёмов - /api/export/feedback."""
     return db.query(models.Feedback).all()
 
+@app.get("/api/export/feedback")
+def export_feedback(
+    format: str = "ndjson",
+    since: Optional[datetime] = None,
+    after_id: Optional[int] = None,
+    limit: Optional[int] = None,
+    current_user: dependencies.Principal = Depends(dependencies.get_current_user)
+):
+    """
+    Потоковая выгрузка оценок (ndjson / csv / parquet), по возрастанию id.
+    Инкрементально: after_id = последний полученный id, since - по updated_at (с повторными голосами).
+    """
+    return export.stream_export(export.feedback_query(since, after_id, limit), "feedback", format)
+
+@app.get("/api/export/assignments")
+def export_assignments(
+    format: str = "ndjson",
+    since: Optional[datetime] = None,
+    after_id: Optional[int] = None,
+    limit: Optional[int] = None,
+    current_user: dependencies.Principal = Depends(dependencies.get_current_user)
+):
+    """
+    Потоковая выгрузка распределения STE по карточкам (ste_id -> card_id), по возрастанию ste_id.
+    С since/after_id в выгрузку попадают и отвязанные STE (card_id = null).
+    """
+    return export.stream_export(export.assignments_query(since, after_id, limit), "assignments", format)
+
+@app.get("/api/changes", response_model=schemas.ChangesResponse)
+def get_changes(
+    since: int = 0,
+    limit: int = 1000,
+    entity: Optional[str] = None,
+    db: Session = Depends(database.get_db),
+    current_user: dependencies.Principal = Depends(dependencies.get_current_user)
+):
+    """
+    Изменения STE и карточек после курсора since (seq), по порядку.
+    Для синхронизации: повторять с since = next, пока has_more.
+    410 - курсор старше начала журнала (записи удалены очисткой), нужна полная выгрузка.
+    """
+    if entity is not None and entity not in changes.ENTITIES:
+        raise HTTPException(status_code=400, detail=f"entity must be one of: {', '.join(changes.ENTITIES)}")
+    oldest = changes.oldest_cursor(db)
+    if since < oldest:
+        raise HTTPException(status_code=410, detail={"msg": "Cursor is older than the change log", "since": oldest})
+    limit = max(1, min(limit, 10000))
+    rows = changes.get_changes(db, since, limit + 1, entity)
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    return {
+        "changes": [row._asdict() for row in rows],
+        "next": rows[-1].seq if rows else since,
+        "has_more": has_more,
+    }
+
 
 # --- 6. API: Reaggregate (ML Pipeline) ---
 
 @app.post("/api/admin/reaggregate", response_model=schemas.ReaggregateResponse)
 def reaggregate_stes(
     request: schemas.ReaggregateRequest,
+    background_tasks: BackgroundTasks,
     db: Session = Depends(database.get_db),
-    current_user: models.User = Depends(dependencies.get_current_user)
+    current_user: dependencies.Principal = Depends(dependencies.get_current_user)
 ):
     """
     Запустить ML кластеризацию для указанных STE.
     Переагрегирует товары и обновляет их card_id.
     """
-    from . import ml_insert
+    from . import card_metrics, ml_insert, neighbors
     
     if not request.ste_ids:
         raise HTTPException(status_code=400, detail="ste_ids cannot be empty")
     
     result = ml_insert.run_ml_pipeline(db, request.ste_ids)
+    if result["status"] == "success":
+        background_tasks.add_task(neighbors.refresh_neighbors_task, request.ste_ids)
+        background_tasks.add_task(card_metrics.refresh_card_metrics_task, result["touched_card_ids"])
     
     return result
 
 
 @app.post("/api/admin/reaggregate/all", response_model=schemas.ReaggregateResponse)
 def reaggregate_all_stes(
+    background_tasks: BackgroundTasks,
     db: Session = Depends(database.get_db),
-    current_user: models.User = Depends(dependencies.get_current_user)
+    current_user: dependencies.Principal = Depends(dependencies.get_current_user)
 ):
     """
     Запустить ML кластеризацию для всех STE.
+    Граф соседей здесь не перестраивается: это офлайн задача
+    (python -m app.neighbors).
     """
-    from . import ml_insert
+    from . import card_metrics, ml_insert
     
     result = ml_insert.run_ml_pipeline(db)
+    if result["status"] == "success":
+        background_tasks.add_task(card_metrics.refresh_card_metrics_task)
     
-    return result
\ No newline at end of file
+    return result
+
+
+@app.post("/api/admin/reaggregate/disputed", response_model=schemas.ReaggregateResponse)
+def reaggregate_disputed_cards(
+    request: schemas.DisputedReaggregateRequest,
+    background_tasks: BackgroundTasks,
+    db: Session = Depends(database.get_db),
+    current_user: dependencies.Principal = Depends(dependencies.get_current_user)
+):
+    """
+    Переагрегировать только спорные карточки (много оценок score=0).
+    Оценки используются как ограничения must-link / cannot-link.
+    """
+    from . import card_metrics, feedback_recluster
+    
+    if request.threshold is not None and not 0 < request.threshold <= 1:
+        raise HTTPException(status_code=400, detail="threshold must be in (0, 1]")
+    
+    result = feedback_recluster.run_feedback_pipeline(db, request.threshold, request.min_votes)
+    if result["status"] == "success":
+        background_tasks.add_task(card_metrics.refresh_card_metrics_task, result["touched_card_ids"])
+    
+    return result
+
+
+# --- 7. API: Service (Эксплуатация) ---
+
+@app.get("/api/health/live")
+def health_live():
+    """Процесс жив (без обращения к БД)."""
+    return {"status": "ok"}
+
+@app.get("/api/health/ready")
+def health_ready():
+    """Готовность: схема создана, прогрев завершён, БД доступна. Иначе 503."""
+    report = lifecycle.state.report()
+    report["database"] = lifecycle.check_database()
+    ready = report["ready"] and report["database"]
+    return JSONResponse(status_code=200 if ready else 503, content=report)
+
+@app.get("/api/admin/db/pool")
+def get_db_pool_status(
+    current_user: dependencies.Principal = Depends(dependencies.get_current_user)
+):
+    """Загрузка пулов соединений этого воркера и время ожидания соединения."""
+    return database.pool_status()
+
+@app.get("/metrics", include_in_schema=False)
+def get_metrics():
+    """Метрики в формате Prometheus (все воркеры, если задан PROMETHEUS_MULTIPROC_DIR)."""
+    if not metrics.METRICS_ENABLED:
+        raise HTTPException(status_code=404, detail="Metrics are disabled")
+    body, content_type = metrics.render()
+    return Response(content=body, media_type=content_type)
+
+@app.get("/api/admin/profiles", response_model=List[str])
+def list_profiles(
+    current_user: dependencies.Principal = Depends(dependencies.get_current_user)
+):
+    """Профили запросов этого контейнера (новые первыми). Включаются PROFILE_ENABLED."""
+    if not current_user.is_admin:
+        raise HTTPException(status_code=403, detail="Admin only")
+    return sorted(profiling.list_profiles(), reverse=True)
+
+@app.get("/api/admin/profiles/{name}")
+def get_profile(
+    name: str,
+    current_user: dependencies.Principal = Depends(dependencies.get_current_user)
+):
+    """Collapsed стеки профиля (flamegraph.pl, speedscope)."""
+    if not current_user.is_admin:
+        raise HTTPException(status_code=403, detail="Admin only")
+    path = profiling.profile_path(name)
+    if path is None:
+        raise HTTPException(status_code=404, detail="Profile not found")
+    return FileResponse(path, media_type="text/plain; charset=utf-8", filename=name)
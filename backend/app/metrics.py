@@ -0,0 +1,258 @@
+"""
+Метрики в формате Prometheus (/metrics).
+
+- задержка запросов по шаблону маршрута (не по сырому пути - иначе
+  кардинальность растёт с числом id)
+- число SQL запросов и время в БД на запрос: события движков SQLAlchemy
+  (единственная пара хуков на курсор, она же питает лог медленных SQL и
+  детектор N+1 в profiling.py) пишут в статистику текущего запроса (contextvar, который видят и
+  потоки threadpool, и async сессии). Запрос считается до отправки
+  последней части тела: BackgroundTasks выполняются позже и не попадают
+  ни в задержку, ни в SQL статистику запроса
+- fuzzy поиск: сколько кандидатов скорилось и сколько прошло порог
+- попадания кешей (HTTP 304, кеш пользователей авторизации)
+- строки импорта, тайминги стадий ML пайплайна
+
+При нескольких воркерах uvicorn каждый процесс пишет свои значения в
+PROMETHEUS_MULTIPROC_DIR, /metrics собирает их со всех воркеров.
+Без этой переменной отдаются метрики только текущего процесса.
+"""
+import os
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Optional
+
+from prometheus_client import CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Histogram, generate_latest
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from . import profiling
+
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "1") == "1"
+MULTIPROC_DIR = os.getenv("PROMETHEUS_MULTIPROC_DIR")
+
+REQUEST_LATENCY = Histogram(
+    "http_request_duration_seconds", "Время обработки запроса",
+    ["method", "route", "status"],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30),
+)
+REQUEST_DB_QUERIES = Histogram(
+    "http_request_db_queries", "Число SQL запросов на HTTP запрос",
+    ["route"],
+    buckets=(0, 1, 2, 3, 5, 8, 13, 21, 50, 100, 250, 1000),
+)
+REQUEST_DB_SECONDS = Histogram(
+    "http_request_db_seconds", "Суммарное время SQL запросов на HTTP запрос",
+    ["route"],
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10),
+)
+DB_QUERY_SECONDS = Histogram(
+    "db_query_duration_seconds", "Время одного SQL запроса",
+    buckets=(0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 5),
+)
+FUZZY_CANDIDATES = Histogram(
+    "fuzzy_candidates", "Число кандидатов, переданных в fuzzy скоринг",
+    buckets=(10, 100, 1000, 10000, 50000, 100000, 250000, 500000, 1000000),
+)
+FUZZY_MATCHES = Histogram(
+    "fuzzy_matches", "Число кандидатов, прошедших порог fuzzy скоринга",
+    buckets=(0, 1, 10, 100, 1000, 10000, 100000),
+)
+FUZZY_SECONDS = Histogram(
+    "fuzzy_scoring_seconds", "Время fuzzy скоринга",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5),
+)
+CACHE_REQUESTS = Counter(
+    "cache_requests_total", "Обращения к кешам по результату (hit / miss / bypass)",
+    ["cache", "result"],
+)
+IMPORT_ROWS = Counter(
+    "import_rows_total", "Строки импорта STE",
+    ["source", "op"],
+)
+IMPORT_SECONDS = Histogram(
+    "import_duration_seconds", "Время импорта файла STE",
+    ["source"],
+    buckets=(0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600),
+)
+PIPELINE_STAGE_SECONDS = Histogram(
+    "ml_stage_duration_seconds", "Время стадий ML переагрегации",
+    ["pipeline", "stage"],
+    buckets=(0.01, 0.05, 0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800),
+)
+
+
+class RequestStats:
+    """SQL статистика одного HTTP запроса."""
+
+    __slots__ = ("queries", "db_seconds", "finished")
+
+    def __init__(self):
+        self.queries = 0
+        self.db_seconds = 0.0
+        # Ответ отправлен: дальше SQL фоновых задач, не запроса
+        self.finished = False
+
+
+_request_stats: ContextVar[Optional[RequestStats]] = ContextVar("request_stats", default=None)
+
+
+def current_request() -> Optional[RequestStats]:
+    return _request_stats.get()
+
+
+# Все движки, включая sync_engine асинхронного (он создаётся лениво)
+@event.listens_for(Engine, "before_cursor_execute")
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("metrics_query_start", []).append(time.perf_counter())
+
+
+def _finish_query(conn, statement: str) -> None:
+    starts = conn.info.get("metrics_query_start")
+    if not starts:
+        return
+    elapsed = time.perf_counter() - starts.pop()
+    DB_QUERY_SECONDS.observe(elapsed)
+    stats = _request_stats.get()
+    if stats is not None and not stats.finished:
+        stats.queries += 1
+        stats.db_seconds += elapsed
+    profiling.observe_query(statement, elapsed)
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    _finish_query(conn, statement)
+
+
+@event.listens_for(Engine, "handle_error")
+def _handle_error(context):
+    # after_cursor_execute для упавшего запроса не вызывается - снимаем его старт здесь
+    if context.connection is not None and context.execution_context is not None:
+        _finish_query(context.connection, context.statement)
+
+
+def observe_cache(cache: str, result: str) -> None:
+    CACHE_REQUESTS.labels(cache, result).inc()
+
+
+def observe_fuzzy(candidates: int, matches: int, seconds: float) -> None:
+    FUZZY_CANDIDATES.observe(candidates)
+    FUZZY_MATCHES.observe(matches)
+    FUZZY_SECONDS.observe(seconds)
+
+
+def observe_import(source: str, created: int, updated: int, seconds: float) -> None:
+    IMPORT_ROWS.labels(source, "created").inc(created)
+    IMPORT_ROWS.labels(source, "updated").inc(updated)
+    IMPORT_SECONDS.labels(source).observe(seconds)
+
+
+class StageTimer:
+    """Тайминги стадий пайплайна: в гистограмму и в словарь для лога / ответа."""
+
+    def __init__(self, pipeline: str):
+        self.pipeline = pipeline
+        self.timings = {}
+
+    def add(self, stage: str, seconds: float) -> None:
+        PIPELINE_STAGE_SECONDS.labels(self.pipeline, stage).observe(seconds)
+        self.timings[stage] = round(self.timings.get(stage, 0.0) + seconds, 3)
+
+    @contextmanager
+    def stage(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+
+# Сколько путей держать в кеше шаблонов маршрутов (ответы без scope["route"])
+_ROUTE_CACHE_SIZE = 4096
+
+
+def _match_route(scope) -> str:
+    """Поиск шаблона пути по таблице маршрутов."""
+    from starlette.routing import Match
+
+    for candidate in scope["app"].router.routes:
+        match, _ = candidate.matches(scope)
+        if match == Match.FULL:
+            return getattr(candidate, "path", None) or "unmatched"
+    return "unmatched"
+
+
+class MetricsMiddleware:
+    """ASGI middleware: задержка и SQL статистика каждого HTTP запроса."""
+
+    def __init__(self, app):
+        self.app = app
+        # (метод, путь) -> шаблон маршрута для ответов до роутера (304 из кеша)
+        self._routes = {}
+
+    def _route_label(self, scope) -> str:
+        route = scope.get("route")
+        if route is not None:
+            return getattr(route, "path", None) or "unmatched"
+        if "app" not in scope:
+            return "unmatched"
+        key = (scope["method"], scope["path"])
+        label = self._routes.get(key)
+        if label is None:
+            label = _match_route(scope)
+            if len(self._routes) >= _ROUTE_CACHE_SIZE:
+                self._routes.clear()
+            self._routes[key] = label
+        return label
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not METRICS_ENABLED or scope["path"] == "/metrics":
+            await self.app(scope, receive, send)
+            return
+
+        status = 500
+        stats = RequestStats()
+        token = _request_stats.set(stats)
+        start = time.perf_counter()
+
+        def finish():
+            if stats.finished:
+                return
+            stats.finished = True
+            elapsed = time.perf_counter() - start
+            route = self._route_label(scope)
+            REQUEST_LATENCY.labels(scope["method"], route, str(status)).observe(elapsed)
+            REQUEST_DB_QUERIES.labels(route).observe(stats.queries)
+            REQUEST_DB_SECONDS.labels(route).observe(stats.db_seconds)
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+            if message["type"] == "http.response.body" and not message.get("more_body", False):
+                # Ответ ушёл клиенту; BackgroundTasks запускаются после этого
+                finish()
+                _request_stats.set(None)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            # Исключение до отправки тела - считаем запрос здесь
+            finish()
+            _request_stats.reset(token)
+
+
+def render() -> tuple:
+    """(тело, content-type) для /metrics."""
+    if MULTIPROC_DIR:
+        from prometheus_client import multiprocess
+
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry), CONTENT_TYPE_LATEST
+    from prometheus_client import REGISTRY
+
+    return generate_latest(REGISTRY), CONTENT_TYPE_LATEST
@@ -0,0 +1,300 @@
+"""
+Версионированные миграции схемы.
+
+Применённые версии хранятся в таблице schema_migrations. Каждая миграция
+выполняется в своей транзакции; на PostgreSQL параллельный запуск из
+нескольких воркеров сериализуется advisory lock'ом.
+
+    python -m app.migrations                # применить недостающие
+    python -m app.migrations --check-plans  # проверить, что горячие запросы идут по индексам
+"""
+import argparse
+import json
+import logging
+import sys
+from typing import Callable, List, Tuple
+
+from sqlalchemy import Column, DateTime, Integer, MetaData, String, Table, func, inspect, select, text
+from sqlalchemy.engine import Connection, Engine
+
+from . import database, models
+
+logger = logging.getLogger(__name__)
+
+# Произвольный ключ для pg_advisory_xact_lock
+_LOCK_KEY = 7_340_041
+
+_meta = MetaData()
+schema_migrations = Table(
+    "schema_migrations",
+    _meta,
+    Column("version", Integer, primary_key=True),
+    Column("name", String, nullable=False),
+    Column("applied_at", DateTime(timezone=True), server_default=func.now()),
+)
+
+
+def _is_postgres(conn: Connection) -> bool:
+    return conn.dialect.name == "postgresql"
+
+
+def _baseline(conn: Connection) -> None:
+    """Таблицы по моделям (для существующих БД - только недостающие)."""
+    models.Base.metadata.create_all(bind=conn)
+
+
+def _stes_card_id_index(conn: Connection) -> None:
+    """Загрузка STE карточки, удаление карточки, реагрегация - все фильтруют по card_id."""
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_stes_card_id ON stes (card_id)"))
+
+
+def _feedback_unique_vote(conn: Connection) -> None:
+    """Один голос пользователя за пару (карточка, STE): нужно для ON CONFLICT в /api/rating."""
+    # Из дублей оставляем последнюю оценку
+    conn.execute(text(
+        "DELETE FROM feedbacks WHERE user_id IS NOT NULL AND id NOT IN ("
+        " SELECT max_id FROM (SELECT MAX(id) AS max_id FROM feedbacks"
+        " WHERE user_id IS NOT NULL GROUP BY card_id, ste_id, user_id) AS latest)"
+    ))
+    conn.execute(text(
+        "CREATE UNIQUE INDEX IF NOT EXISTS ux_feedbacks_card_ste_user ON feedbacks (card_id, ste_id, user_id)"
+    ))
+
+
+def _neighbors_reverse_index(conn: Connection) -> None:
+    """Инкрементальное обновление графа удаляет рёбра по neighbor_id."""
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_ste_neighbors_neighbor_id ON ste_neighbors (neighbor_id)"))
+
+
+def _trigram_indexes(conn: Connection) -> None:
+    """GIN индексы pg_trgm под ILIKE '%q%' в поиске (только PostgreSQL)."""
+    if not _is_postgres(conn):
+        return
+    conn.execute(text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+    for column in ("name", "model_name", "manufacturer"):
+        conn.execute(text(
+            f"CREATE INDEX IF NOT EXISTS ix_stes_{column}_trgm ON stes USING gin ({column} gin_trgm_ops)"
+        ))
+
+
+def _add_column(conn: Connection, table: str, column: str, ddl: str) -> None:
+    """ALTER TABLE ADD COLUMN, если колонки ещё нет (baseline мог её создать)."""
+    if column not in {c["name"] for c in inspect(conn).get_columns(table)}:
+        conn.execute(text(f"ALTER TABLE {table} ADD COLUMN {column} {ddl}"))
+
+
+def _timestamp_column(conn: Connection, table: str, column: str) -> None:
+    """
+    Колонка времени изменения: добавляется без значения, заполняется из
+    created_at, затем получает DEFAULT now() (на PostgreSQL; SQLite не умеет
+    менять DEFAULT колонки - там значение подставляет default модели).
+    """
+    _add_column(conn, table, column, "TIMESTAMP WITH TIME ZONE")
+    conn.execute(text(
+        f"UPDATE {table} SET {column} = COALESCE(created_at, CURRENT_TIMESTAMP) WHERE {column} IS NULL"
+    ))
+    if _is_postgres(conn):
+        conn.execute(text(f"ALTER TABLE {table} ALTER COLUMN {column} SET DEFAULT now()"))
+
+
+def _card_feedback_aggregates(conn: Connection) -> None:
+    """Счётчики оценок на карточке вместо AVG по feedbacks на каждый запрос."""
+    _add_column(conn, "cards", "feedback_count", "INTEGER NOT NULL DEFAULT 0")
+    _add_column(conn, "cards", "feedback_positive", "INTEGER NOT NULL DEFAULT 0")
+    conn.execute(text(
+        "UPDATE cards SET"
+        " feedback_count = (SELECT COUNT(*) FROM feedbacks WHERE feedbacks.card_id = cards.id),"
+        " feedback_positive = (SELECT COALESCE(SUM(score), 0) FROM feedbacks WHERE feedbacks.card_id = cards.id)"
+    ))
+
+
+def _change_tracking(conn: Connection) -> None:
+    """updated_at/version на stes и cards + журнал изменений."""
+    for table in ("stes", "cards"):
+        _timestamp_column(conn, table, "updated_at")
+        _add_column(conn, table, "version", "INTEGER NOT NULL DEFAULT 1")
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_stes_updated_at ON stes (updated_at)"))
+    models.ChangeLog.__table__.create(bind=conn, checkfirst=True)
+
+
+def _card_reclustered_at(conn: Connection) -> None:
+    """Время переагрегации спорной карточки (старые оценки её больше не делают спорной)."""
+    _add_column(conn, "cards", "reclustered_at", "TIMESTAMP WITH TIME ZONE")
+
+
+def _feedback_updated_at(conn: Connection) -> None:
+    """Время последнего голоса: повторная оценка меняет score без новой строки."""
+    _timestamp_column(conn, "feedbacks", "updated_at")
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_feedbacks_updated_at ON feedbacks (updated_at)"))
+
+
+def _change_log_compaction(conn: Connection) -> None:
+    """BIGINT курсор журнала и индексы под очистку по возрасту и компакцию."""
+    if _is_postgres(conn):
+        conn.execute(text("ALTER TABLE change_log ALTER COLUMN seq TYPE BIGINT"))
+        sequence = conn.execute(text("SELECT pg_get_serial_sequence('change_log', 'seq')")).scalar()
+        if sequence:
+            conn.execute(text(f"ALTER SEQUENCE {sequence} AS BIGINT"))
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_change_log_changed_at ON change_log (changed_at)"))
+    conn.execute(text(
+        "CREATE INDEX IF NOT EXISTS ix_change_log_entity_seq ON change_log (entity, entity_id, seq)"
+    ))
+
+
+def _card_metrics_updated_at_index(conn: Connection) -> None:
+    """Поколение метрик для ETag каталога - MAX(updated_at) по индексу."""
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_card_metrics_updated_at ON card_metrics (updated_at)"))
+
+
+def _change_tracking_defaults(conn: Connection) -> None:
+    """БД, где change_tracking добавил updated_at без DEFAULT: заполняем NULL и ставим DEFAULT."""
+    for table in ("stes", "cards"):
+        _timestamp_column(conn, table, "updated_at")
+
+
+def _feedback_updated_at_default(conn: Connection) -> None:
+    """Голоса, записанные с updated_at = NULL (не было DEFAULT), и сам DEFAULT."""
+    _timestamp_column(conn, "feedbacks", "updated_at")
+
+
+# (версия, имя, функция). Новые миграции - только в конец списка.
+MIGRATIONS: List[Tuple[int, str, Callable[[Connection], None]]] = [
+    (1, "baseline", _baseline),
+    (2, "stes_card_id_index", _stes_card_id_index),
+    (3, "feedback_unique_vote", _feedback_unique_vote),
+    (4, "neighbors_reverse_index", _neighbors_reverse_index),
+    (5, "stes_trigram_indexes", _trigram_indexes),
+    (6, "card_feedback_aggregates", _card_feedback_aggregates),
+    (7, "change_tracking", _change_tracking),
+    (8, "card_reclustered_at", _card_reclustered_at),
+    (9, "feedback_updated_at", _feedback_updated_at),
+    (10, "change_log_compaction", _change_log_compaction),
+    (11, "card_metrics_updated_at_index", _card_metrics_updated_at_index),
+    (12, "change_tracking_defaults", _change_tracking_defaults),
+    (13, "feedback_updated_at_default", _feedback_updated_at_default),
+]
+
+
+def applied_versions(conn: Connection) -> set:
+    return {row[0] for row in conn.execute(select(schema_migrations.c.version))}
+
+
+def migrate(engine: Engine = None) -> List[str]:
+    """Применяет недостающие миграции. Возвращает имена применённых."""
+    engine = engine or database.engine
+    _meta.create_all(bind=engine)
+
+    applied = []
+    for version, name, step in MIGRATIONS:
+        with engine.begin() as conn:
+            if _is_postgres(conn):
+                conn.execute(text("SELECT pg_advisory_xact_lock(:key)"), {"key": _LOCK_KEY})
+            # Проверяем под блокировкой: другой воркер мог успеть раньше
+            if version in applied_versions(conn):
+                continue
+            step(conn)
+            conn.execute(schema_migrations.insert().values(version=version, name=name))
+        applied.append(name)
+        logger.info(f"Migration {version} ({name}) applied")
+    return applied
+
+
+# --- Проверка планов горячих запросов ---
+
+# (описание, SQL, параметры, ожидаемый индекс (None - любой), только для PostgreSQL)
+HOT_QUERIES = [
+    ("card STE list", "SELECT id FROM stes WHERE card_id = :id", {"id": 1}, "ix_stes_card_id", False),
+    ("import lookup by external_id", "SELECT id FROM stes WHERE external_id IN (:a, :b)", {"a": 1, "b": 2}, None, False),
+    (
+        "existing vote lookup",
+        "SELECT id FROM feedbacks WHERE card_id = :c AND ste_id = :s AND user_id = :u",
+        {"c": 1, "s": 1, "u": 1},
+        "ux_feedbacks_card_ste_user",
+        False,
+    ),
+    ("neighbor reverse edges", "SELECT ste_id FROM ste_neighbors WHERE neighbor_id = :id", {"id": 1},
+     "ix_ste_neighbors_neighbor_id", False),
+    ("search ILIKE name", "SELECT id FROM stes WHERE name ILIKE :q", {"q": "%бумага%"}, "ix_stes_name_trgm", True),
+    ("search ILIKE model", "SELECT id FROM stes WHERE model_name ILIKE :q", {"q": "%x-200%"},
+     "ix_stes_model_name_trgm", True),
+    ("search ILIKE manufacturer", "SELECT id FROM stes WHERE manufacturer ILIKE :q", {"q": "%комус%"},
+     "ix_stes_manufacturer_trgm", True),
+]
+
+
+def _plan_indexes(conn: Connection, sql: str, params: dict) -> Tuple[set, str]:
+    """Индексы, которые планировщик использует в запросе, и сам план."""
+    if _is_postgres(conn):
+        plan = conn.execute(text(f"EXPLAIN (FORMAT JSON) {sql}"), params).scalar()
+        plan = json.loads(plan) if isinstance(plan, str) else plan
+        found = set()
+
+        def walk(node):
+            if "Index Name" in node:
+                found.add(node["Index Name"])
+            for child in node.get("Plans", []):
+                walk(child)
+
+        walk(plan[0]["Plan"])
+        return found, json.dumps(plan[0]["Plan"], ensure_ascii=False)
+
+    rows = conn.execute(text(f"EXPLAIN QUERY PLAN {sql}"), params).all()
+    details = [row[-1] for row in rows]
+    found = set()
+    for detail in details:
+        for marker in ("USING INDEX ", "USING COVERING INDEX "):
+            if marker in detail:
+                found.add(detail.split(marker, 1)[1].split(" ")[0])
+    return found, "; ".join(details)
+
+
+def check_plans(engine: Engine = None) -> List[dict]:
+    """
+    EXPLAIN горячих запросов. На маленькой таблице PostgreSQL предпочтёт
+    seq scan, поэтому он отключается на время проверки: проверяем, что
+    подходящий индекс есть и планировщик может его использовать.
+    """
+    engine = engine or database.engine
+    results = []
+    with engine.connect() as conn:
+        postgres = _is_postgres(conn)
+        if postgres:
+            conn.execute(text("SET LOCAL enable_seqscan = off"))
+        for description, sql, params, expected, postgres_only in HOT_QUERIES:
+            if postgres_only and not postgres:
+                results.append({"query": description, "status": "skipped"})
+                continue
+            found, plan = _plan_indexes(conn, sql, params)
+            ok = expected in found if expected else bool(found)
+            results.append({
+                "query": description,
+                "status": "ok" if ok else "missing",
+                "expected": expected,
+                "used": sorted(found),
+                "plan": plan,
+            })
+        conn.rollback()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--check-plans", action="store_true", help="Проверить планы горячих запросов")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    applied = migrate()
+    print(f"Applied migrations: {', '.join(applied) or 'none'}")
+
+    if args.check_plans:
+        failed = False
+        for result in check_plans():
+            print(f"[{result['status']:>7}] {result['query']}: {', '.join(result.get('used', [])) or '-'}")
+            if result["status"] == "missing":
+                failed = True
+                print(f"          plan: {result['plan']}")
+        sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,27 +1,39 @@
 import logging
 import os
-from typing import List, Optional
+import queue
+import threading
+import time
+from typing import Dict, Iterator, List, Optional, Tuple
 
 import hdbscan
+import numpy as np
 import pandas as pd
-from sentence_transformers import SentenceTransformer
-from sqlalchemy import update
+from sqlalchemy import func, select, update
 from sqlalchemy.orm import Session
 
-from . import models
+from . import blocking, changes, embedding_backend, embedding_service, embedding_store, metrics, models, representation
+from .curation import create_cards, retire_empty_cards
 
 logger = logging.getLogger(__name__)
 
 # Название модели (можно менять через env)
 MODEL_NAME = os.getenv('EMBEDDING_MODEL', 'paraphrase-multilingual-MiniLM-L12-v2')
 
+# MinHash/LSH блокинг перед кластеризацией (см. blocking.py)
+ML_BLOCKING = os.getenv('ML_BLOCKING', '1') == '1'
+# В блоках до такого размера разрешаем один общий кластер (HDBSCAN иначе отдаёт их в шум)
+SINGLE_CLUSTER_MAX_BLOCK = 10
+
+# Размер порции при потоковом чтении STE из БД
+LOAD_CHUNK_SIZE = int(os.getenv('ML_LOAD_CHUNK_SIZE', 10000))
+
 # Кешируем модель, чтобы не загружать при каждом запросе
 _model_cache = None
 _model_load_error = None
 
 
-def get_embedding_model() -> SentenceTransformer:
-    """Ленивая загрузка и кеширование модели."""
+def get_embedding_model():
+    """Ленивая загрузка и кеширование модели (бэкенд задаётся EMBEDDING_BACKEND)."""
     global _model_cache, _model_load_error
     
     # Сбрасываем ошибку, чтобы можно было повторить попытку
@@ -31,10 +43,17 @@ def get_embedding_model() -> SentenceTransformer:
     try:
         logger.info(f"Loading embedding model: {MODEL_NAME}")
         logger.info(f"HF_HOME: {os.getenv('HF_HOME', 'not set')}")
+        start = time.perf_counter()
+        
+        if embedding_service.SERVICE_SOCKET:
+            # Модель держит общий сервис эмбеддингов, воркер только шлёт тексты
+            logger.info(f"Using embedding service at {embedding_service.SERVICE_SOCKET}")
+            _model_cache = embedding_service.RemoteEncoder()
+            return _model_cache
         
         # Пробуем загрузить модель (из кэша или скачать)
-        _model_cache = SentenceTransformer(MODEL_NAME)
-        logger.info("Embedding model loaded successfully")
+        _model_cache = embedding_backend.load_encoder(MODEL_NAME)
+        logger.info(f"Embedding model loaded in {time.perf_counter() - start:.1f}s")
         return _model_cache
         
     except Exception as e:
@@ -53,57 +72,346 @@ def preload_model():
         return False
 
 
-def get_all_stes_from_db(db: Session, ste_ids: List[int] = None) -> pd.DataFrame:
-    """Оптимизированное получение данных из БД."""
-    # Базовый запрос
-    query = db.query(
+def save_embeddings(ids, embeddings, titles: List[str]) -> None:
+    """Сохраняет эмбеддинги названий в общее хранилище (ошибка записи не ломает пайплайн)."""
+    if not embedding_store.STORE_PATH:
+        return
+    try:
+        embedding_store.save_embeddings(ids, embeddings, hashes=embedding_store.text_hashes(titles))
+    except Exception as e:
+        logger.warning(f"Could not save embeddings to store: {e}")
+
+
+def encode_titles(titles: List[str]) -> np.ndarray:
+    """Кодирует названия моделью; одинаковые названия кодируются один раз."""
+    codes, unique = pd.factorize(pd.Series(titles, dtype=object))
+    encoded = get_embedding_model().encode(list(unique), show_progress_bar=False, batch_size=64)
+    return np.asarray(encoded, dtype=np.float32)[codes]
+
+
+def get_or_encode_embeddings(left_df: pd.DataFrame) -> np.ndarray:
+    """
+    Эмбеддинги для STE из left_df: берём из хранилища, кодируем моделью
+    только отсутствующие и те, чьё название изменилось с момента
+    кодирования (хеш названия не совпадает). Векторы возвращаются в
+    пространстве хранилища.
+    """
+    store = embedding_store.get_store() if embedding_store.STORE_PATH else None
+    ids = left_df['id'].to_numpy()
+    titles = left_df['title'].fillna('').tolist()
+    
+    if store is None or len(store) == 0:
+        embeddings = encode_titles(titles)
+        save_embeddings(ids, embeddings, titles)
+        return np.asarray(embeddings, dtype=np.float32)
+    
+    positions = store.positions(ids)
+    result = np.zeros((len(ids), store.dim), dtype=np.float32)
+    found = positions >= 0
+    if found.any():
+        # Переименованные STE (или векторы без хеша) кодируем заново
+        found[found] = store.hashes_at(positions[found]) == embedding_store.text_hashes(
+            [titles[i] for i in np.flatnonzero(found)]
+        )
+    if found.any():
+        result[found] = store.dequantize(positions[found])
+    missing = np.flatnonzero(~found)
+    if len(missing):
+        encoded = encode_titles([titles[i] for i in missing])
+        result[missing] = store.project(encoded)
+        save_embeddings(ids[missing], encoded, [titles[i] for i in missing])
+    return result
+
+
+def _ste_query(ste_ids: List[int] = None, with_features: bool = False):
+    """SELECT только нужных пайплайну колонок."""
+    columns = [
         models.STE.id,
         models.STE.card_id,
         models.STE.name,
-        models.STE.characteristics
-    )
-    
-    # Фильтруем по ID, если указаны
-    if ste_ids:
+        models.STE.manufacturer,
+        models.STE.model_name,
+        models.STE.category_id,
+    ]
+    if with_features:
+        columns.append(models.STE.characteristics)
+    stmt = select(*columns).order_by(models.STE.id)
+    if ste_ids is not None:
+        stmt = stmt.where(models.STE.id.in_(ste_ids))
+    return stmt
+
+
+def iter_ste_chunks(db: Session, ste_ids: List[int] = None, with_features: bool = False,
+                    chunk_size: int = LOAD_CHUNK_SIZE) -> Iterator[list]:
+    """Читает STE порциями через серверный курсор (без материализации всей таблицы)."""
+    stmt = _ste_query(ste_ids, with_features).execution_options(stream_results=True, yield_per=chunk_size)
+    result = db.execute(stmt)
+    try:
+        for rows in result.partitions(chunk_size):
+            yield rows
+    finally:
+        result.close()
+
+
+class _SteColumns:
+    """Преаллоцированные колонки под результат загрузки."""
+
+    def __init__(self, size: int, with_features: bool):
+        self.size = 0
+        self.ids = np.empty(size, dtype=np.int64)
+        self.card_ids = np.zeros(size, dtype=np.int64)
+        self.titles = np.empty(size, dtype=object)
+        self.manufacturers = np.empty(size, dtype=object)
+        self.model_names = np.empty(size, dtype=object)
+        self.category_ids = np.full(size, -1, dtype=np.int64)
+        self.features = np.empty(size, dtype=object) if with_features else None
+
+    def _grow(self, extra: int) -> None:
+        # Между COUNT и чтением могли добавиться строки
+        new_size = max(self.size + extra, len(self.ids) * 2)
+        for name in ('ids', 'card_ids', 'titles', 'manufacturers', 'model_names', 'category_ids', 'features'):
+            column = getattr(self, name)
+            if column is not None:
+                grown = np.zeros(new_size, dtype=column.dtype) if column.dtype != object else np.empty(new_size, dtype=object)
+                grown[:self.size] = column[:self.size]
+                setattr(self, name, grown)
+
+    def append(self, rows: list) -> slice:
+        if self.size + len(rows) > len(self.ids):
+            self._grow(len(rows))
+        start, end = self.size, self.size + len(rows)
+        for i, row in enumerate(rows, start):
+            self.ids[i] = row[0]
+            self.card_ids[i] = row[1] or 0
+            self.titles[i] = row[2] or ''
+            self.manufacturers[i] = row[3]
+            self.model_names[i] = row[4]
+            self.category_ids[i] = row[5] if row[5] is not None else -1
+            if self.features is not None:
+                self.features[i] = row[6] or {}
+        self.size = end
+        return slice(start, end)
+
+    def to_frame(self) -> pd.DataFrame:
+        n = self.size
+        data = {
+            'id': self.ids[:n],
+            'card_id': self.card_ids[:n],
+            'title': self.titles[:n],
+            'manufacturer': self.manufacturers[:n],
+            'model_name': self.model_names[:n],
+            'category_id': self.category_ids[:n],
+        }
+        if self.features is not None:
+            data['features'] = self.features[:n]
+        return pd.DataFrame(data)
+
+
+def _count_stes(db: Session, ste_ids: List[int] = None) -> int:
+    query = db.query(func.count(models.STE.id))
+    if ste_ids is not None:
         query = query.filter(models.STE.id.in_(ste_ids))
+    return query.scalar() or 0
+
+
+def _needs_features() -> bool:
+    return blocking.BLOCKING_USE_CHARACTERISTICS or representation.needs_characteristics()
+
+
+def get_all_stes_from_db(db: Session, ste_ids: List[int] = None, with_features: bool = None,
+                         total: Optional[int] = None) -> pd.DataFrame:
+    """
+    Потоковая загрузка STE в колонки (id, card_id, title, manufacturer, model_name,
+    category_id и features, если они нужны блокингу/признакам).
+    ``ste_ids`` None - все STE, пустой список - ни одной.
+    ``total`` - уже посчитанное число строк (иначе делается COUNT).
+    """
+    if with_features is None:
+        with_features = _needs_features()
+    columns = _SteColumns(_count_stes(db, ste_ids) if total is None else total, with_features)
+    for rows in iter_ste_chunks(db, ste_ids, with_features):
+        columns.append(rows)
+    return columns.to_frame()
+
+
+def load_and_encode(db: Session, ste_ids: List[int] = None,
+                    timer: Optional[metrics.StageTimer] = None,
+                    total: Optional[int] = None) -> Tuple[pd.DataFrame, np.ndarray]:
+    """
+    Загрузка с параллельным кодированием: пока фоновый поток читает следующую
+    порцию из БД, модель кодирует уже прочитанную. В ``timer`` стадия load -
+    время ожидания порций из БД, encode - время кодирования.
+    
+    Поток чтения работает в своей сессии (Session не потокобезопасна). Если
+    кодирование упало, поток останавливается и закрывает курсор до выхода.
+    """
+    if total is None:
+        total = _count_stes(db, ste_ids)
+    with_features = _needs_features()
+    columns = _SteColumns(total, with_features)
+    if total == 0:
+        return columns.to_frame(), np.zeros((0, 0), dtype=np.float32)
     
-    result = query.all()
+    model = get_embedding_model()
+    chunks = queue.Queue(maxsize=2)
+    stop = threading.Event()
+    done = object()
     
-    if not result:
-        return pd.DataFrame(columns=['id', 'card_id', 'title', 'features'])
+    def _put(item) -> bool:
+        # Очередь полна, пока потребитель кодирует; при остановке не ждём его
+        while not stop.is_set():
+            try:
+                chunks.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
     
-    # Создаем DataFrame напрямую из результата
-    df = pd.DataFrame(result, columns=['id', 'card_id', 'title', 'features'])
-    df['card_id'] = df['card_id'].fillna(0).astype(int)
-    df['features'] = df['features'].apply(lambda x: x or {})
+    def _reader():
+        with Session(bind=db.get_bind()) as reader_db:
+            rows_iter = iter_ste_chunks(reader_db, ste_ids, with_features)
+            try:
+                for rows in rows_iter:
+                    if not _put(rows):
+                        return
+            except Exception as e:
+                _put(e)
+                return
+            finally:
+                # Закрывает серверный курсор и до конца итерации
+                rows_iter.close()
+        _put(done)
     
-    return df
+    reader = threading.Thread(target=_reader, daemon=True)
+    reader.start()
+    
+    parts = []
+    waited = encoding = 0.0
+    try:
+        while True:
+            start = time.perf_counter()
+            rows = chunks.get()
+            waited += time.perf_counter() - start
+            if rows is done:
+                break
+            if isinstance(rows, Exception):
+                raise rows
+            chunk = columns.append(rows)
+            start = time.perf_counter()
+            parts.append(np.asarray(
+                model.encode(columns.titles[chunk].tolist(), show_progress_bar=False, batch_size=64),
+                dtype=np.float32
+            ))
+            encoding += time.perf_counter() - start
+    finally:
+        stop.set()
+        reader.join()
+    if timer is not None:
+        timer.add('load', waited)
+        timer.add('encode', encoding)
+    
+    embeddings = np.concatenate(parts) if parts else np.zeros((0, 0), dtype=np.float32)
+    return columns.to_frame(), embeddings
 
 
-def run_ml_clustering(left_df: pd.DataFrame) -> pd.DataFrame:
-    """Кластеризация с использованием кешированной модели."""
-    if left_df.empty:
-        return pd.DataFrame(columns=['id', 'title', 'features', 'cluster_id'])
+def cluster_embeddings(embeddings: np.ndarray, allow_single_cluster: bool = False) -> np.ndarray:
+    """HDBSCAN по эмбеддингам; для одного объекта - шум."""
+    if len(embeddings) < 2:
+        return np.full(len(embeddings), -1)
+    clusterer = hdbscan.HDBSCAN(min_cluster_size=2, min_samples=1, allow_single_cluster=allow_single_cluster)
+    return clusterer.fit_predict(embeddings)
+
+
+def run_blocked_clustering(left_df: pd.DataFrame, timer: Optional[metrics.StageTimer] = None) -> np.ndarray:
+    """
+    Кластеризация с MinHash/LSH блокингом: точные дубликаты схлопываются,
+    HDBSCAN запускается только для представителей внутри блоков.
+    Эмбеддинги нужны всем STE (хранилище читают граф соседей и метрики
+    карточек), поэтому берутся из хранилища или кодируются для всех строк,
+    включая одиночные блоки; одинаковые названия кодируются один раз.
+    """
+    timer = timer or metrics.StageTimer('reaggregate')
+    with timer.stage('block'):
+        blocks = blocking.build_blocks(left_df)
+    stats = blocking.block_stats(blocks)
+    logger.info(
+        f"Blocking: {stats['total']} STE -> {stats['representatives']} unique, "
+        f"{stats['blocks']} blocks, {stats['clustered']} go to clustering "
+        f"(largest block {stats['largest_block']})"
+    )
     
-    titles = left_df['title'].fillna('').tolist()
+    with timer.stage('encode'):
+        embeddings = get_or_encode_embeddings(left_df)
     
-    # Используем кешированную модель
-    model = get_embedding_model()
-    embeddings = model.encode(titles, show_progress_bar=False, batch_size=64)
+    labels = np.full(len(left_df), -1)
+    members = blocking.block_members(blocks)
+    if members:
+        next_label = 0
+        with timer.stage('cluster'):
+            for block in members:
+                block_embeddings = representation.build_representations(left_df.iloc[block], embeddings[block])
+                local = cluster_embeddings(block_embeddings, allow_single_cluster=len(block) <= SINGLE_CLUSTER_MAX_BLOCK)
+                clustered = local >= 0
+                labels[block[clustered]] = local[clustered] + next_label
+                next_label += local.max() + 1 if clustered.any() else 0
+    else:
+        next_label = 0
+    
+    # Дубликаты получают метку своего представителя; группа дубликатов без кластера - свой кластер
+    dup_group = blocks['dup_group'].to_numpy()
+    rep_positions = np.flatnonzero(blocks['is_representative'].to_numpy())
+    group_label = pd.Series(labels[rep_positions], index=dup_group[rep_positions])
+    group_size = pd.Series(dup_group).value_counts()
+    for group in group_size[group_size > 1].index:
+        if group_label[group] < 0:
+            group_label[group] = next_label
+            next_label += 1
+    return group_label.reindex(dup_group).to_numpy()
+
+
+def run_ml_clustering(left_df: pd.DataFrame, embeddings: Optional[np.ndarray] = None,
+                      timer: Optional[metrics.StageTimer] = None) -> pd.DataFrame:
+    """
+    Кластеризация с использованием кешированной модели.
+    ``embeddings`` - уже посчитанные эмбеддинги названий (см. ``load_and_encode``).
+    """
+    if left_df.empty:
+        return pd.DataFrame(columns=['id', 'title', 'cluster_id'])
     
-    clusterer = hdbscan.HDBSCAN(min_cluster_size=2, min_samples=1)
-    labels = clusterer.fit_predict(embeddings)
+    timer = timer or metrics.StageTimer('reaggregate')
+    if ML_BLOCKING:
+        labels = run_blocked_clustering(left_df, timer)
+    else:
+        with timer.stage('encode'):
+            if embeddings is None:
+                titles = left_df['title'].fillna('').tolist()
+                
+                # Используем кешированную модель
+                model = get_embedding_model()
+                embeddings = model.encode(titles, show_progress_bar=False, batch_size=64)
+            save_embeddings(left_df['id'].to_numpy(), embeddings, left_df['title'].fillna('').tolist())
+        
+        with timer.stage('cluster'):
+            labels = cluster_embeddings(representation.build_representations(left_df, embeddings))
     
-    df = left_df[['id', 'title', 'features']].copy()
+    df = left_df[['id', 'title']].copy()
     df['cluster_id'] = labels
     
     return df
 
 
 def merge_cluster_to_card(left_df: pd.DataFrame, right_df: pd.DataFrame) -> pd.DataFrame:
-    """Объединение результатов кластеризации."""
+    """
+    Объединение результатов кластеризации.
+
+    Сырые метки HDBSCAN кладутся в колонку ``cluster_id`` (шум = -1),
+    текущая привязка остаётся в ``card_id``. Перевод меток в id карточек
+    делает ``reconcile_clusters_to_cards``.
+    """
     if right_df.empty:
-        return left_df
+        merged_df = left_df.copy()
+        merged_df['cluster_id'] = -1
+        return merged_df
     
     # Делаем left join по id
     merged_df = left_df.merge(
@@ -111,26 +419,98 @@ def merge_cluster_to_card(left_df: pd.DataFrame, right_df: pd.DataFrame) -> pd.D
         on='id', 
         how='left'
     )
+    merged_df['cluster_id'] = merged_df['cluster_id'].fillna(-1).astype(int)
     
-    # Где cluster_id = -1 (шум), ставим 0
-    merged_df['cluster_id'] = merged_df['cluster_id'].replace(-1, 0)
+    return merged_df
+
+
+def match_clusters_to_cards(merged_df: pd.DataFrame) -> Dict[int, int]:
+    """
+    Сопоставляет новые кластеры существующим карточкам по максимальному
+    пересечению STE (жадно, один к одному).
+
+    Returns:
+        Словарь {cluster_id: card_id} для кластеров, которым нашлась карточка
+    """
+    clustered = merged_df[(merged_df['cluster_id'] >= 0) & (merged_df['card_id'] != 0)]
+    if clustered.empty:
+        return {}
     
-    # Обновляем card_id значениями из cluster_id
-    merged_df['card_id'] = merged_df['cluster_id'].fillna(merged_df['card_id']).astype(int)
+    overlap = (
+        clustered.groupby(['cluster_id', 'card_id'])
+        .size()
+        .reset_index(name='overlap')
+        # При равном пересечении предпочитаем меньший id - результат детерминирован
+        .sort_values(['overlap', 'cluster_id', 'card_id'], ascending=[False, True, True])
+    )
     
-    merged_df = merged_df.drop(columns=['cluster_id'])
+    mapping = {}
+    used_cards = set()
+    for cluster_id, card_id, _ in overlap.itertuples(index=False):
+        if cluster_id in mapping or card_id in used_cards:
+            continue
+        mapping[int(cluster_id)] = int(card_id)
+        used_cards.add(card_id)
     
-    return merged_df
+    return mapping
 
 
-def update_stes_in_db(db: Session, merged_df: pd.DataFrame, ste_ids: List[int] = None) -> int:
-    """Оптимизированное batch-обновление БД."""
+def reconcile_clusters_to_cards(db: Session, merged_df: pd.DataFrame) -> Tuple[pd.DataFrame, dict]:
+    """
+    Переводит метки кластеров в id карточек с минимальным числом изменений.
+
+    Кластер получает id карточки, с которой у него максимальное пересечение;
+    для оставшихся кластеров создаются новые карточки. Шум отвязывается от
+    карточки. Карточки, которые стали пустыми, удаляются после записи в БД
+    (см. ``run_ml_pipeline``).
+
+    Returns:
+        (DataFrame с новым card_id, статистика)
+    """
+    mapping = match_clusters_to_cards(merged_df)
+    
+    cluster_ids = sorted(int(c) for c in merged_df['cluster_id'].unique() if c >= 0)
+    unmatched = [c for c in cluster_ids if c not in mapping]
+    for cluster_id, card_id in zip(unmatched, create_cards(db, len(unmatched))):
+        mapping[cluster_id] = card_id
+    
+    old_card_ids = merged_df['card_id']
+    new_card_ids = merged_df['cluster_id'].map(mapping).fillna(0).astype(int)
+    
+    reconciled_df = merged_df.drop(columns=['cluster_id']).copy()
+    reconciled_df['card_id'] = new_card_ids
+    
+    # Сколько изменений было бы при записи сырых меток HDBSCAN
+    raw_labels = merged_df['cluster_id'].clip(lower=0)
+    naive_changes = int((raw_labels != old_card_ids).sum())
+    changes = int((new_card_ids != old_card_ids).sum())
+    
+    # Кандидаты на удаление: карточки, из которых ушли STE и которые не сопоставлены кластеру
+    reused = set(mapping.values())
+    orphaned = sorted(
+        int(c) for c in old_card_ids[(old_card_ids != new_card_ids) & (old_card_ids != 0)].unique()
+        if c not in reused
+    )
+    
+    stats = {
+        'changes': changes,
+        'naive_changes': naive_changes,
+        'churn_avoided': max(naive_changes - changes, 0),
+        'cards_reused': len(mapping) - len(unmatched),
+        'cards_created': len(unmatched),
+        'orphaned_card_ids': orphaned,
+    }
+    return reconciled_df, stats
+
+
+def update_stes_in_db(db: Session, merged_df: pd.DataFrame, ste_ids: List[int] = None, commit: bool = True) -> int:
+    """Оптимизированное batch-обновление БД. Пишет только изменившиеся card_id."""
     if merged_df.empty:
         return 0
     
     # Получаем текущие card_id из БД одним запросом
     query = db.query(models.STE.id, models.STE.card_id)
-    if ste_ids:
+    if ste_ids is not None:
         query = query.filter(models.STE.id.in_(ste_ids))
     
     current_data = query.all()
@@ -148,16 +528,14 @@ def update_stes_in_db(db: Session, merged_df: pd.DataFrame, ste_ids: List[int] =
     if not updates:
         return 0
     
-    # Batch update через executemany (значительно быстрее)
+    # Batch update по первичному ключу через executemany (значительно быстрее)
     for batch_start in range(0, len(updates), 500):
         batch = updates[batch_start:batch_start + 500]
-        for item in batch:
-            db.query(models.STE).filter(models.STE.id == item['id']).update(
-                {'card_id': item['card_id']}, 
-                synchronize_session=False
-            )
+        db.execute(update(models.STE), batch)
+    changes.record_changes(db, 'ste', [row['id'] for row in updates])
     
-    db.commit()
+    if commit:
+        db.commit()
     return len(updates)
 
 
@@ -172,19 +550,64 @@ def run_ml_pipeline(db: Session, ste_ids: List[int] = None) -> dict:
     Returns:
         Словарь с результатами
     """
-    left_df = get_all_stes_from_db(db, ste_ids)
-    
-    if left_df.empty:
+    embeddings = None
+    timer = metrics.StageTimer('reaggregate')
+    total = _count_stes(db, ste_ids)
+    if total == 0:
         return {"status": "no_data", "total": 0, "updated": 0}
-    
     try:
-        right_df = run_ml_clustering(left_df)
+        if ML_BLOCKING:
+            # Блокингу нужны все строки до кодирования
+            with timer.stage('load'):
+                left_df = get_all_stes_from_db(db, ste_ids, total=total)
+        else:
+            left_df, embeddings = load_and_encode(db, ste_ids, timer, total=total)
+        
+        if left_df.empty:
+            return {"status": "no_data", "total": 0, "updated": 0}
+        
+        right_df = run_ml_clustering(left_df, embeddings, timer)
     except RuntimeError as e:
         logger.error(f"ML clustering failed: {e}")
-        return {"status": "error", "total": len(left_df), "updated": 0, "error": str(e)}
+        return {"status": "error", "total": total, "updated": 0, "error": str(e)}
+    
+    return apply_clusters(db, left_df, right_df, ste_ids, timer)
+
+
+def apply_clusters(db: Session, left_df: pd.DataFrame, right_df: pd.DataFrame, ste_ids: List[int] = None,
+                   timer: Optional[metrics.StageTimer] = None) -> dict:
+    """Сопоставляет кластеры карточкам, пишет изменения в БД и удаляет опустевшие карточки."""
+    timer = timer or metrics.StageTimer('reaggregate')
+    with timer.stage('merge'):
+        merged_df = merge_cluster_to_card(left_df, right_df)
+        reconciled_df, stats = reconcile_clusters_to_cards(db, merged_df)
+    
+    # Карточки, чей состав мог измениться (для пересчёта метрик)
+    touched = merged_df['card_id'][merged_df['card_id'] != reconciled_df['card_id']]
+    touched = pd.concat([touched, reconciled_df['card_id'][merged_df['card_id'] != reconciled_df['card_id']]])
+    touched_card_ids = sorted(int(c) for c in touched.unique() if c != 0)
     
-    merged_df = merge_cluster_to_card(left_df, right_df)
+    with timer.stage('write'):
+        updated_count = update_stes_in_db(db, reconciled_df, ste_ids, commit=False)
+        cards_retired = retire_empty_cards(db, stats['orphaned_card_ids'])
+        db.commit()
     
-    updated_count = update_stes_in_db(db, merged_df, ste_ids)
+    logger.info(
+        f"Reconciliation: {updated_count} card_id changes "
+        f"(raw labels would give {stats['naive_changes']}), "
+        f"{stats['cards_reused']} cards reused, {stats['cards_created']} created, "
+        f"{cards_retired} retired"
+    )
+    logger.info(f"Pipeline stages ({timer.pipeline}): {timer.timings}")
     
-    return {"status": "success", "total": len(left_df), "updated": updated_count}
\ No newline at end of file
+    return {
+        "status": "success",
+        "total": len(left_df),
+        "updated": updated_count,
+        "churn_avoided": stats['churn_avoided'],
+        "cards_reused": stats['cards_reused'],
+        "cards_created": stats['cards_created'],
+        "cards_retired": cards_retired,
+        "touched_card_ids": touched_card_ids,
+        "stage_timings": timer.timings,
+    }
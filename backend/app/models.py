@@ -1,8 +1,8 @@
-from sqlalchemy import Column, Integer, String, Boolean, ForeignKey, JSON, Float, Text, DateTime
+from sqlalchemy import BigInteger, Column, Integer, String, Boolean, ForeignKey, JSON, Float, Text, DateTime, Index
 from sqlalchemy.sql import func
-from sqlalchemy.orm import relationship, object_session
+from sqlalchemy.orm import relationship
 from sqlalchemy.ext.hybrid import hybrid_property
-from sqlalchemy import select
+from sqlalchemy import case, cast
 from .database import Base
 
 class User(Base):
@@ -16,6 +16,8 @@ class User(Base):
     feedbacks = relationship("Feedback", back_populates="user")
 
 class STE(Base):
+    # Индексы и схема меняются миграциями (migrations.py); GIN pg_trgm индексы
+    # на name/model_name/manufacturer создаются только там (нужны под ILIKE)
     __tablename__ = "stes"
     id = Column(Integer, primary_key=True, index=True)
     
@@ -32,9 +34,15 @@ class STE(Base):
     manufacturer = Column(String, nullable=True) # 'производитель'
     category_name = Column(String, nullable=True) # 'название категории'
     
-    card_id = Column(Integer, ForeignKey("cards.id"), nullable=True)
+    card_id = Column(Integer, ForeignKey("cards.id"), nullable=True, index=True)
     card = relationship("Card", back_populates="stes")
     created_at = Column(DateTime(timezone=True), server_default=func.now())
+    # Отслеживание изменений (см. changes.py). default - и для БД после миграции,
+    # где у колонки нет DEFAULT (SQLite не умеет его добавить)
+    updated_at = Column(
+        DateTime(timezone=True), default=func.now(), server_default=func.now(), onupdate=func.now(), index=True
+    )
+    version = Column(Integer, nullable=False, default=1, server_default="1")
 
 class Card(Base):
     __tablename__ = "cards"
@@ -43,24 +51,37 @@ class Card(Base):
     stes = relationship("STE", back_populates="card")
 
     created_at = Column(DateTime(timezone=True), server_default=func.now())
+    updated_at = Column(DateTime(timezone=True), default=func.now(), server_default=func.now(), onupdate=func.now())
+    version = Column(Integer, nullable=False, default=1, server_default="1")
+
+    # Агрегаты оценок (обновляются вместе с записью оценок, см. ratings.py)
+    feedback_count = Column(Integer, nullable=False, default=0, server_default="0")
+    feedback_positive = Column(Integer, nullable=False, default=0, server_default="0")
+    # Последняя переагрегация по фидбеку: спорность считается по оценкам после неё
+    reclustered_at = Column(DateTime(timezone=True), nullable=True)
 
     @hybrid_property
     def score(self):
         """Average feedback score for this card (0.0 - 1.0). Returns 0.0 if no feedbacks."""
-        sess = object_session(self)
-        if sess is None:
+        if not self.feedback_count:
             return 0.0
-        avg = sess.query(func.avg(Feedback.score)).filter(Feedback.card_id == self.id).scalar()
-        return float(avg) if avg is not None else 0.0
+        return self.feedback_positive / self.feedback_count
 
     @score.expression
     def score(cls):
-        return select(func.avg(Feedback.score)).where(Feedback.card_id == cls.id).scalar_subquery()
+        return case(
+            (cls.feedback_count > 0, cast(cls.feedback_positive, Float) / cls.feedback_count),
+            else_=0.0,
+        )
 
 from sqlalchemy import CheckConstraint
 
 class Feedback(Base):
     __tablename__ = "feedbacks"
+    # Один голос пользователя за пару (карточка, STE); покрывает и выборки по card_id
+    __table_args__ = (
+        Index("ux_feedbacks_card_ste_user", "card_id", "ste_id", "user_id", unique=True),
+    )
     
     id = Column(Integer, primary_key=True, index=True)
     
@@ -77,8 +98,59 @@ class Feedback(Base):
     user_id = Column(Integer, ForeignKey("users.id"), nullable=True)
     
     created_at = Column(DateTime(timezone=True), server_default=func.now())
+    # Повторный голос перезаписывает score: инкрементальные выгрузки идут по updated_at
+    updated_at = Column(
+        DateTime(timezone=True), default=func.now(), server_default=func.now(), onupdate=func.now(), index=True
+    )
     
     # Связи (опционально, для удобства ORM)
     card = relationship("Card")
     ste = relationship("STE")
-    user = relationship("User", back_populates="feedbacks")
\ No newline at end of file
+    user = relationship("User", back_populates="feedbacks")
+
+
+class STENeighbor(Base):
+    """Предрассчитанный k-NN граф по эмбеддингам STE (для /api/ste/{id}/similar)."""
+    __tablename__ = "ste_neighbors"
+    
+    ste_id = Column(Integer, ForeignKey("stes.id", ondelete="CASCADE"), primary_key=True)
+    neighbor_id = Column(Integer, ForeignKey("stes.id", ondelete="CASCADE"), primary_key=True, index=True)
+    # Косинусная близость эмбеддингов
+    score = Column(Float, nullable=False)
+    
+    neighbor = relationship("STE", foreign_keys=[neighbor_id])
+
+
+class CardMetrics(Base):
+    """Метрики связности карточки по эмбеддингам (для приоритизации проверки)."""
+    __tablename__ = "card_metrics"
+    
+    card_id = Column(Integer, ForeignKey("cards.id", ondelete="CASCADE"), primary_key=True)
+    # Сколько STE карточки нашлось в хранилище эмбеддингов
+    size = Column(Integer, nullable=False)
+    # Средняя попарная косинусная близость STE внутри карточки
+    mean_similarity = Column(Float, nullable=True, index=True)
+    # Самый далёкий от центра карточки STE
+    worst_ste_id = Column(Integer, nullable=True)
+    worst_similarity = Column(Float, nullable=True)
+    # Ближайшая другая карточка (по центроидам)
+    nearest_card_id = Column(Integer, nullable=True)
+    nearest_card_similarity = Column(Float, nullable=True)
+    # MAX(updated_at) - поколение метрик в ETag каталога (sort=quality)
+    updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now(), index=True)
+
+
+class ChangeLog(Base):
+    """Журнал изменений STE и карточек (курсор для /api/changes)."""
+    __tablename__ = "change_log"
+    # Компакция ищет более позднюю запись того же объекта
+    __table_args__ = (
+        Index("ix_change_log_entity_seq", "entity", "entity_id", "seq"),
+    )
+    
+    # На SQLite автоинкремент есть только у INTEGER PRIMARY KEY (он и так 64-битный)
+    seq = Column(BigInteger().with_variant(Integer, "sqlite"), primary_key=True, autoincrement=True)
+    entity = Column(String, nullable=False)  # 'ste' | 'card'
+    entity_id = Column(Integer, nullable=False)
+    op = Column(String, nullable=False)  # 'insert' | 'update' | 'delete'
+    changed_at = Column(DateTime(timezone=True), server_default=func.now(), index=True)
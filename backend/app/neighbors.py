@@ -0,0 +1,351 @@
+"""
+Предрассчитанный граф ближайших соседей STE.
+
+Граф строится по хранилищу эмбеддингов (см. embedding_store.py) и лежит в
+таблице ste_neighbors, поэтому /api/ste/{id}/similar не вызывает модель и
+одинаково работает во всех воркерах.
+
+Полная перестройка - офлайн задача, не фоновая задача API воркера:
+
+    python -m app.neighbors                 # HNSW индекс (hnswlib)
+    python -m app.neighbors --index exact   # точный поиск блочным matmul
+
+Запросы идут блоками по NEIGHBORS_BLOCK строк, рёбра пишутся в БД после
+каждого блока, поэтому память не растёт с размером каталога. После
+точечной реагрегации граф обновляется инкрементально: списки изменённых
+STE считаются заново, а у STE, которые на них ссылались или стали их
+соседями, список пересобирается из прежних соседей и изменённых STE;
+если так нельзя гарантировать точный top-k, список пересчитывается целиком.
+"""
+import argparse
+import logging
+import os
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+from sqlalchemy import delete, insert, select
+from sqlalchemy.orm import Session
+
+from . import database, embedding_store, models
+
+logger = logging.getLogger(__name__)
+
+# Сколько соседей храним на STE (запрос k не может быть больше)
+NEIGHBORS_K = int(os.getenv('NEIGHBORS_K', 50))
+# Сколько запросов считаем за раз
+NEIGHBORS_BLOCK = int(os.getenv('NEIGHBORS_BLOCK', 256))
+# Кандидатов на блок в точном поиске (память: block * candidates * 4 байта)
+NEIGHBORS_CANDIDATE_BLOCK = int(os.getenv('NEIGHBORS_CANDIDATE_BLOCK', 65536))
+# Индекс полной перестройки: hnsw (hnswlib) | exact
+NEIGHBORS_INDEX = os.getenv('NEIGHBORS_INDEX', 'hnsw')
+NEIGHBORS_HNSW_M = int(os.getenv('NEIGHBORS_HNSW_M', 16))
+NEIGHBORS_HNSW_EF = int(os.getenv('NEIGHBORS_HNSW_EF', 200))
+# Обновлять граф после точечной реагрегации
+NEIGHBORS_ENABLED = os.getenv('NEIGHBORS_ENABLED', '1') == '1'
+
+_CHUNK = 5000
+
+
+def _existing_ids(db: Session, ids: np.ndarray) -> np.ndarray:
+    """Id STE, которые ещё есть в БД (хранилище может содержать удалённые)."""
+    existing = set()
+    for start in range(0, len(ids), 10000):
+        chunk = [int(i) for i in ids[start:start + 10000]]
+        existing.update(row[0] for row in db.execute(select(models.STE.id).where(models.STE.id.in_(chunk))))
+    return np.array(sorted(existing), dtype=np.int64)
+
+
+def _merge_top(scores: np.ndarray, positions: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Top-k по строкам, отсортированный по убыванию (scores и positions одной формы)."""
+    if scores.shape[1] > k:
+        top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        scores = np.take_along_axis(scores, top, axis=1)
+        positions = np.take_along_axis(positions, top, axis=1)
+    order = np.argsort(-scores, axis=1, kind='stable')
+    return np.take_along_axis(scores, order, axis=1), np.take_along_axis(positions, order, axis=1)
+
+
+class ExactIndex:
+    """Точный поиск: блоки запросов x блоки кандидатов с накоплением top-k."""
+
+    def __init__(self, store, candidates: np.ndarray):
+        self.store = store
+        # Позиции строк хранилища, среди которых ищем соседей
+        self.candidates = candidates
+
+    def search(self, query_positions: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        """(позиции соседей, близости) [len(query), k]; пустые места - позиция -1."""
+        queries = self.store.dequantize(query_positions)
+        best_scores = np.full((len(queries), k), -np.inf, dtype=np.float32)
+        best_positions = np.full((len(queries), k), -1, dtype=np.int64)
+        for start in range(0, len(self.candidates), NEIGHBORS_CANDIDATE_BLOCK):
+            block = self.candidates[start:start + NEIGHBORS_CANDIDATE_BLOCK]
+            scores = queries @ self.store.dequantize(block).T
+            scores[query_positions[:, None] == block[None, :]] = -np.inf
+            best_scores, best_positions = _merge_top(
+                np.hstack([best_scores, scores]),
+                np.hstack([best_positions, np.broadcast_to(block, scores.shape)]),
+                k,
+            )
+        best_positions[~np.isfinite(best_scores)] = -1
+        return best_positions, best_scores
+
+
+class HnswIndex:
+    """
+    Приближённый поиск по HNSW графу (hnswlib), строится один раз на перестройку.
+    Векторы хранилища нормированы, поэтому скалярное произведение = косинус.
+    """
+
+    def __init__(self, store, candidates: np.ndarray):
+        import hnswlib
+
+        self.store = store
+        self.index = hnswlib.Index(space='ip', dim=store.dim)
+        self.index.init_index(max_elements=len(candidates), M=NEIGHBORS_HNSW_M, ef_construction=NEIGHBORS_HNSW_EF)
+        for start in range(0, len(candidates), NEIGHBORS_CANDIDATE_BLOCK):
+            block = candidates[start:start + NEIGHBORS_CANDIDATE_BLOCK]
+            self.index.add_items(store.dequantize(block), block)
+        self.size = len(candidates)
+
+    def search(self, query_positions: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        # +1: сам запрос обычно находится первым
+        limit = min(k + 1, self.size)
+        self.index.set_ef(max(NEIGHBORS_HNSW_EF, limit))
+        queries = self.store.dequantize(query_positions)
+        labels, distances = self.index.knn_query(queries, k=limit)
+        labels = labels.astype(np.int64)
+        scores = (1.0 - distances).astype(np.float32)
+        scores[labels == query_positions[:, None]] = -np.inf
+        scores, labels = _merge_top(scores, labels, k)
+        labels[~np.isfinite(scores)] = -1
+        return labels, scores
+
+
+def build_index(store, candidates: np.ndarray, kind: str = NEIGHBORS_INDEX):
+    if kind == 'hnsw':
+        try:
+            return HnswIndex(store, candidates)
+        except ImportError:
+            logger.warning("hnswlib is not installed, falling back to exact neighbor search")
+    elif kind != 'exact':
+        raise ValueError(f"Unknown neighbor index '{kind}', use hnsw or exact")
+    return ExactIndex(store, candidates)
+
+
+def compute_neighbors(store, index, query_positions: np.ndarray, k: int = NEIGHBORS_K) -> Iterator[List[dict]]:
+    """Рёбра top-k соседей для строк query_positions, порциями по NEIGHBORS_BLOCK запросов."""
+    for start in range(0, len(query_positions), NEIGHBORS_BLOCK):
+        block = query_positions[start:start + NEIGHBORS_BLOCK]
+        neighbors, scores = index.search(block, k)
+        rows = []
+        for row, position in enumerate(block):
+            ste_id = int(store.ids[position])
+            for neighbor, score in zip(neighbors[row], scores[row]):
+                if neighbor >= 0:
+                    rows.append({'ste_id': ste_id, 'neighbor_id': int(store.ids[neighbor]), 'score': float(score)})
+        yield rows
+
+
+def _insert(db: Session, rows: List[dict]) -> None:
+    for start in range(0, len(rows), _CHUNK):
+        db.execute(insert(models.STENeighbor), rows[start:start + _CHUNK])
+
+
+def _delete_lists(db: Session, ste_ids: List[int]) -> None:
+    for start in range(0, len(ste_ids), _CHUNK):
+        db.execute(
+            delete(models.STENeighbor)
+            .where(models.STENeighbor.ste_id.in_(ste_ids[start:start + _CHUNK]))
+            .execution_options(synchronize_session=False)
+        )
+
+
+def _load_lists(db: Session, ste_ids: List[int]) -> Dict[int, List[Tuple[int, float]]]:
+    """Текущие списки соседей: ste_id -> [(neighbor_id, score)]."""
+    lists: Dict[int, List[Tuple[int, float]]] = {ste_id: [] for ste_id in ste_ids}
+    for start in range(0, len(ste_ids), _CHUNK):
+        rows = db.execute(
+            select(models.STENeighbor.ste_id, models.STENeighbor.neighbor_id, models.STENeighbor.score)
+            .where(models.STENeighbor.ste_id.in_(ste_ids[start:start + _CHUNK]))
+        )
+        for ste_id, neighbor_id, score in rows:
+            lists[ste_id].append((neighbor_id, score))
+    return lists
+
+
+def _referencing(db: Session, ste_ids: List[int]) -> set:
+    """STE, в списках которых есть кто-то из ste_ids."""
+    found = set()
+    for start in range(0, len(ste_ids), _CHUNK):
+        found.update(db.scalars(
+            select(models.STENeighbor.ste_id)
+            .where(models.STENeighbor.neighbor_id.in_(ste_ids[start:start + _CHUNK]))
+            .distinct()
+        ))
+    return found
+
+
+def rebuild_neighbors(db: Session, k: int = NEIGHBORS_K, index_kind: str = NEIGHBORS_INDEX) -> int:
+    """
+    Полная перестройка графа (офлайн, см. main). Старый граф виден читателям
+    до commit в конце; рёбра пишутся блоками.
+
+    Returns:
+        Число записанных рёбер
+    """
+    store = embedding_store.get_store()
+    if store is None or len(store) < 2:
+        return 0
+
+    live = np.flatnonzero(np.isin(store.ids, _existing_ids(db, store.ids)))
+    index = build_index(store, live, index_kind)
+    logger.info(f"Neighbor index ({type(index).__name__}) ready for {len(live)} STE")
+
+    db.execute(delete(models.STENeighbor))
+    written = 0
+    for rows in compute_neighbors(store, index, live, k):
+        _insert(db, rows)
+        written += len(rows)
+    db.commit()
+    logger.info(f"Neighbor graph rebuilt: {len(live)} STE, {written} edges")
+    return written
+
+
+def refresh_neighbors(db: Session, ste_ids: List[int], k: int = NEIGHBORS_K) -> int:
+    """
+    Инкрементальное обновление графа для STE с изменившимися эмбеддингами.
+
+    Списки изменённых STE считаются точным поиском. Список затронутого STE
+    (ссылался на изменённый или стал его соседом) - top-k из прежних соседей
+    и изменённых STE; результат точный, если k-я близость не ниже прежней
+    k-й (все не вошедшие в прежний список STE были не ближе неё), иначе
+    список пересчитывается точным поиском. STE, не связанные с изменёнными
+    ни в одну сторону, не проверяются (граф почти симметричен) - их
+    поправит следующая полная перестройка.
+
+    Returns:
+        Число записанных рёбер
+    """
+    store = embedding_store.get_store()
+    if store is None or len(store) < 2 or not ste_ids:
+        return 0
+
+    live_mask = np.isin(store.ids, _existing_ids(db, store.ids))
+    live = np.flatnonzero(live_mask)
+    exact = ExactIndex(store, live)
+
+    changed_all = sorted({int(i) for i in ste_ids})
+    changed_positions = store.positions(changed_all)
+    changed_positions = changed_positions[changed_positions >= 0]
+    changed_positions = changed_positions[live_mask[changed_positions]]
+    changed_set = set(changed_all)
+
+    forward = [row for rows in compute_neighbors(store, exact, changed_positions, k) for row in rows]
+    affected = (_referencing(db, changed_all) | {row['neighbor_id'] for row in forward}) - changed_set
+    affected = sorted(affected)
+    old_lists = _load_lists(db, affected)
+
+    rows = list(forward)
+    rescan = []
+    changed_live = store.ids[changed_positions]
+    for start in range(0, len(affected), NEIGHBORS_BLOCK):
+        block_ids = affected[start:start + NEIGHBORS_BLOCK]
+        positions = store.positions(block_ids)
+        valid = positions >= 0
+        valid[valid] = live_mask[positions[valid]]
+        scores = np.zeros((len(block_ids), len(changed_positions)), dtype=np.float32)
+        if valid.any() and len(changed_positions):
+            scores[valid] = store.dequantize(positions[valid]) @ store.dequantize(changed_positions).T
+
+        for row, ste_id in enumerate(block_ids):
+            if not valid[row]:
+                continue
+            old = old_lists[ste_id]
+            kept = [(n, s) for n, s in old if n not in changed_set]
+            fresh = [(int(n), float(s)) for n, s in zip(changed_live, scores[row]) if int(n) != ste_id]
+            merged = sorted(kept + fresh, key=lambda item: -item[1])[:k]
+            # Прежний список был полным: всё, что в него не вошло, не ближе его k-й близости
+            if len(old) >= k and len(merged) == k and merged[-1][1] >= min(s for _, s in old):
+                rows += [{'ste_id': ste_id, 'neighbor_id': n, 'score': s} for n, s in merged]
+            else:
+                rescan.append(positions[row])
+
+    for rescanned in compute_neighbors(store, exact, np.array(rescan, dtype=np.int64), k):
+        rows += rescanned
+
+    _delete_lists(db, changed_all + affected)
+    _insert(db, rows)
+    db.commit()
+    logger.info(
+        f"Neighbor graph updated: {len(changed_positions)} STE changed, {len(affected)} lists repaired "
+        f"({len(rescan)} rescanned), {len(rows)} edges written"
+    )
+    return len(rows)
+
+
+def refresh_neighbors_task(ste_ids: List[int]) -> None:
+    """Фоновое обновление графа после точечной реагрегации (своя сессия БД)."""
+    if not NEIGHBORS_ENABLED:
+        return
+    db = database.SessionLocal()
+    try:
+        refresh_neighbors(db, ste_ids)
+    except Exception as e:
+        logger.error(f"Neighbor graph refresh failed: {e}")
+        db.rollback()
+    finally:
+        db.close()
+
+
+def _similar_in_category(db: Session, ste_id: int, k: int) -> Optional[list]:
+    """Точный top-k среди STE той же категории по хранилищу (None - не посчитать)."""
+    store = embedding_store.get_store()
+    category_id = db.scalar(select(models.STE.category_id).where(models.STE.id == ste_id))
+    if store is None or category_id is None:
+        return None
+    query = store.positions([ste_id])
+    if query[0] < 0:
+        return None
+    ids = np.array(db.scalars(select(models.STE.id).where(models.STE.category_id == category_id)).all(), dtype=np.int64)
+    candidates = store.positions(ids)
+    candidates = np.sort(candidates[candidates >= 0])
+    neighbors, scores = ExactIndex(store, candidates).search(query, k)
+    found = [(int(store.ids[n]), float(s)) for n, s in zip(neighbors[0], scores[0]) if n >= 0]
+    stes = {ste.id: ste for ste in db.query(models.STE).filter(models.STE.id.in_([n for n, _ in found]))}
+    return [(stes[n], s) for n, s in found if n in stes]
+
+
+def get_similar(db: Session, ste_id: int, k: int = 10, same_category: bool = False):
+    """Соседи STE из предрассчитанного графа: список пар (STE, score)."""
+    query = (
+        db.query(models.STE, models.STENeighbor.score)
+        .join(models.STENeighbor, models.STENeighbor.neighbor_id == models.STE.id)
+        .filter(models.STENeighbor.ste_id == ste_id)
+    )
+    if same_category:
+        category_id = select(models.STE.category_id).where(models.STE.id == ste_id).scalar_subquery()
+        query = query.filter(models.STE.category_id == category_id)
+    rows = query.order_by(models.STENeighbor.score.desc()).limit(k).all()
+    if same_category and len(rows) < k:
+        # В общем top-K мало STE этой категории - ищем по категории напрямую
+        rows = _similar_in_category(db, ste_id, k) or rows
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Rebuild the STE neighbor graph')
+    parser.add_argument('--k', type=int, default=NEIGHBORS_K)
+    parser.add_argument('--index', choices=('hnsw', 'exact'), default=NEIGHBORS_INDEX)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(name)s %(levelname)s %(message)s')
+    db = database.SessionLocal()
+    try:
+        print(f"Edges written: {rebuild_neighbors(db, args.k, args.index)}")
+    finally:
+        db.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,236 @@
+"""
+Диагностика медленных запросов.
+
+- id запроса: берётся из X-Request-ID или генерируется, возвращается в
+  ответе и попадает во все записи лога ниже
+- лог медленных SQL: запросы дольше DB_SLOW_QUERY_MS
+- детектор N+1: один и тот же SQL текст (параметры не учитываются)
+  N_PLUS_ONE_THRESHOLD и более раз за HTTP запрос
+- время SQL приходит из общих хуков курсора в metrics.py (observe_query),
+  своих хуков на движке у модуля нет
+- сэмплирующий профайлер: для путей из PROFILE_ROUTES или по заголовку
+  X-Profile: 1 от админа. Раз в PROFILE_INTERVAL_MS снимаются стеки всех
+  занятых потоков воркера (event loop, threadpool, пул fuzzy), результат
+  пишется в PROFILE_DIR в collapsed формате (flamegraph.pl, speedscope).
+  Простаивающие потоки и select event loop не сэмплируются, поэтому
+  ожидание async драйвера БД в профиль не попадает: SQL время смотрите в
+  логе медленных запросов.
+"""
+import logging
+import os
+import re
+import sys
+import threading
+import uuid
+from collections import Counter
+from contextvars import ContextVar
+from datetime import datetime
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+# Порог медленного SQL запроса, мс (0 - не логировать)
+DB_SLOW_QUERY_MS = float(os.getenv("DB_SLOW_QUERY_MS", 500))
+# Сколько повторов одного SQL за запрос считать N+1 (0 - выключено)
+N_PLUS_ONE_THRESHOLD = int(os.getenv("N_PLUS_ONE_THRESHOLD", 10))
+
+# Профилирование: разрешено ли вообще, для каких путей (префиксы через запятую)
+PROFILE_ENABLED = os.getenv("PROFILE_ENABLED", "0") == "1"
+PROFILE_ROUTES = [p.strip() for p in os.getenv("PROFILE_ROUTES", "").split(",") if p.strip()]
+PROFILE_INTERVAL_MS = float(os.getenv("PROFILE_INTERVAL_MS", 5))
+PROFILE_DIR = os.getenv("PROFILE_DIR", "/tmp/profiles")
+PROFILE_KEEP = int(os.getenv("PROFILE_KEEP", 100))
+
+# Лист стека в этих файлах / функциях - поток ждёт работу, а не работает
+_IDLE_FILES = ("threading.py", "selectors.py", "queue.py")
+_IDLE_FUNCTIONS = {
+    ("thread.py", "_worker"),  # concurrent.futures (пул fuzzy) в SimpleQueue.get
+    ("core.py", "_connection_worker_thread"),  # поток соединения aiosqlite
+}
+
+
+class RequestProfile:
+    """Диагностика одного HTTP запроса."""
+
+    __slots__ = ("request_id", "method", "path", "statements")
+
+    def __init__(self, request_id: str, method: str, path: str):
+        self.request_id = request_id
+        self.method = method
+        self.path = path
+        # SQL текст -> [число выполнений, суммарное время]
+        self.statements = {}
+
+
+_current: ContextVar[Optional[RequestProfile]] = ContextVar("request_profile", default=None)
+
+
+def current_request_id() -> str:
+    profile = _current.get()
+    return profile.request_id if profile is not None else "-"
+
+
+def observe_query(statement: str, elapsed: float) -> None:
+    """SQL запрос выполнен (вызывается из событий движка в metrics.py): N+1 и лог медленных."""
+    profile = _current.get()
+    if profile is not None:
+        entry = profile.statements.setdefault(statement, [0, 0.0])
+        entry[0] += 1
+        entry[1] += elapsed
+    if DB_SLOW_QUERY_MS and elapsed * 1000 >= DB_SLOW_QUERY_MS:
+        logger.warning(
+            f"Slow query {elapsed * 1000:.0f}ms [request {current_request_id()}"
+            f"{' ' + profile.method + ' ' + profile.path if profile is not None else ''}]: "
+            f"{' '.join(statement.split())[:1000]}"
+        )
+
+
+def report_repeated_statements(profile: RequestProfile) -> None:
+    """Логирует SQL, повторённый в запросе N_PLUS_ONE_THRESHOLD и более раз."""
+    if not N_PLUS_ONE_THRESHOLD:
+        return
+    for statement, (count, seconds) in profile.statements.items():
+        if count >= N_PLUS_ONE_THRESHOLD:
+            logger.warning(
+                f"Possible N+1 [request {profile.request_id} {profile.method} {profile.path}]: "
+                f"{count} executions, {seconds * 1000:.0f}ms total: {' '.join(statement.split())[:500]}"
+            )
+
+
+class SamplingProfiler:
+    """Поток, который снимает стеки занятых потоков и копит их в collapsed виде."""
+
+    def __init__(self, interval: float = PROFILE_INTERVAL_MS / 1000):
+        self.interval = interval
+        self.samples = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+
+    def _run(self) -> None:
+        own = threading.get_ident()
+        names = {}
+        while not self._stop.wait(self.interval):
+            for thread in threading.enumerate():
+                names[thread.ident] = thread.name
+            for ident, frame in sys._current_frames().items():
+                leaf_file = os.path.basename(frame.f_code.co_filename)
+                if ident == own or leaf_file in _IDLE_FILES or (leaf_file, frame.f_code.co_name) in _IDLE_FUNCTIONS:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                self.samples[";".join(reversed(stack)).replace("\n", " ")] += 1
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def stop(self) -> Counter:
+        self._stop.set()
+        self._thread.join()
+        return self.samples
+
+
+# Один профиль на воркер за раз: стеки снимаются со всех потоков
+_profile_lock = threading.Lock()
+
+
+def _admin_token(headers: dict) -> bool:
+    """Подписанный токен с is_admin (без запроса в БД)."""
+    from jose import JWTError, jwt
+
+    from .auth.jwt import ALGORITHM, SECRET_KEY
+
+    scheme, _, token = headers.get("authorization", "").partition(" ")
+    if scheme.lower() != "bearer" or not token:
+        return False
+    try:
+        return bool(jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM]).get("is_admin"))
+    except JWTError:
+        return False
+
+
+def should_profile(path: str, headers: dict) -> bool:
+    if not PROFILE_ENABLED:
+        return False
+    if any(path.startswith(prefix) for prefix in PROFILE_ROUTES):
+        return True
+    return headers.get("x-profile") == "1" and _admin_token(headers)
+
+
+def save_profile(profile: RequestProfile, samples: Counter) -> str:
+    """Пишет collapsed стеки в PROFILE_DIR, старые файлы сверх PROFILE_KEEP удаляются."""
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    slug = re.sub(r"[^A-Za-z0-9_-]", "_", profile.path.strip("/"))[:80] or "root"
+    name = f"{datetime.now():%Y%m%d-%H%M%S}-{profile.request_id}-{slug}.collapsed"
+    with open(os.path.join(PROFILE_DIR, name), "w", encoding="utf-8") as f:
+        for stack, count in samples.most_common():
+            f.write(f"{stack} {count}\n")
+
+    files = sorted(list_profiles())
+    for stale in files[:max(len(files) - PROFILE_KEEP, 0)]:
+        try:
+            os.remove(os.path.join(PROFILE_DIR, stale))
+        except OSError:
+            pass
+    return name
+
+
+def list_profiles() -> list:
+    if not os.path.isdir(PROFILE_DIR):
+        return []
+    return [name for name in os.listdir(PROFILE_DIR) if name.endswith(".collapsed")]
+
+
+def profile_path(name: str) -> Optional[str]:
+    """Путь к файлу профиля; None, если имя не из PROFILE_DIR."""
+    if os.path.basename(name) != name or not name.endswith(".collapsed"):
+        return None
+    path = os.path.join(PROFILE_DIR, name)
+    return path if os.path.isfile(path) else None
+
+
+class ProfilingMiddleware:
+    """ASGI middleware: X-Request-ID, детектор N+1 и профилирование по запросу."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        headers = {k.decode("latin-1").lower(): v.decode("latin-1") for k, v in scope["headers"]}
+        # Чужой id попадает в лог и имя файла профиля - только безопасные символы
+        request_id = re.sub(r"[^A-Za-z0-9_.-]", "", headers.get("x-request-id", ""))[:64].strip(".") or uuid.uuid4().hex[:16]
+        profile = RequestProfile(request_id, scope["method"], scope["path"])
+        token = _current.set(profile)
+
+        sampler = None
+        if should_profile(scope["path"], headers) and _profile_lock.acquire(blocking=False):
+            sampler = SamplingProfiler()
+            sampler.start()
+
+        async def send_with_request_id(message):
+            if message["type"] == "http.response.start":
+                message["headers"] = list(message.get("headers", [])) + [(b"x-request-id", request_id.encode())]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_request_id)
+        finally:
+            _current.reset(token)
+            if sampler is not None:
+                try:
+                    samples = sampler.stop()
+                    name = save_profile(profile, samples)
+                    logger.info(f"Profile [request {request_id} {profile.method} {profile.path}]: "
+                                f"{sum(samples.values())} samples -> {name}")
+                except OSError as e:
+                    logger.warning(f"Could not save profile: {e}")
+                finally:
+                    _profile_lock.release()
+            report_repeated_statements(profile)
@@ -0,0 +1,104 @@
+"""
+Запись оценок агрегации.
+
+Голоса пишутся одним INSERT ... ON CONFLICT (card_id, ste_id, user_id)
+DO UPDATE, агрегаты карточек (cards.feedback_count / feedback_positive)
+пересчитываются в той же транзакции одним UPDATE по затронутым карточкам.
+"""
+import os
+from typing import Dict, List, Tuple
+
+from fastapi import HTTPException
+from sqlalchemy import func, select, update
+from sqlalchemy.orm import Session
+
+from . import changes, models
+
+# Максимум голосов в одном запросе /api/rating/batch
+RATING_BATCH_MAX = int(os.getenv("RATING_BATCH_MAX", 1000))
+
+
+def _dialect_insert(db: Session):
+    dialect = db.get_bind().dialect.name
+    if dialect == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert
+    elif dialect == "sqlite":
+        from sqlalchemy.dialects.sqlite import insert
+    else:
+        raise NotImplementedError(f"Upsert is not supported for {dialect}")
+    return insert
+
+
+def validate_votes(db: Session, votes: List[dict]) -> List[dict]:
+    """
+    Проверяет оценки и убирает дубли внутри запроса (последний голос побеждает).
+    Существование карточек и STE проверяется двумя запросами на весь батч.
+    """
+    if any(vote["score"] not in (0, 1) for vote in votes):
+        raise HTTPException(status_code=400, detail="Score must be 0 or 1")
+
+    unique: Dict[Tuple[int, int], dict] = {}
+    for vote in votes:
+        unique[(vote["card_id"], vote["ste_id"])] = vote
+
+    card_ids = {card_id for card_id, _ in unique}
+    ste_ids = {ste_id for _, ste_id in unique}
+    found_cards = set(db.scalars(select(models.Card.id).where(models.Card.id.in_(card_ids))))
+    found_stes = set(db.scalars(select(models.STE.id).where(models.STE.id.in_(ste_ids))))
+    missing_cards = sorted(card_ids - found_cards)
+    missing_stes = sorted(ste_ids - found_stes)
+    if missing_cards or missing_stes:
+        raise HTTPException(status_code=404, detail={
+            "msg": "Card or STE not found",
+            "card_ids": missing_cards,
+            "ste_ids": missing_stes,
+        })
+    return list(unique.values())
+
+
+def refresh_card_feedback(db: Session, card_ids) -> None:
+    """Пересчитывает агрегаты оценок карточек по таблице feedbacks (без commit)."""
+    card_ids = sorted(set(card_ids))
+    for start in range(0, len(card_ids), 5000):
+        chunk = card_ids[start:start + 5000]
+        count = (
+            select(func.count(models.Feedback.id))
+            .where(models.Feedback.card_id == models.Card.id)
+            .scalar_subquery()
+        )
+        positive = (
+            select(func.coalesce(func.sum(models.Feedback.score), 0))
+            .where(models.Feedback.card_id == models.Card.id)
+            .scalar_subquery()
+        )
+        db.execute(
+            update(models.Card)
+            .where(models.Card.id.in_(chunk))
+            .values(feedback_count=count, feedback_positive=positive)
+            .execution_options(synchronize_session=False)
+        )
+    changes.record_changes(db, "card", card_ids)
+
+
+def upsert_votes(db: Session, user_id: int, votes: List[dict]) -> int:
+    """
+    Записывает проверенные голоса пользователя и обновляет агрегаты карточек.
+    Возвращает число записанных голосов. Commit - на вызывающем.
+    """
+    if not votes:
+        return 0
+    insert = _dialect_insert(db)
+    rows = [
+        {"card_id": vote["card_id"], "ste_id": vote["ste_id"], "score": vote["score"], "user_id": user_id}
+        for vote in votes
+    ]
+    # Время голоса и в INSERT, и в ON CONFLICT: не полагаемся на DEFAULT колонки
+    statement = insert(models.Feedback).values(updated_at=func.now())
+    statement = statement.on_conflict_do_update(
+        index_elements=[models.Feedback.card_id, models.Feedback.ste_id, models.Feedback.user_id],
+        set_={"score": statement.excluded.score, "updated_at": func.now()},
+    )
+    for start in range(0, len(rows), 5000):
+        db.execute(statement, rows[start:start + 5000])
+    refresh_card_feedback(db, [vote["card_id"] for vote in votes])
+    return len(rows)
@@ -0,0 +1,114 @@
+"""
+Представления STE для кластеризации.
+
+Эмбеддинг названия дополняется хешированными структурными признаками
+(производитель, модель, категория, характеристики). Каждый блок
+нормируется и умножается на sqrt(веса поля), поэтому косинусная близость
+итогового вектора - взвешенная сумма близостей по полям.
+"""
+import json
+import logging
+import os
+import zlib
+from typing import Dict, List
+
+import numpy as np
+import pandas as pd
+
+from .blocking import normalize_text
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_WEIGHTS = {
+    'title': 1.0,
+    'model_name': 0.5,
+    'manufacturer': 0.25,
+    'category_id': 0.25,
+    'characteristics': 0.0,
+}
+
+
+def _load_weights(raw: str) -> Dict[str, float]:
+    """Веса из JSON поверх DEFAULT_WEIGHTS; при ошибке в env - веса по умолчанию."""
+    try:
+        overrides = json.loads(raw)
+        if not isinstance(overrides, dict):
+            raise ValueError("expected a JSON object")
+        return {**DEFAULT_WEIGHTS, **{field: float(weight) for field, weight in overrides.items()}}
+    except (TypeError, ValueError) as e:
+        logger.warning(f"Invalid ML_FEATURE_WEIGHTS ({e}), using defaults: {DEFAULT_WEIGHTS}")
+        return dict(DEFAULT_WEIGHTS)
+
+
+# Переопределение весов: ML_FEATURE_WEIGHTS='{"model_name": 1.0, "characteristics": 0.2}'
+FEATURE_WEIGHTS = _load_weights(os.getenv('ML_FEATURE_WEIGHTS', '{}'))
+# Размерность хешированного блока на каждое структурное поле
+FEATURE_HASH_DIM = int(os.getenv('ML_FEATURE_HASH_DIM', 32))
+
+STRUCTURED_FIELDS = ('model_name', 'manufacturer', 'category_id', 'characteristics')
+
+
+def needs_characteristics(weights: Dict[str, float] = None) -> bool:
+    """Нужно ли загружать характеристики из БД."""
+    return (FEATURE_WEIGHTS if weights is None else weights).get('characteristics', 0) > 0
+
+
+def _tokens(field: str, value) -> List[str]:
+    """Признаки поля в виде строк для хеширования."""
+    if field == 'characteristics':
+        if not isinstance(value, dict):
+            return []
+        return [f"{normalize_text(k)}={normalize_text(v)}" for k, v in value.items()]
+    if field == 'category_id':
+        return [] if value is None or pd.isna(value) or value < 0 else [str(int(value))]
+
+    text = normalize_text(value)
+    if not text:
+        return []
+    if field == 'model_name':
+        # Модель целиком + её части, чтобы "X-200" и "X 200 PRO" были близки
+        parts = text.split()
+        return [text] + parts if len(parts) > 1 else [text]
+    return [text]
+
+
+def hash_field(values, field: str, dim: int = FEATURE_HASH_DIM) -> np.ndarray:
+    """Feature hashing значений поля в нормированные векторы [len(values), dim]."""
+    result = np.zeros((len(values), dim), dtype=np.float32)
+    for row, value in enumerate(values):
+        for token in _tokens(field, value):
+            h = zlib.crc32(f"{field}:{token}".encode('utf-8'))
+            # Старший бит задаёт знак, чтобы коллизии в среднем гасились
+            result[row, h % dim] += 1.0 if h & 0x80000000 else -1.0
+    norms = np.linalg.norm(result, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return result / norms
+
+
+def build_representations(
+    df: pd.DataFrame,
+    text_embeddings: np.ndarray,
+    weights: Dict[str, float] = None,
+) -> np.ndarray:
+    """
+    Склеивает эмбеддинг названия со структурными признаками.
+
+    Args:
+        df: строки STE (колонки model_name, manufacturer, category_id, features)
+        text_embeddings: эмбеддинги названий в том же порядке
+        weights: веса полей (по умолчанию FEATURE_WEIGHTS)
+    """
+    weights = FEATURE_WEIGHTS if weights is None else weights
+    text = np.asarray(text_embeddings, dtype=np.float32)
+    norms = np.linalg.norm(text, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    blocks = [text / norms * np.sqrt(weights.get('title', 1.0))]
+
+    for field in STRUCTURED_FIELDS:
+        weight = weights.get(field, 0)
+        column = 'features' if field == 'characteristics' else field
+        if weight <= 0 or column not in df.columns:
+            continue
+        blocks.append(hash_field(df[column].tolist(), field) * np.sqrt(weight))
+
+    return np.hstack(blocks) if len(blocks) > 1 else blocks[0]
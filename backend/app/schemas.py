@@ -1,3 +1,4 @@
+from datetime import datetime
 from typing import Any, Dict, List, Optional
 
 from pydantic import BaseModel
@@ -40,6 +41,10 @@ class STEResponse(STEBase):
     class Config:
         from_attributes = True
 
+class SimilarSTEResponse(BaseModel):
+    ste: STEResponse
+    score: float  # Косинусная близость эмбеддингов
+
 # --- Card ---
 class CardBase(BaseModel):
     name: Optional[str] = None
@@ -53,6 +58,43 @@ class CardUpdate(BaseModel):
 class CardResponse(CardBase):
     id: int
     stes: List[STEResponse] = []
+    feedback_count: int = 0
+    score: float = 0.0  # Доля положительных оценок
+    class Config:
+        from_attributes = True
+
+class CardMergeRequest(BaseModel):
+    target_id: int
+    source_ids: List[int]  # Карточки, которые вливаются в target_id и удаляются
+    name: Optional[str] = None  # Новое название целевой карточки
+
+class CardSplitRequest(BaseModel):
+    ste_ids: List[int]  # STE карточки, которые уходят в новую карточку
+    name: Optional[str] = None
+
+class STEMove(BaseModel):
+    ste_ids: List[int]
+    card_id: Optional[int] = None  # None - отвязать STE от карточки
+
+class CardMoveRequest(BaseModel):
+    moves: List[STEMove]
+    retire_empty: bool = False  # Удалить опустевшие карточки без оценок
+
+class CardBulkResponse(BaseModel):
+    card_id: Optional[int] = None  # Целевая (merge) или новая (split) карточка
+    moved: int  # Сколько STE сменили карточку
+    touched_card_ids: List[int] = []
+    created_card_ids: List[int] = []
+    deleted_card_ids: List[int] = []
+
+class CardMetricsResponse(BaseModel):
+    card_id: int
+    size: int
+    mean_similarity: Optional[float] = None
+    worst_ste_id: Optional[int] = None
+    worst_similarity: Optional[float] = None
+    nearest_card_id: Optional[int] = None
+    nearest_card_similarity: Optional[float] = None
     class Config:
         from_attributes = True
 
@@ -86,13 +128,48 @@ class FeedbackResponse(FeedbackCreate):
     class Config:
         from_attributes = True
 
+class FeedbackBatchCreate(BaseModel):
+    votes: List[FeedbackCreate]
+
+class FeedbackBatchResponse(BaseModel):
+    received: int
+    written: int  # После удаления дублей внутри запроса
+    cards_updated: int
+
+
+# --- Change feed ---
+class ChangeEntry(BaseModel):
+    seq: int
+    entity: str  # 'ste' | 'card'
+    entity_id: int
+    op: str  # 'insert' | 'update' | 'delete'
+    changed_at: Optional[datetime] = None
+
+class ChangesResponse(BaseModel):
+    changes: List[ChangeEntry]
+    next: int  # Передать как since в следующем запросе
+    has_more: bool
+
 
 # --- Reaggregate ---
 class ReaggregateRequest(BaseModel):
     ste_ids: List[int]  # Список ID STE для реагрегации
 
+class DisputedReaggregateRequest(BaseModel):
+    # None - значения FEEDBACK_DISPUTE_THRESHOLD / FEEDBACK_DISPUTE_MIN_VOTES
+    threshold: Optional[float] = None  # Доля оценок score=0, начиная с которой карточка спорная
+    min_votes: Optional[int] = None  # Минимум оценок у карточки
+
 class ReaggregateResponse(BaseModel):
     status: str
     total: int = 0
     updated: int = 0
+    # Статистика сопоставления кластеров с существующими карточками
+    churn_avoided: int = 0
+    cards_reused: int = 0
+    cards_created: int = 0
+    cards_retired: int = 0
+    disputed_cards: int = 0
+    # Время стадий пайплайна (load, encode, cluster, merge, write), секунды
+    stage_timings: Dict[str, float] = {}
     error: Optional[str] = None
\ No newline at end of file
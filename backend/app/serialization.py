@@ -0,0 +1,61 @@
+"""
+Быстрый путь сериализации для больших списков.
+
+Вместо ORM объектов, которые FastAPI валидирует через схемы с
+from_attributes и кодирует стандартным json, строки выбираются кортежами
+нужных колонок, собираются в dict той же формы, что STEResponse /
+CardResponse, и кодируются orjson. Данные из БД считаются доверенными,
+поэтому валидация pydantic пропускается (схемы остаются в response_model
+для документации).
+"""
+from collections import defaultdict
+from typing import Dict, Iterable, List
+
+from fastapi.responses import ORJSONResponse
+
+from . import models, schemas
+
+# Поля STEResponse в порядке схемы: новое поле схемы должно появиться и в модели STE
+STE_FIELDS = tuple(schemas.STEResponse.model_fields)
+STE_COLUMNS = tuple(getattr(models.STE, field) for field in STE_FIELDS)
+
+CARD_COLUMNS = (models.Card.id, models.Card.name, models.Card.feedback_count, models.Card.feedback_positive)
+
+
+def ste_dict(row) -> dict:
+    """Строка select(*STE_COLUMNS) -> dict формы STEResponse."""
+    item = dict(zip(STE_FIELDS, row))
+    if item["characteristics"] is None:
+        item["characteristics"] = {}
+    return item
+
+
+def ste_dicts(rows: Iterable) -> List[dict]:
+    return [ste_dict(row) for row in rows]
+
+
+def card_dicts(card_rows: Iterable, ste_rows: Iterable) -> List[dict]:
+    """
+    Строки select(*CARD_COLUMNS) и STE этих карточек -> dict формы CardResponse.
+    Порядок карточек сохраняется, STE раскладываются по card_id.
+    """
+    stes_by_card: Dict[int, List[dict]] = defaultdict(list)
+    for row in ste_rows:
+        item = ste_dict(row)
+        stes_by_card[item["card_id"]].append(item)
+
+    result = []
+    for card_id, name, feedback_count, feedback_positive in card_rows:
+        result.append({
+            "name": name,
+            "id": card_id,
+            "stes": stes_by_card.get(card_id, []),
+            "feedback_count": feedback_count or 0,
+            "score": feedback_positive / feedback_count if feedback_count else 0.0,
+        })
+    return result
+
+
+def json_response(content) -> ORJSONResponse:
+    """Ответ, который FastAPI отдаёт как есть (без валидации response_model)."""
+    return ORJSONResponse(content)
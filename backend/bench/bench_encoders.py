@@ -0,0 +1,96 @@
+"""
+Сравнение бэкендов инференса модели эмбеддингов на CPU (предложений/сек).
+
+Базовая линия - текущий путь: SentenceTransformer.encode(batch_size=64).
+
+Примеры:
+    python -m bench.bench_encoders --n 5000
+    python -m bench.bench_encoders --from-db --backends torch,onnx,onnx-int8 --threads 4
+"""
+import argparse
+import random
+import time
+
+import numpy as np
+
+from app import embedding_backend, ml_insert
+
+_WORDS = [
+    'Бумага', 'офисная', 'А4', 'Снегурочка', 'ручка', 'шариковая', 'синяя', 'картридж', 'лазерный',
+    'для', 'принтера', 'HP', 'стул', 'офисный', 'черный', 'кресло', 'руководителя', 'кожа', 'перчатки',
+    'нитриловые', 'размер', 'M', 'шприц', 'одноразовый', '5', 'мл', 'маска', 'медицинская', 'трехслойная',
+]
+
+
+def synthetic_texts(n: int, seed: int = 0):
+    rng = random.Random(seed)
+    return [
+        ' '.join(rng.choice(_WORDS) for _ in range(rng.randint(2, 24))) + f' {rng.randint(1, 9999)}'
+        for _ in range(n)
+    ]
+
+
+def db_texts(n: int):
+    from app import database, models
+
+    db = database.SessionLocal()
+    try:
+        return [row[0] or '' for row in db.query(models.STE.name).limit(n)]
+    finally:
+        db.close()
+
+
+def measure(encode, texts, repeats: int):
+    encode(texts[:32])  # прогрев
+    best = None
+    result = None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = encode(texts)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, np.asarray(result, dtype=np.float32)
+
+
+def cosine_agreement(a: np.ndarray, b: np.ndarray) -> float:
+    a = a / np.linalg.norm(a, axis=1, keepdims=True)
+    b = b / np.linalg.norm(b, axis=1, keepdims=True)
+    return float((a * b).sum(axis=1).mean())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--n', type=int, default=5000, help='Сколько предложений кодировать')
+    parser.add_argument('--from-db', action='store_true', help='Брать названия STE из БД')
+    parser.add_argument('--backends', default=','.join(embedding_backend.BACKENDS))
+    parser.add_argument('--threads', type=int, default=embedding_backend.EMBEDDING_THREADS)
+    parser.add_argument('--repeats', type=int, default=3)
+    args = parser.parse_args()
+
+    texts = db_texts(args.n) if args.from_db else synthetic_texts(args.n)
+
+    import torch
+    from sentence_transformers import SentenceTransformer
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    baseline_model = SentenceTransformer(ml_insert.MODEL_NAME, device='cpu')
+    baseline_time, baseline = measure(
+        lambda batch: baseline_model.encode(batch, batch_size=64, show_progress_bar=False), texts, args.repeats
+    )
+
+    print(f"{len(texts)} sentences, model {ml_insert.MODEL_NAME}, threads {args.threads or 'default'}")
+    print(f"{'backend':<20} {'sent/sec':>10} {'speedup':>8} {'cos vs baseline':>16}")
+    print(f"{'baseline (st, 64)':<20} {len(texts) / baseline_time:>10.1f} {1.0:>8.2f} {1.0:>16.4f}")
+
+    for backend in args.backends.split(','):
+        encoder = embedding_backend.load_encoder(ml_insert.MODEL_NAME, backend=backend, threads=args.threads)
+        elapsed, embeddings = measure(encoder.encode, texts, args.repeats)
+        print(
+            f"{backend:<20} {len(texts) / elapsed:>10.1f} {baseline_time / elapsed:>8.2f} "
+            f"{cosine_agreement(baseline, embeddings):>16.4f}"
+        )
+
+
+if __name__ == '__main__':
+    main()
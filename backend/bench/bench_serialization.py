@@ -0,0 +1,108 @@
+"""
+Сериализация списков STE и карточек: путь FastAPI по умолчанию против быстрого.
+
+- orm: ORM объекты -> валидация схемой (from_attributes) -> dump -> json.dumps,
+  как FastAPI делает для response_model
+- fast: кортежи колонок -> dict (app.serialization) -> orjson
+
+Данные синтетические и уже в памяти: замеряется только сериализация.
+
+Примеры:
+    python -m bench.bench_serialization
+    python -m bench.bench_serialization --sizes 10,100,1000 --stes-per-card 20
+"""
+import argparse
+import json
+import time
+from typing import List
+
+import orjson
+from pydantic import TypeAdapter
+
+from app import models, schemas, serialization
+from bench.synthetic import generate_catalog
+
+
+def ste_tuples(catalog) -> List[tuple]:
+    rows = []
+    catalog = catalog.astype(object).where(catalog.notna(), None)
+    for i, record in enumerate(catalog.to_dict('records'), start=1):
+        values = {**record, 'id': i, 'card_id': None, 'image_url': None}
+        rows.append(tuple(values.get(field) for field in serialization.STE_FIELDS))
+    return rows
+
+
+def build_orm(ste_rows, card_count: int, per_card: int):
+    """Карточки с вложенными STE как ORM объекты (без сессии)."""
+    cards = []
+    for card_id in range(1, card_count + 1):
+        card = models.Card(id=card_id, name=f"Карточка {card_id}", feedback_count=3, feedback_positive=2)
+        chunk = ste_rows[(card_id - 1) * per_card:card_id * per_card]
+        card.stes = [models.STE(**{**dict(zip(serialization.STE_FIELDS, row)), 'card_id': card_id}) for row in chunk]
+        cards.append(card)
+    return cards
+
+
+def build_tuples(ste_rows, card_count: int, per_card: int):
+    card_rows = [(card_id, f"Карточка {card_id}", 3, 2) for card_id in range(1, card_count + 1)]
+    card_field = serialization.STE_FIELDS.index('card_id')
+    nested = []
+    for card_id in range(1, card_count + 1):
+        for row in ste_rows[(card_id - 1) * per_card:card_id * per_card]:
+            row = list(row)
+            row[card_field] = card_id
+            nested.append(tuple(row))
+    return card_rows, nested
+
+
+def fastapi_default(adapter, objects) -> bytes:
+    validated = adapter.validate_python(objects, from_attributes=True)
+    content = adapter.dump_python(validated, mode='json')
+    # Как starlette JSONResponse.render
+    return json.dumps(content, ensure_ascii=False, allow_nan=False, indent=None, separators=(',', ':')).encode('utf-8')
+
+
+def measure(fn, repeats: int) -> tuple:
+    payload = fn()
+    best = None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, len(payload)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', default='10,100,1000', help='Число элементов в ответе')
+    parser.add_argument('--stes-per-card', type=int, default=10, help='STE на карточку в списке карточек')
+    parser.add_argument('--repeats', type=int, default=20)
+    args = parser.parse_args()
+
+    sizes = [int(s) for s in args.sizes.split(',')]
+    ste_rows = ste_tuples(generate_catalog(max(sizes) * args.stes_per_card, seed=1))
+    ste_adapter = TypeAdapter(List[schemas.STEResponse])
+    card_adapter = TypeAdapter(List[schemas.CardResponse])
+
+    print(f"{'payload':<22} {'orm ms':>9} {'fast ms':>9} {'speedup':>8} {'KB':>8}")
+    for size in sizes:
+        rows = ste_rows[:size]
+        objects = [models.STE(**dict(zip(serialization.STE_FIELDS, row))) for row in rows]
+        orm_time, orm_bytes = measure(lambda: fastapi_default(ste_adapter, objects), args.repeats)
+        fast_time, _ = measure(lambda: orjson.dumps(serialization.ste_dicts(rows)), args.repeats)
+        print(f"{f'{size} STE':<22} {orm_time * 1000:>9.2f} {fast_time * 1000:>9.2f} "
+              f"{orm_time / fast_time:>7.1f}x {orm_bytes / 1024:>8.1f}")
+
+    for size in sizes:
+        cards = build_orm(ste_rows, size, args.stes_per_card)
+        card_rows, nested = build_tuples(ste_rows, size, args.stes_per_card)
+        orm_time, orm_bytes = measure(lambda: fastapi_default(card_adapter, cards), args.repeats)
+        fast_time, _ = measure(lambda: orjson.dumps(serialization.card_dicts(card_rows, nested)), args.repeats)
+        label = f"{size} cards x {args.stes_per_card} STE"
+        print(f"{label:<22} {orm_time * 1000:>9.2f} {fast_time * 1000:>9.2f} "
+              f"{orm_time / fast_time:>7.1f}x {orm_bytes / 1024:>8.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,64 @@
+"""
+Отчёт о качестве квантованного хранилища эмбеддингов относительно float32.
+
+Примеры:
+    python -m bench.embedding_store_report --input embeddings.npy
+    python -m bench.embedding_store_report --from-db --limit 20000
+"""
+import argparse
+
+import numpy as np
+
+from app import embedding_store
+
+
+def load_embeddings(args) -> np.ndarray:
+    if args.input:
+        return np.load(args.input).astype(np.float32)
+
+    from app import database, ml_insert, models
+
+    db = database.SessionLocal()
+    try:
+        titles = [row[0] or '' for row in db.query(models.STE.name).limit(args.limit)]
+    finally:
+        db.close()
+    model = ml_insert.get_embedding_model()
+    return np.asarray(model.encode(titles, show_progress_bar=False, batch_size=64), dtype=np.float32)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--input', help='.npy файл с float32 эмбеддингами')
+    parser.add_argument('--from-db', action='store_true', help='Закодировать названия STE из БД')
+    parser.add_argument('--limit', type=int, default=20000, help='Сколько STE брать из БД')
+    parser.add_argument('--k', type=int, default=10)
+    parser.add_argument('--queries', type=int, default=500)
+    parser.add_argument('--dims', default='0,128,64', help='Размерности PCA через запятую (0 - без PCA)')
+    parser.add_argument('--catalog-size', type=int, default=1_000_000,
+                        help='Для оценки объёма хранилища на весь каталог')
+    args = parser.parse_args()
+    if not args.input and not args.from_db:
+        parser.error('use --input or --from-db')
+
+    embeddings = load_embeddings(args)
+    configs = [
+        (dtype, int(dim))
+        for dim in args.dims.split(',')
+        for dtype in embedding_store.SUPPORTED_DTYPES
+    ]
+    report = embedding_store.quality_report(embeddings, configs, k=args.k, n_queries=args.queries)
+
+    recall_key = next(key for key in report[0] if key.startswith('recall@'))
+    print(f"{len(embeddings)} vectors, source dim {embeddings.shape[1]}")
+    print(f"{'dtype':<8} {'dim':>5} {'bytes/vec':>10} {'MB/catalog':>11} {recall_key:>10} {'abs err':>9}")
+    for row in report:
+        catalog_mb = row['bytes_per_vector'] * args.catalog_size / 2**20
+        print(
+            f"{row['dtype']:<8} {row['dim']:>5} {row['bytes_per_vector']:>10.1f} "
+            f"{catalog_mb:>11.1f} {row[recall_key]:>10.4f} {row['mean_abs_error']:>9.5f}"
+        )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,341 @@
+"""
+Нагрузочный тест публичного и админского API.
+
+Смешанная нагрузка на уже наполненную БД (см. bench.load_seed):
+- поиск fuzzy / ILIKE / exact, запросы по Zipf (частые запросы повторяются)
+- просмотр карточек: список -> карточка -> связь карточка/STE, категории
+- одиночные оценки и всплески пакетных оценок (/api/rating/batch)
+- импорт файла STE параллельно с остальной нагрузкой
+
+--concurrency виртуальных пользователей работают в замкнутом цикле
+(следующий запрос - после ответа). Отчёт: число запросов, ошибки,
+пропускная способность и p50/p95/p99 по каждому эндпоинту. С --baseline
+сравнивает p95 с прошлым отчётом (--json) и завершается с кодом 1 при
+регрессии больше --max-regression.
+
+Примеры:
+    python -m bench.load_test --url http://localhost:8000 --duration 60 --concurrency 32
+    python -m bench.load_test --in-process --db-url sqlite:///./load.db --duration 20 --json load.json
+    python -m bench.load_test --url http://localhost:8000 --baseline load.json --max-regression 0.2
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import time
+from collections import defaultdict
+from typing import Dict, List, Optional
+
+import numpy as np
+
+DEFAULT_MIX = 'search_fuzzy=30,search_ilike=20,search_exact=10,browse=25,categories=5,rate=10'
+
+
+class Stats:
+    """Задержки и ошибки по эндпоинтам (только после прогрева)."""
+
+    def __init__(self):
+        self.latencies: Dict[str, List[float]] = defaultdict(list)
+        self.errors: Dict[str, int] = defaultdict(int)
+        self.recording = False
+
+    def add(self, name: str, seconds: float, ok: bool) -> None:
+        if not self.recording:
+            return
+        self.latencies[name].append(seconds)
+        if not ok:
+            self.errors[name] += 1
+
+    def report(self, duration: float) -> dict:
+        result = {}
+        for name in sorted(self.latencies):
+            values = np.asarray(self.latencies[name]) * 1000
+            p50, p95, p99 = np.percentile(values, [50, 95, 99])
+            result[name] = {
+                'count': len(values),
+                'errors': self.errors[name],
+                'rps': round(len(values) / duration, 1),
+                'p50_ms': round(float(p50), 1),
+                'p95_ms': round(float(p95), 1),
+                'p99_ms': round(float(p99), 1),
+                'max_ms': round(float(values.max()), 1),
+            }
+        return result
+
+
+class Workload:
+    def __init__(self, client, args, stats: Stats):
+        self.client = client
+        self.args = args
+        self.stats = stats
+        self.rng = random.Random(args.seed)
+        self.admin_headers = {}
+        self.user_headers: List[dict] = []
+        self.cards: List[tuple] = []  # (card_id, [ste_id, ...])
+        self.queries: Dict[str, List[str]] = {}
+        self.weights: Dict[str, List[float]] = {}
+
+    async def call(self, name: str, method: str, path: str, **kwargs):
+        start = time.perf_counter()
+        try:
+            response = await self.client.request(method, path, **kwargs)
+            ok = response.status_code < 400
+        except Exception:
+            response, ok = None, False
+        self.stats.add(name, time.perf_counter() - start, ok)
+        return response
+
+    # --- подготовка ---
+
+    async def login(self, login: str, password: str) -> Optional[dict]:
+        response = await self.client.post('/api/auth/login', json={'login': login, 'password': password})
+        if response.status_code != 200:
+            return None
+        return {'Authorization': f"Bearer {response.json()['access_token']}"}
+
+    def build_queries(self) -> None:
+        """Словарь запросов из того же генератора, что наполнял БД; вес запроса ~ 1 / rank^s."""
+        from bench.synthetic import generate_catalog
+
+        catalog = generate_catalog(self.args.vocab_size, seed=self.args.seed)
+        names = catalog['name'].dropna().tolist()
+        short = sorted({' '.join(name.split()[:2]) for name in names})
+        exact = sorted(set(catalog['model_name'].dropna()) | set(catalog['manufacturer'].dropna()))
+        for kind, values in (('fuzzy', sorted(set(names))), ('ilike', short), ('exact', exact)):
+            values = list(values)
+            self.rng.shuffle(values)
+            ranks = np.arange(1, len(values) + 1)
+            self.queries[kind] = values
+            self.weights[kind] = list(np.cumsum(1.0 / ranks ** self.args.zipf_s))
+
+    def query(self, kind: str) -> str:
+        return self.rng.choices(self.queries[kind], cum_weights=self.weights[kind])[0]
+
+    async def setup(self) -> None:
+        self.admin_headers = await self.login(self.args.admin_login, self.args.admin_password)
+        if self.admin_headers is None:
+            raise SystemExit(f"Cannot log in as {self.args.admin_login}")
+        for i in range(1, self.args.users + 1):
+            headers = await self.login(f'load{i}', self.args.user_password)
+            if headers is not None:
+                self.user_headers.append(headers)
+        if not self.user_headers:
+            # Без пользователей load* (bench.load_seed) оценки идут от админа
+            self.user_headers = [self.admin_headers]
+
+        for skip in range(0, self.args.browse_cards, 200):
+            response = await self.client.get(
+                '/api/admin/card/', params={'skip': skip, 'limit': 200}, headers=self.admin_headers
+            )
+            page = response.json() if response.status_code == 200 else []
+            self.cards += [(card['id'], [ste['id'] for ste in card['stes']]) for card in page if card['stes']]
+            if len(page) < 200:
+                break
+        if not self.cards:
+            raise SystemExit("No cards with STE - seed the database first (python -m bench.load_seed)")
+        self.build_queries()
+
+    # --- сценарии ---
+
+    async def search_fuzzy(self):
+        await self.call('GET /api/search fuzzy', 'GET', '/api/search', params={'query': self.query('fuzzy')})
+
+    async def search_ilike(self):
+        await self.call('GET /api/search ilike', 'GET', '/api/search',
+                        params={'query': self.query('ilike'), 'fuzzy': 'false'})
+
+    async def search_exact(self):
+        await self.call('GET /api/search exact', 'GET', '/api/search',
+                        params={'query': self.query('exact'), 'exact': 'true'})
+
+    async def browse(self):
+        skip = self.rng.randrange(0, max(len(self.cards) - 20, 1))
+        await self.call('GET /api/admin/card/', 'GET', '/api/admin/card/',
+                        params={'skip': skip, 'limit': 20}, headers=self.admin_headers)
+        card_id, ste_ids = self.rng.choice(self.cards)
+        await self.call('GET /api/admin/card/{id}', 'GET', f'/api/admin/card/{card_id}', headers=self.admin_headers)
+        await self.call('GET /api/card/{card_id}/{ste_id}', 'GET', f'/api/card/{card_id}/{self.rng.choice(ste_ids)}')
+
+    async def categories(self):
+        await self.call('GET /api/categories', 'GET', '/api/categories')
+
+    def vote(self) -> dict:
+        card_id, ste_ids = self.rng.choice(self.cards)
+        return {'card_id': card_id, 'ste_id': self.rng.choice(ste_ids), 'score': int(self.rng.random() < 0.8)}
+
+    async def rate(self):
+        await self.call('POST /api/rating', 'POST', '/api/rating',
+                        json=self.vote(), headers=self.rng.choice(self.user_headers))
+
+    # --- циклы ---
+
+    async def user_loop(self, deadline: float, mix: List[tuple]) -> None:
+        scenarios = [getattr(self, name) for name, _ in mix]
+        cum_weights = list(np.cumsum([weight for _, weight in mix]))
+        while time.perf_counter() < deadline:
+            await self.rng.choices(scenarios, cum_weights=cum_weights)[0]()
+            if self.args.think_ms:
+                await asyncio.sleep(self.rng.expovariate(1000 / self.args.think_ms))
+
+    async def rating_bursts(self, deadline: float) -> None:
+        """Всплески: --burst-size одновременных пакетов по --burst-votes голосов."""
+        while self.args.burst_every > 0:
+            await asyncio.sleep(self.args.burst_every)
+            if time.perf_counter() >= deadline:
+                return
+            await asyncio.gather(*[
+                self.call('POST /api/rating/batch', 'POST', '/api/rating/batch',
+                          json={'votes': [self.vote() for _ in range(self.args.burst_votes)]},
+                          headers=self.rng.choice(self.user_headers))
+                for _ in range(self.args.burst_size)
+            ])
+
+    async def imports(self, deadline: float) -> None:
+        """Импорт файла STE на фоне нагрузки (повторный импорт того же файла - обновления)."""
+        if self.args.import_size <= 0:
+            return
+        from bench.synthetic import generate_catalog, to_import_csv
+
+        catalog = generate_catalog(self.args.import_size, seed=self.args.seed + 1)
+        # Свои external_id, чтобы не перезаписывать каталог из bench.load_seed
+        catalog['external_id'] = catalog['external_id'] + 10_000_000
+        payload = to_import_csv(catalog)
+        await asyncio.sleep(self.args.import_delay)
+        while time.perf_counter() < deadline:
+            await self.call('POST /api/admin/ste/upload', 'POST', '/api/admin/ste/upload',
+                            files={'file': ('load.csv', payload, 'text/csv')}, headers=self.admin_headers)
+            if self.args.import_every <= 0:
+                return
+            await asyncio.sleep(self.args.import_every)
+
+
+def parse_mix(value: str) -> List[tuple]:
+    mix = []
+    for part in value.split(','):
+        name, _, weight = part.partition('=')
+        if not hasattr(Workload, name.strip()):
+            raise SystemExit(f"Unknown scenario: {name}")
+        mix.append((name.strip(), float(weight or 1)))
+    return mix
+
+
+async def run(client, args) -> dict:
+    stats = Stats()
+    workload = Workload(client, args, stats)
+    await workload.setup()
+    mix = parse_mix(args.mix)
+
+    deadline = time.perf_counter() + args.warmup + args.duration
+    tasks = [workload.user_loop(deadline, mix) for _ in range(args.concurrency)]
+    tasks += [workload.rating_bursts(deadline), workload.imports(deadline)]
+    gathered = asyncio.gather(*tasks)
+
+    await asyncio.sleep(args.warmup)
+    stats.recording = True
+    started = time.perf_counter()
+    await gathered
+    # Последние запросы могли закончиться позже дедлайна
+    duration = time.perf_counter() - started
+    return {'duration': round(duration, 1), 'concurrency': args.concurrency, 'endpoints': stats.report(duration)}
+
+
+async def run_http(args) -> dict:
+    import httpx
+
+    limits = httpx.Limits(max_connections=args.concurrency + args.burst_size + 2)
+    async with httpx.AsyncClient(base_url=args.url, timeout=args.timeout, limits=limits) as client:
+        return await run(client, args)
+
+
+async def run_in_process(args) -> dict:
+    """Приложение в этом же процессе (без uvicorn и сети) - для быстрых сравнений на SQLite."""
+    import httpx
+
+    os.environ['DATABASE_URL'] = args.db_url
+    from app import main as app_main
+
+    async with app_main.app.router.lifespan_context(app_main.app):
+        transport = httpx.ASGITransport(app=app_main.app)
+        async with httpx.AsyncClient(transport=transport, base_url='http://loadtest', timeout=args.timeout) as client:
+            return await run(client, args)
+
+
+def print_report(report: dict) -> None:
+    endpoints = report['endpoints']
+    print(f"{'endpoint':<34} {'count':>7} {'err':>5} {'rps':>7} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'max ms':>8}")
+    for name, row in endpoints.items():
+        print(f"{name:<34} {row['count']:>7} {row['errors']:>5} {row['rps']:>7} "
+              f"{row['p50_ms']:>8} {row['p95_ms']:>8} {row['p99_ms']:>8} {row['max_ms']:>8}")
+    total = sum(row['count'] for row in endpoints.values())
+    errors = sum(row['errors'] for row in endpoints.values())
+    print(f"total: {total} requests, {errors} errors, {total / report['duration']:.1f} rps "
+          f"over {report['duration']}s at concurrency {report['concurrency']}")
+
+
+def compare(report: dict, baseline: dict, max_regression: float, min_count: int = 20) -> List[str]:
+    """Эндпоинты, у которых p95 вырос больше чем на max_regression."""
+    regressions = []
+    for name, row in report['endpoints'].items():
+        old = baseline.get('endpoints', {}).get(name)
+        if not old or old['count'] < min_count or row['count'] < min_count:
+            continue
+        change = row['p95_ms'] / old['p95_ms'] - 1 if old['p95_ms'] else 0.0
+        print(f"{name:<34} p95 {old['p95_ms']:>8} -> {row['p95_ms']:>8} ms ({change:+.0%})")
+        if change > max_regression:
+            regressions.append(name)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', default='http://localhost:8000')
+    parser.add_argument('--in-process', action='store_true', help='Запустить приложение в этом процессе')
+    parser.add_argument('--db-url', default=os.getenv('DATABASE_URL'), help='БД для --in-process')
+    parser.add_argument('--duration', type=float, default=60, help='Секунд замера')
+    parser.add_argument('--warmup', type=float, default=5, help='Секунд прогрева без замера')
+    parser.add_argument('--concurrency', type=int, default=16, help='Виртуальных пользователей')
+    parser.add_argument('--think-ms', type=float, default=0, help='Средняя пауза между запросами пользователя')
+    parser.add_argument('--mix', default=DEFAULT_MIX, help='Веса сценариев')
+    parser.add_argument('--zipf-s', type=float, default=1.1, help='Показатель Zipf для запросов поиска')
+    parser.add_argument('--vocab-size', type=int, default=5000, help='STE в генераторе словаря запросов')
+    parser.add_argument('--browse-cards', type=int, default=2000, help='Сколько карточек загрузить для просмотра')
+    parser.add_argument('--burst-every', type=float, default=10, help='Секунд между всплесками оценок (0 - без)')
+    parser.add_argument('--burst-size', type=int, default=8, help='Одновременных пакетов во всплеске')
+    parser.add_argument('--burst-votes', type=int, default=100, help='Голосов в пакете')
+    parser.add_argument('--import-size', type=int, default=2000, help='Строк в файле импорта (0 - без импорта)')
+    parser.add_argument('--import-delay', type=float, default=5, help='Секунд до первого импорта')
+    parser.add_argument('--import-every', type=float, default=0, help='Повторять импорт (0 - один раз)')
+    parser.add_argument('--admin-login', default='admin')
+    parser.add_argument('--admin-password', default='admin1')
+    parser.add_argument('--users', type=int, default=20, help='Сколько пользователей load* использовать')
+    parser.add_argument('--user-password', default='load')
+    parser.add_argument('--timeout', type=float, default=60)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', help='Сохранить отчёт в файл')
+    parser.add_argument('--baseline', help='Отчёт прошлого прогона для сравнения p95')
+    parser.add_argument('--max-regression', type=float, default=0.2, help='Допустимый рост p95 (доля)')
+    args = parser.parse_args()
+
+    if args.in_process:
+        if not args.db_url:
+            parser.error('--in-process requires --db-url or DATABASE_URL')
+        report = asyncio.run(run_in_process(args))
+    else:
+        report = asyncio.run(run_http(args))
+
+    print_report(report)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(report, json.load(f), args.max_regression)
+        if regressions:
+            print(f"p95 regression over {args.max_regression:.0%}: {', '.join(regressions)}")
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,218 @@
+"""
+Бенчмарк ML пайплайна на синтетических каталогах.
+
+Для каждого размера каталога (в отдельном процессе, чтобы пик RSS был честным)
+создаётся БД-заглушка, заполняется синтетическими STE и прогоняются стадии
+load -> encode -> cluster -> merge -> write. Для каждой стадии пишется время
+и пик RSS, для результата - ARI относительно эталонных групп.
+
+Примеры:
+    python -m bench.ml_pipeline_bench --sizes 10000,100000
+    python -m bench.ml_pipeline_bench --sizes 10000 --encoder model --db-url postgresql://...
+    python -m bench.ml_pipeline_bench --sizes 1000000 --no-blocking --output results.json
+"""
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import zlib
+
+import numpy as np
+
+
+class HashingEncoder:
+    """Быстрая замена модели: хешированные символьные 3-граммы (для замеров без torch)."""
+
+    name = 'stub'
+
+    def __init__(self, dim: int = 256):
+        self.dim = dim
+
+    def encode(self, texts, show_progress_bar: bool = False, batch_size: int = None, **kwargs) -> np.ndarray:
+        result = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            text = f" {str(text).lower()} "
+            for i in range(len(text) - 2):
+                result[row, zlib.crc32(text[i:i + 3].encode('utf-8')) % self.dim] += 1.0
+        norms = np.linalg.norm(result, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return result / norms
+
+    def get_sentence_embedding_dimension(self) -> int:
+        return self.dim
+
+
+class TimedEncoder:
+    """Обёртка, которая копит время, проведённое в encode."""
+
+    def __init__(self, encoder):
+        self.encoder = encoder
+        self.elapsed = 0.0
+        self.count = 0
+
+    def encode(self, texts, **kwargs):
+        start = time.perf_counter()
+        try:
+            return self.encoder.encode(texts, **kwargs)
+        finally:
+            self.elapsed += time.perf_counter() - start
+            self.count += len(texts)
+
+    def get_sentence_embedding_dimension(self) -> int:
+        return self.encoder.get_sentence_embedding_dimension()
+
+
+def peak_rss_mb() -> float:
+    # На Linux ru_maxrss в килобайтах
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def seed_database(db, catalog, batch_size: int = 10000) -> None:
+    from sqlalchemy import insert
+
+    from app import models
+
+    columns = ['external_id', 'name', 'manufacturer', 'model_name', 'category_id',
+               'category_name', 'country_of_origin', 'characteristics']
+    records = catalog[columns].to_dict('records')
+    for start in range(0, len(records), batch_size):
+        db.execute(insert(models.STE), records[start:start + batch_size])
+    db.commit()
+
+
+def run_single(args) -> dict:
+    """Один прогон в текущем процессе (окружение уже настроено родителем)."""
+    from sklearn.metrics import adjusted_rand_score
+
+    from app import database, ml_insert, models
+    from bench.synthetic import generate_catalog
+
+    result = {'size': args.size, 'encoder': args.encoder, 'blocking': ml_insert.ML_BLOCKING, 'stages': {}}
+
+    def stage(name, started, **extra):
+        result['stages'][name] = {'seconds': round(time.perf_counter() - started, 3),
+                                  'peak_rss_mb': round(peak_rss_mb(), 1), **extra}
+
+    started = time.perf_counter()
+    catalog = generate_catalog(args.size, mean_group_size=args.group_size, noise=args.noise, seed=args.seed)
+    models.Base.metadata.drop_all(bind=database.engine)
+    models.Base.metadata.create_all(bind=database.engine)
+    db = database.SessionLocal()
+    seed_database(db, catalog)
+    stage('seed', started)
+
+    encoder = HashingEncoder() if args.encoder == 'stub' else ml_insert.get_embedding_model()
+    timed = TimedEncoder(encoder)
+    ml_insert._model_cache = timed
+
+    started = time.perf_counter()
+    left_df = ml_insert.get_all_stes_from_db(db)
+    stage('load', started, rows=len(left_df))
+
+    embeddings = None
+    if not ml_insert.ML_BLOCKING:
+        started = time.perf_counter()
+        embeddings = timed.encode(left_df['title'].tolist(), show_progress_bar=False, batch_size=64)
+        stage('encode', started, sentences=timed.count)
+
+    started = time.perf_counter()
+    encode_before = timed.elapsed
+    right_df = ml_insert.run_ml_clustering(left_df, embeddings)
+    if ml_insert.ML_BLOCKING:
+        # Кодирование идёт внутри блокинга - выделяем его время отдельно
+        encode_seconds = timed.elapsed - encode_before
+        result['stages']['encode'] = {'seconds': round(encode_seconds, 3), 'peak_rss_mb': round(peak_rss_mb(), 1),
+                                      'sentences': timed.count}
+        stage('cluster', started + encode_seconds)
+    else:
+        stage('cluster', started)
+
+    started = time.perf_counter()
+    merged_df = ml_insert.merge_cluster_to_card(left_df, right_df)
+    reconciled_df, stats = ml_insert.reconcile_clusters_to_cards(db, merged_df)
+    stage('merge', started, cards_created=stats['cards_created'])
+
+    started = time.perf_counter()
+    updated = ml_insert.update_stes_in_db(db, reconciled_df, commit=False)
+    ml_insert.retire_empty_cards(db, stats['orphaned_card_ids'])
+    db.commit()
+    stage('write', started, updated=updated)
+
+    # Шум (card_id = 0) - каждый STE сам по себе
+    predicted = reconciled_df.set_index('id')['card_id']
+    predicted = predicted.where(predicted != 0, -predicted.index.to_series())
+    truth = catalog['group'].to_numpy()
+    ste_ids = [row[0] for row in db.query(models.STE.id).order_by(models.STE.id)]
+    result['ari'] = round(float(adjusted_rand_score(truth, predicted.reindex(ste_ids).to_numpy())), 4)
+    result['clusters'] = int(stats['cards_created'])
+    result['true_groups'] = int(catalog['group'].nunique())
+    result['total_seconds'] = round(sum(
+        s['seconds'] for name, s in result['stages'].items() if name != 'seed'
+    ), 3)
+    db.close()
+    return result
+
+
+def run_in_subprocess(size: int, args) -> dict:
+    env = dict(os.environ)
+    workdir = tempfile.mkdtemp(prefix='ml-bench-')
+    env['DATABASE_URL'] = args.db_url or f"sqlite:///{workdir}/bench.db"
+    env['EMBEDDING_STORE_PATH'] = os.path.join(workdir, 'embeddings') if args.store else ''
+    env['ML_BLOCKING'] = '0' if args.no_blocking else '1'
+    command = [
+        sys.executable, '-m', 'bench.ml_pipeline_bench', '--single',
+        '--size', str(size), '--encoder', args.encoder, '--group-size', str(args.group_size),
+        '--noise', str(args.noise), '--seed', str(args.seed),
+    ]
+    completed = subprocess.run(command, env=env, capture_output=True, text=True)
+    if completed.returncode != 0:
+        raise RuntimeError(f"Benchmark for size {size} failed:\n{completed.stderr}")
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+
+def print_report(results) -> None:
+    stages = ['load', 'encode', 'cluster', 'merge', 'write']
+    header = f"{'size':>9} " + ' '.join(f"{s + ' s':>10}" for s in stages) + f" {'total s':>9} {'peak MB':>9} {'ARI':>7}"
+    print(header)
+    for r in results:
+        cells = ' '.join(f"{r['stages'].get(s, {}).get('seconds', float('nan')):>10.2f}" for s in stages)
+        peak = max(s['peak_rss_mb'] for s in r['stages'].values())
+        print(f"{r['size']:>9} {cells} {r['total_seconds']:>9.2f} {peak:>9.1f} {r['ari']:>7.4f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', default='10000,100000,1000000')
+    parser.add_argument('--encoder', choices=['stub', 'model'], default='stub',
+                        help='stub - хешированные n-граммы, model - EMBEDDING_MODEL через EMBEDDING_BACKEND')
+    parser.add_argument('--group-size', type=float, default=4.0, help='Средний размер группы дубликатов')
+    parser.add_argument('--noise', type=float, default=0.3, help='Вероятность искажений названия')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--db-url', help='БД для записи (по умолчанию временный SQLite)')
+    parser.add_argument('--no-blocking', action='store_true', help='Отключить MinHash/LSH блокинг')
+    parser.add_argument('--store', action='store_true', help='Сохранять эмбеддинги в хранилище')
+    parser.add_argument('--output', help='Сохранить результаты в JSON')
+    parser.add_argument('--single', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--size', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.single:
+        print(json.dumps(run_single(args)))
+        return
+
+    results = []
+    for size in (int(s) for s in args.sizes.split(',')):
+        print(f"Running size {size}...", file=sys.stderr)
+        results.append(run_in_subprocess(size, args))
+    print_report(results)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
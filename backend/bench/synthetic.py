@@ -0,0 +1,125 @@
+"""
+Генератор синтетических каталогов STE на русском языке.
+
+Каталог состоит из групп "одинаковых" товаров (эталонная разметка для ARI):
+внутри группы названия отличаются порядком слов, регистром, пунктуацией,
+единицами измерения, опечатками и номером модели у части STE.
+"""
+import random
+from typing import List
+
+import numpy as np
+import pandas as pd
+
+_PRODUCTS = [
+    ('Бумага офисная', 'Канцелярия', ['А4', 'А3'], ['80 г/м2', '500 листов', 'белая']),
+    ('Ручка шариковая', 'Канцелярия', ['синяя', 'черная', 'красная'], ['0.7 мм', 'автоматическая', 'с колпачком']),
+    ('Карандаш чернографитный', 'Канцелярия', ['HB', '2B', 'H'], ['с ластиком', 'заточенный']),
+    ('Картридж лазерный', 'Оргтехника', ['черный', 'цветной'], ['для принтера', 'оригинальный', 'совместимый']),
+    ('Стул офисный', 'Мебель', ['черный', 'серый'], ['на колесиках', 'с подлокотниками', 'ткань']),
+    ('Кресло руководителя', 'Мебель', ['кожа', 'экокожа'], ['с подголовником', 'черное']),
+    ('Стол письменный', 'Мебель', ['120x60', '140x70'], ['ЛДСП', 'с тумбой', 'венге']),
+    ('Перчатки нитриловые', 'Медицина', ['S', 'M', 'L'], ['неопудренные', '100 шт', 'голубые']),
+    ('Шприц одноразовый', 'Медицина', ['2 мл', '5 мл', '10 мл'], ['с иглой', 'стерильный', 'трехкомпонентный']),
+    ('Маска медицинская', 'Медицина', ['трехслойная', 'четырехслойная'], ['на резинках', '50 шт']),
+    ('Мыло жидкое', 'Хозтовары', ['500 мл', '5 л'], ['антибактериальное', 'с дозатором']),
+    ('Бумага туалетная', 'Хозтовары', ['двухслойная', 'однослойная'], ['8 рулонов', 'белая']),
+    ('Лампа светодиодная', 'Электротовары', ['E27', 'E14'], ['10 Вт', '4000K', 'матовая']),
+    ('Кабель силовой', 'Электротовары', ['ВВГнг 3x2.5', 'ВВГнг 3x1.5'], ['100 м', 'медный']),
+    ('Монитор', 'Оргтехника', ['24"', '27"'], ['IPS', 'Full HD', 'HDMI']),
+    ('Клавиатура', 'Оргтехника', ['проводная', 'беспроводная'], ['USB', 'черная', 'русская раскладка']),
+]
+_BRANDS = [
+    'Снегурочка', 'BIC', 'Erich Krause', 'Комус', 'HP', 'Canon', 'Brauberg', 'Бюрократ', 'Chairman',
+    'Klever', 'Медтехника', 'Vogt Medical', 'Aura', 'Эконом', 'Navigator', 'Logitech', 'Samsung', 'Philips',
+]
+_UNITS = {'шт': 'штук', 'мл': 'миллилитров', 'мм': 'миллиметров', 'л': 'литров'}
+
+
+def _typo(word: str, rng: random.Random) -> str:
+    if len(word) < 4:
+        return word
+    i = rng.randrange(1, len(word) - 1)
+    return word[:i] + word[i + 1] + word[i] + word[i + 2:]
+
+
+def _variant(words: List[str], rng: random.Random, noise: float) -> str:
+    words = list(words)
+    if rng.random() < noise:
+        tail = words[1:]
+        rng.shuffle(tail)
+        words = words[:1] + tail
+    if rng.random() < noise:
+        words = [_UNITS.get(w, w) for w in words]
+    if rng.random() < noise / 2:
+        i = rng.randrange(len(words))
+        words[i] = _typo(words[i], rng)
+    text = ' '.join(words)
+    if rng.random() < noise:
+        text = text.replace(' ', ', ', 1)
+    if rng.random() < noise / 2:
+        text = text.upper() if rng.random() < 0.5 else text.lower()
+    return text
+
+
+def generate_catalog(size: int, mean_group_size: float = 4.0, noise: float = 0.3, seed: int = 0) -> pd.DataFrame:
+    """
+    Синтетический каталог из ``size`` STE.
+
+    Args:
+        mean_group_size: средний размер группы дубликатов (геометрическое распределение)
+        noise: вероятность каждого вида искажения названия внутри группы
+
+    Returns:
+        DataFrame с колонками модели STE и ``group`` - эталонной группой
+    """
+    rng = random.Random(seed)
+    np_rng = np.random.default_rng(seed)
+    rows = []
+    group = 0
+    while len(rows) < size:
+        product, category, options, attributes = rng.choice(_PRODUCTS)
+        category_id = 1000 + [p[0] for p in _PRODUCTS].index(product)
+        brand = rng.choice(_BRANDS)
+        model = f"{brand[:2].upper()}-{rng.randint(100, 9999)}"
+        base = [product, rng.choice(options), brand] + rng.sample(attributes, rng.randint(1, len(attributes)))
+        characteristics = {
+            'Бренд': brand,
+            'Вариант': base[1],
+            'Страна': rng.choice(['Россия', 'Китай', 'Германия']),
+        }
+        group_size = min(int(np_rng.geometric(1.0 / mean_group_size)), size - len(rows))
+        for _ in range(group_size):
+            # У части STE группы номер модели записан иначе или с суффиксом
+            model_name = model if rng.random() > noise else f"{model}{rng.choice(['', '/A', ' PRO', '-1'])}"
+            rows.append({
+                'external_id': len(rows) + 1,
+                'name': _variant(base + ([model_name] if rng.random() < 0.5 else []), rng, noise),
+                'manufacturer': brand if rng.random() > noise / 3 else None,
+                'model_name': model_name,
+                'category_id': category_id,
+                'category_name': category,
+                'country_of_origin': characteristics['Страна'],
+                'characteristics': characteristics,
+                'group': group,
+            })
+        group += 1
+    return pd.DataFrame(rows)
+
+
+def to_import_csv(catalog: pd.DataFrame) -> bytes:
+    """Каталог в формате файла импорта /api/admin/ste/upload."""
+    df = pd.DataFrame({
+        'id сте': catalog['external_id'],
+        'название сте': catalog['name'],
+        'ссылка на картинку сте': None,
+        'модель': catalog['model_name'],
+        'страна происхождения': catalog['country_of_origin'],
+        'производитель': catalog['manufacturer'],
+        'id категории': catalog['category_id'],
+        'название категории': catalog['category_name'],
+        'характеристики': catalog['characteristics'].apply(
+            lambda chars: '; '.join(f"{k}:{v}" for k, v in chars.items())
+        ),
+    })
+    return df.to_csv(index=False).encode('utf-8')
@@ -0,0 +1,22 @@
+#!/bin/sh
+# Запуск бэкенда в проде: общий сервис эмбеддингов + uvicorn воркеры
+set -e
+
+if [ -n "$EMBEDDING_SERVICE_SOCKET" ]; then
+    # Сервис перезапускается при падении, воркеры переподключаются сами
+    (
+        while true; do
+            python -m app.embedding_service || true
+            echo "Embedding service exited, restarting" >&2
+            sleep 1
+        done
+    ) &
+    # Воркеры стартуют только когда модель загружена и прогрета
+    python -m app.embedding_service --wait
+fi
+
+# Метрики воркеров собираются через общий каталог (очищается при старте)
+export PROMETHEUS_MULTIPROC_DIR="${PROMETHEUS_MULTIPROC_DIR:-/tmp/prometheus}"
+rm -rf "$PROMETHEUS_MULTIPROC_DIR" && mkdir -p "$PROMETHEUS_MULTIPROC_DIR"
+
+exec uvicorn app.main:app --host 0.0.0.0 --port 8000 --workers "${UVICORN_WORKERS:-2}"